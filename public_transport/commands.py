@@ -0,0 +1,41 @@
+"""Long-running bench commands.
+
+These loops tick every few seconds, so they run as their own processes
+rather than as scheduler jobs that would hold a queue worker for most of
+every minute. Add them to the bench Procfile or supervisor config, e.g.
+
+    position_broadcaster: bench --site mysite run-position-broadcaster
+    deviation_evaluator: bench --site mysite run-deviation-evaluator
+"""
+import click
+from frappe.commands import get_site, pass_context
+
+@click.command("run-position-broadcaster")
+@pass_context
+def run_position_broadcaster(context):
+    """Publish queued bus positions to followers and map viewports"""
+    import frappe
+    from public_transport.public_transport.utils import position_broadcaster
+
+    frappe.init(site=get_site(context))
+    frappe.connect()
+    try:
+        position_broadcaster.run_position_broadcaster()
+    finally:
+        frappe.destroy()
+
+@click.command("run-deviation-evaluator")
+@pass_context
+def run_deviation_evaluator(context):
+    """Evaluate the whole fleet for route deviations when batch mode is on"""
+    import frappe
+    from public_transport.public_transport.utils import deviation_evaluator
+
+    frappe.init(site=get_site(context))
+    frappe.connect()
+    try:
+        deviation_evaluator.run_deviation_evaluator()
+    finally:
+        frappe.destroy()
+
+commands = [run_position_broadcaster, run_deviation_evaluator]
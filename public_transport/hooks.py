@@ -56,13 +56,6 @@ fixtures = [
 # Document Events
 # --------------
 doc_events = {
-    "Booking": {
-        "on_update": "public_transport.public_transport.doctype.booking.booking.on_update",
-        "on_submit": [
-            "public_transport.public_transport.doctype.booking.booking.on_submit",
-            "public_transport.public_transport.utils.sms_service.send_booking_confirmation"
-        ]
-    },
     "Payment": {
         "on_submit": "public_transport.public_transport.doctype.payment.payment.on_submit"
     },
@@ -70,7 +63,7 @@ doc_events = {
         "after_insert": "public_transport.public_transport.utils.sms_service.process_sms_queue"
     },
     "GPS Location Log": {
-        "after_insert": "public_transport.public_transport.utils.gps_tracking.update_bus_location"
+        "after_insert": "public_transport.public_transport.utils.gps_tracking.on_location_log_insert"
     }
 }
 
@@ -83,8 +76,8 @@ scheduler_events = {
         "public_transport.public_transport.commands.cleanup_gps_logs",
         "public_transport.public_transport.utils.notification_analytics.NotificationAnalytics.generate_daily_report"
     ],
-    "hourly": [
-        "public_transport.public_transport.commands.cleanup_expired_seat_locks"
+    "daily_long": [
+        "public_transport.public_transport.utils.travel_time_model.refresh_travel_time_model"
     ],
     "weekly": [
         "public_transport.public_transport.doctype.booking_agent_settings.booking_agent_settings.process_weekly_payouts"
@@ -93,6 +86,11 @@ scheduler_events = {
         "public_transport.public_transport.doctype.booking_agent_settings.booking_agent_settings.process_monthly_payouts"
     ],
     "all": [
+        "public_transport.public_transport.utils.trip_resolver.update_trip_states",
+        "public_transport.public_transport.utils.arrival_board.prune_stop_arrivals",
+        "public_transport.public_transport.utils.viewport_grid.prune_viewports",
+        "public_transport.public_transport.realtime.cleanup_subscriptions",
+        "public_transport.public_transport.utils.seat_reservations.reconcile_seat_counts",
         "public_transport.public_transport.utils.sms_service.process_sms_queue",
         "public_transport.public_transport.utils.alert_generator.check_weather_conditions",
         "public_transport.public_transport.utils.alert_generator.check_traffic_incidents"
@@ -100,6 +98,9 @@ scheduler_events = {
     "cron": {
         "*/15 * * * *": [  # Every 15 minutes
             "public_transport.public_transport.utils.notification_analytics.update_notification_metrics"
+        ],
+        "* * * * *": [
+            "public_transport.public_transport.commands.cleanup_expired_seat_locks"
         ]
     }
 }
@@ -10,7 +10,7 @@ public_transport.realtime = {
             if (cur_frm && cur_frm.doctype === 'Bus Trip' && cur_frm.doc.name === data.trip) {
                 cur_frm.reload_doc();
                 frappe.show_alert({
-                    message: `Seat ${data.seat_id} status updated to ${data.status}`,
+                    message: `Seats ${data.seat_ids.join(', ')} updated to ${data.status}`,
                     indicator: 'green'
                 });
             }
@@ -26,15 +26,16 @@ public_transport.realtime = {
             }
         });
 
-        frappe.realtime.on('gps_update', function(data) {
+        // Sent to each user subscribed to the bus, as a compact delta
+        frappe.realtime.on('bus_location', function(data) {
             if (cur_frm && cur_frm.doctype === 'Bus' && cur_frm.doc.name === data.bus) {
                 frappe.show_alert({
-                    message: `Bus location updated at ${data.timestamp}`,
+                    message: `Bus location updated at ${data.ts}`,
                     indicator: 'blue'
                 });
                 // Update map if it exists
                 if (cur_frm.map_view) {
-                    cur_frm.map_view.update_location(data.latitude, data.longitude);
+                    cur_frm.map_view.update_location(data.lat, data.lng);
                 }
             }
         });
@@ -8,6 +8,7 @@ public_transport.realtime.BusTracker = class BusTracker {
         this.path = [];
         this.mapElement = mapElement;
         this.subscribers = new Set();
+        this.state = {};
         
         this.initialize();
     }
@@ -160,21 +161,46 @@ public_transport.realtime.BusTracker = class BusTracker {
     }
     
     subscribeToUpdates() {
-        frappe.realtime.on(`bus_location_${this.busId}`, (data) => {
-            this.handleLocationUpdate(data);
-        });
+        // Positions of every tracked bus arrive on one event as compact deltas
+        this.onLocation = (data) => {
+            if (data.bus === this.busId) {
+                this.handleLocationUpdate(data);
+            }
+        };
+        frappe.realtime.on('bus_location', this.onLocation);
         
-        // Subscribe to bus updates
-        frappe.call({
+        this.renewSubscription();
+    }
+    
+    async renewSubscription() {
+        // Subscribing again is the heartbeat that keeps updates flowing
+        const result = await frappe.call({
             method: 'public_transport.public_transport.realtime.subscribe_to_bus',
             args: { bus_id: this.busId }
         });
+        
+        if (result.message) {
+            // The full latest position, as updates only carry what changed
+            const position = result.message.position;
+            if (position && position.ts !== this.state.ts) {
+                this.handleLocationUpdate(position);
+            } else if (position) {
+                Object.assign(this.state, position);
+            }
+
+            this.renewTimer = setTimeout(
+                () => this.renewSubscription(),
+                result.message.renew_after * 1000
+            );
+        }
     }
     
-    handleLocationUpdate(data) {
+    handleLocationUpdate(update) {
+        // Speed, heading and deviation are only sent when they change
+        const data = Object.assign(this.state, update);
         const position = {
-            lat: parseFloat(data.location.lat),
-            lng: parseFloat(data.location.lng)
+            lat: parseFloat(data.lat),
+            lng: parseFloat(data.lng)
         };
         
         // Update marker position
@@ -308,7 +334,8 @@ public_transport.realtime.BusTracker = class BusTracker {
             args: { bus_id: this.busId }
         });
         
-        frappe.realtime.off(`bus_location_${this.busId}`);
+        frappe.realtime.off('bus_location', this.onLocation);
+        clearTimeout(this.renewTimer);
         
         // Clear map elements
         if (this.marker) {
@@ -320,4 +347,90 @@ public_transport.realtime.BusTracker = class BusTracker {
         
         this.subscribers.clear();
     }
-};
\ No newline at end of file
+};
+public_transport.realtime.FleetMap = class FleetMap {
+    constructor(mapElement) {
+        this.markers = new Map();
+        this.map = new google.maps.Map(mapElement, {
+            zoom: 12,
+            center: { lat: 6.9271, lng: 79.8612 }  // Default to Colombo
+        });
+
+        // Only buses inside the subscribed viewport are pushed to this client
+        this.onPositions = (data) => this.updateBuses(data.buses);
+        frappe.realtime.on('bus_positions', this.onPositions);
+
+        this.idleListener = this.map.addListener('idle', () => this.subscribeViewport());
+    }
+
+    async subscribeViewport() {
+        const bounds = this.map.getBounds();
+        if (!bounds) return;
+
+        const result = await frappe.call({
+            method: 'public_transport.public_transport.realtime.subscribe_viewport',
+            args: {
+                south: bounds.getSouthWest().lat(),
+                west: bounds.getSouthWest().lng(),
+                north: bounds.getNorthEast().lat(),
+                east: bounds.getNorthEast().lng(),
+                zoom: this.map.getZoom()
+            }
+        });
+
+        if (result.message) {
+            this.replaceBuses(result.message.buses);
+
+            // Renew before the server lets the subscription lapse
+            clearTimeout(this.renewTimer);
+            this.renewTimer = setTimeout(
+                () => this.subscribeViewport(),
+                result.message.renew_after * 1000
+            );
+        }
+    }
+
+    replaceBuses(buses) {
+        const visible = new Set(buses.map(bus => bus.bus));
+        this.markers.forEach((marker, busId) => {
+            if (!visible.has(busId)) {
+                marker.setMap(null);
+                this.markers.delete(busId);
+            }
+        });
+        this.updateBuses(buses);
+    }
+
+    updateBuses(buses) {
+        buses.forEach(bus => {
+            const position = { lat: parseFloat(bus.lat), lng: parseFloat(bus.lng) };
+            let marker = this.markers.get(bus.bus);
+
+            if (!marker) {
+                marker = new google.maps.Marker({
+                    map: this.map,
+                    title: bus.bus,
+                    icon: {
+                        url: '/assets/public_transport/images/bus-icon.svg',
+                        scaledSize: new google.maps.Size(24, 24)
+                    }
+                });
+                this.markers.set(bus.bus, marker);
+            }
+            marker.setPosition(position);
+        });
+    }
+
+    destroy() {
+        frappe.call({
+            method: 'public_transport.public_transport.realtime.unsubscribe_viewport'
+        });
+
+        frappe.realtime.off('bus_positions', this.onPositions);
+        google.maps.event.removeListener(this.idleListener);
+        clearTimeout(this.renewTimer);
+
+        this.markers.forEach(marker => marker.setMap(null));
+        this.markers.clear();
+    }
+};
@@ -1,7 +1,28 @@
 import frappe
 from frappe import _
-from frappe.utils import now_datetime
+from frappe.utils import now_datetime, cint
 import json
+from werkzeug.wrappers import Response
+from .utils.location_cache import get_latest_position
+from .utils.trip_resolver import active_trip
+from .utils.route_geometry import get_route_geometry
+from .utils.map_matching import match_to_route, get_cursor
+from .utils.deviation_detection import DEVIATION_THRESHOLD_KM
+from .utils.travel_time_model import predict_stop_arrivals
+from .utils.seat_map_cache import get_seat_snapshot
+from .utils.seat_reservations import extend_hold, HOLD_SECONDS
+from .doctype.booking.booking import SeatUnavailableError
+from .utils.waiting_room import (
+    waiting_room_enabled, join_queue, get_queue_status, verify_token, is_admitted, leave_queue
+)
+
+# Limits for guest stop searches
+MAX_STOP_SEARCH_RADIUS = 10  # km
+MAX_NEAREST_STOPS = 50
+
+# Limits for arrival boards
+MAX_BOARD_ARRIVALS = 50
+MAX_FEED_STOPS = 100
 
 @frappe.whitelist()
 def process_payment(booking_id, payment_details):
@@ -45,6 +66,32 @@ def update_gps_location(bus_id, latitude, longitude, timestamp=None):
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+@frappe.whitelist()
+def update_gps_locations(fixes):
+    """Handle batched GPS updates buffered by on-board units
+
+    `fixes` is a list of {"bus_id", "latitude", "longitude", "timestamp"}
+    objects for one or many buses, optionally carrying "speed" (km/h) and
+    "heading" (degrees).
+    """
+    try:
+        if isinstance(fixes, str):
+            fixes = json.loads(fixes)
+
+        if not isinstance(fixes, list):
+            frappe.throw(_("Fixes must be a list"))
+
+        from .utils.gps_tracking import record_location_batch
+        inserted, rejected = record_location_batch(fixes)
+
+        return {
+            "status": "success",
+            "inserted": inserted,
+            "rejected": rejected
+        }
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
 @frappe.whitelist()
 def generate_ticket(booking_id):
     """Generate ticket for printing"""
@@ -88,32 +135,79 @@ def send_notification(booking_id, notification_type):
         return {"status": "error", "message": str(e)}
 
 @frappe.whitelist(allow_guest=True)
-def get_seat_map(trip_id):
-    """Get seat map for a specific trip"""
+def get_seat_map(trip_id, since_version=None):
+    """Get seat map for a specific trip.
+
+    Returns the version, the layout and a status vector with one character
+    per seat (A, H, B or X). Clients holding a version can pass it as
+    since_version to get only [seat index, status] changes, or revalidate
+    with If-None-Match to get a 304 when nothing changed.
+    """
     try:
-        trip = frappe.get_doc("Bus Trip", trip_id)
-        if not trip.long_trip_limited_seat:
-            frappe.throw(_("This trip does not have a seat map"))
-            
-        seats = []
-        for seat in trip.seat_map_layout:
-            seats.append({
-                "seat_id": seat.seat_id,
-                "status": seat.status,
-                "price": seat.price,
-                "row": seat.row_identifier,
-                "column": seat.column_identifier,
-                "side": seat.side
-            })
-        
-        return seats
+        snapshot = get_seat_snapshot(trip_id, cint(since_version) if since_version else None)
+
+        etag = f'"{trip_id}:{snapshot.version}"'
+        if etag_matches(frappe.get_request_header("If-None-Match"), etag):
+            # Returned as is, so nothing is serialised into the body or overrides the status
+            response = Response(status=304)
+            response.headers["ETag"] = etag
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+
+        frappe.local.response_headers.set("ETag", etag)
+        frappe.local.response_headers.set("Cache-Control", "no-cache")
+        return snapshot
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header names etag, ignoring the weak prefix proxies add when compressing"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+@frappe.whitelist()
+def join_booking_queue(trip_id):
+    """Join a trip's waiting room, or keep the place already held.
+
+    Returns the queue token to pass to create_booking, with the status:
+    admitted, or waiting with the position and estimated wait in seconds.
+    """
+    try:
+        if not waiting_room_enabled():
+            return {"status": "admitted"}
+        return join_queue(trip_id, frappe.session.user)
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
 @frappe.whitelist()
-def create_booking(trip_id, seats):
-    """Create a new booking for selected seats"""
+def get_booking_queue_status(trip_id):
+    """Poll a trip's waiting room; waiting users must poll to keep their place"""
     try:
+        if not waiting_room_enabled():
+            return {"status": "admitted"}
+        return get_queue_status(trip_id, frappe.session.user)
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+@frappe.whitelist()
+def create_booking(trip_id, seats, queue_token=None):
+    """Create a new booking for selected seats.
+
+    Returns the status unavailable when a selected seat was taken or is
+    held by another booking, so clients can refresh the seat map.
+    """
+    try:
+        # Turn away bookers the waiting room has not admitted before any database work
+        if waiting_room_enabled():
+            user = frappe.session.user
+            if not verify_token(queue_token, trip_id, user):
+                return {"status": "error", "message": "Invalid or expired queue token. Please join the queue again."}
+            if not is_admitted(trip_id, user):
+                return {"status": "error", "message": "It is not your turn to book yet."}
+
         if isinstance(seats, str):
             seats = json.loads(seats)
             
@@ -133,11 +227,42 @@ def create_booking(trip_id, seats):
             booking.passenger_contact = user.mobile_no
             
         booking.insert()
+
+        if waiting_room_enabled():
+            leave_queue(trip_id, frappe.session.user)
         
         return {
             "status": "success",
             "booking_id": booking.name
         }
+    except SeatUnavailableError as e:
+        return {"status": "unavailable", "message": str(e)}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+@frappe.whitelist()
+def extend_booking_hold(booking_id):
+    """Keep a draft booking's seats held while the passenger completes payment.
+
+    Returns the status unavailable when a seat was taken after its hold
+    lapsed, so the passenger can pick seats again.
+    """
+    try:
+        booking = frappe.get_doc("Booking", booking_id)
+        if booking.owner != frappe.session.user:
+            booking.check_permission("write")
+        if booking.docstatus != 0:
+            return {"status": "error", "message": "Only draft bookings hold seats"}
+
+        lost = extend_hold(booking.bus_trip, [seat.seat_id for seat in booking.selected_seats], booking.name)
+        if lost:
+            return {
+                "status": "unavailable",
+                "message": "Seats {} are no longer held for this booking".format(", ".join(lost)),
+                "seats": list(lost)
+            }
+
+        return {"status": "success", "expires_in": HOLD_SECONDS}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
@@ -148,13 +273,7 @@ def get_bus_location(trip_id):
         trip = frappe.get_doc("Bus Trip", trip_id)
         
         # Get latest location for the bus
-        latest_location = frappe.get_all(
-            "GPS Location Log",
-            filters={"bus": trip.bus},
-            fields=["latitude", "longitude", "timestamp"],
-            order_by="timestamp desc",
-            limit=1
-        )
+        latest_location = get_latest_position(trip.bus)
         
         if not latest_location:
             return {
@@ -166,11 +285,11 @@ def get_bus_location(trip_id):
         eta = None
         if hasattr(trip, 'destination_coordinates'):
             from ..utils.gps_tracking import calculate_eta
-            eta = calculate_eta(latest_location[0], trip.destination_coordinates)
+            eta = calculate_eta(latest_location, trip.destination_coordinates)
             
         return {
             "status": "success",
-            "location": latest_location[0],
+            "location": latest_location,
             "eta": eta
         }
         
@@ -185,13 +304,7 @@ def get_trip_eta(trip_id):
     """Calculate and return ETA for a trip"""
     try:
         trip = frappe.get_doc("Bus Trip", trip_id)
-        latest_location = frappe.get_all(
-            "GPS Location Log",
-            filters={"bus": trip.bus},
-            fields=["latitude", "longitude", "timestamp"],
-            order_by="timestamp desc",
-            limit=1
-        )
+        latest_location = get_latest_position(trip.bus)
         
         if not latest_location:
             return {
@@ -199,29 +312,33 @@ def get_trip_eta(trip_id):
                 "message": "No location data available"
             }
             
-        from geopy.distance import geodesic
-        from datetime import timedelta
-        
-        # Parse destination coordinates
-        dest_coords = trip.destination_coordinates.split(',')
-        current_pos = (latest_location[0].latitude, latest_location[0].longitude)
-        destination = (float(dest_coords[0]), float(dest_coords[1]))
-        
-        # Calculate distance and estimated time
-        distance = geodesic(current_pos, destination).kilometers
-        avg_speed = 40  # assumed average speed in km/h
+        geometry = get_route_geometry(trip.route)
+        match = match_to_route(
+            geometry,
+            latest_location.latitude,
+            latest_location.longitude,
+            DEVIATION_THRESHOLD_KM,
+            cursor=get_cursor(trip.bus, geometry.route)
+        )
         
-        # Add traffic factor based on time of day
-        current_hour = frappe.utils.now_datetime().hour
-        if 7 <= current_hour <= 9 or 16 <= current_hour <= 19:  # Rush hours
-            avg_speed *= 0.7  # Reduce speed by 30% during rush hours
+        if not match:
+            return {
+                "status": "error",
+                "message": "Route has no stops to estimate against"
+            }
+            
+        # Sum the remaining segments' observed travel times
+        arrivals = predict_stop_arrivals(geometry, match.along)
+        late_arrivals = predict_stop_arrivals(geometry, match.along, quantile="p85")
         
-        travel_time = distance / avg_speed
-        eta = frappe.utils.now_datetime() + timedelta(hours=travel_time)
+        now = frappe.utils.now_datetime()
+        eta = arrivals[-1][1] if arrivals else now
+        distance = geometry.total_distance - match.along
         
         return {
             "status": "success",
             "eta": eta,
+            "eta_p85": late_arrivals[-1][1] if late_arrivals else now,
             "distance_remaining": round(distance, 2)
         }
         
@@ -236,17 +353,7 @@ def get_route_data(bus_id):
     """Get route and stop data for bus tracking"""
     try:
         # Get current trip for the bus
-        current_trip = frappe.get_all(
-            "Bus Trip",
-            filters={
-                "bus": bus_id,
-                "departure_time": ["<=", frappe.utils.now_datetime()],
-                "arrival_time": [">", frappe.utils.now_datetime()],
-                "docstatus": 1
-            },
-            fields=["name", "route"],
-            limit=1
-        )
+        current_trip = active_trip(bus_id)
         
         if not current_trip:
             return {
@@ -254,43 +361,57 @@ def get_route_data(bus_id):
                 "message": "No active trip found for this bus"
             }
             
-        route = frappe.get_doc("Route", current_trip[0].route)
+        geometry = get_route_geometry(current_trip.route)
+        stop_details = {
+            stop.name: stop for stop in frappe.get_all(
+                "Bus Stop",
+                filters={"name": ["in", geometry.stops]},
+                fields=["name", "stop_name", "address"]
+            )
+        } if geometry.stops else {}
+        
+        facilities = {}
+        for f in frappe.get_all(
+            "Stop Facility",
+            filters={"parent": ["in", geometry.stops], "parenttype": "Bus Stop"},
+            fields=["parent", "facility_type", "status"]
+        ) if geometry.stops else []:
+            facilities.setdefault(f.parent, []).append({
+                "facility_type": f.facility_type,
+                "status": f.status
+            })
+        
         stops = []
         coordinates = []
         
-        for stop_entry in route.stops:
-            stop = frappe.get_doc("Bus Stop", stop_entry.stop)
+        for i, stop_name in enumerate(geometry.stops):
+            latitude, longitude = float(geometry.latitudes[i]), float(geometry.longitudes[i])
             coordinates.append({
-                "lat": stop.latitude,
-                "lng": stop.longitude
+                "lat": latitude,
+                "lng": longitude
             })
             
+            stop = stop_details.get(stop_name, {})
             stops.append({
-                "name": stop.name,
-                "stop_name": stop.stop_name,
-                "latitude": stop.latitude,
-                "longitude": stop.longitude,
-                "address": stop.address,
-                "sequence": stop_entry.sequence,
-                "facilities": [
-                    {
-                        "facility_type": f.facility_type,
-                        "status": f.status
-                    } for f in stop.facilities
-                ] if stop.facilities else []
+                "name": stop_name,
+                "stop_name": stop.get("stop_name"),
+                "latitude": latitude,
+                "longitude": longitude,
+                "address": stop.get("address"),
+                "sequence": geometry.sequences[i],
+                "facilities": facilities.get(stop_name, [])
             })
         
         # Calculate ETAs for upcoming stops
-        current_location = get_bus_location(bus_id)
-        if current_location.get("status") == "success":
-            location = current_location["location"]
-            update_stop_etas(stops, location)
+        location = get_latest_position(bus_id)
+        if location and stops:
+            update_stop_etas(stops, location, geometry)
         
         return {
             "status": "success",
             "route": {
-                "name": route.name,
-                "route_number": route.route_number,
+                "name": geometry.route,
+                "route_number": frappe.db.get_value("Route", geometry.route, "route_number"),
                 "coordinates": coordinates
             },
             "stops": stops
@@ -302,37 +423,19 @@ def get_route_data(bus_id):
             "message": str(e)
         }
 
-def update_stop_etas(stops, current_location):
+def update_stop_etas(stops, current_location, geometry):
     """Calculate ETAs for each upcoming stop"""
-    from geopy.distance import geodesic
-    from datetime import timedelta
-    
-    current_pos = (current_location["latitude"], current_location["longitude"])
-    
-    # Find closest stop to determine which stops are upcoming
-    distances = [(i, geodesic(current_pos, (stop["latitude"], stop["longitude"])).kilometers)
-                for i, stop in enumerate(stops)]
-    closest_idx = min(distances, key=lambda x: x[1])[0]
+    match = match_to_route(
+        geometry,
+        current_location["latitude"],
+        current_location["longitude"],
+        DEVIATION_THRESHOLD_KM
+    )
+    if not match:
+        return
     
-    # Update ETAs for upcoming stops
-    avg_speed = 30  # km/h
-    cumulative_distance = 0
-    
-    for i in range(closest_idx, len(stops)):
-        if i > closest_idx:
-            # Calculate distance from previous stop
-            prev_pos = (stops[i-1]["latitude"], stops[i-1]["longitude"])
-            curr_pos = (stops[i]["latitude"], stops[i]["longitude"])
-            segment_distance = geodesic(prev_pos, curr_pos).kilometers
-            cumulative_distance += segment_distance
-        else:
-            # For first upcoming stop, use distance from current position
-            cumulative_distance = distances[i][1]
-        
-        # Calculate ETA
-        travel_time = (cumulative_distance / avg_speed) * 60  # minutes
-        eta = frappe.utils.now_datetime() + timedelta(minutes=travel_time)
-        stops[i]["eta"] = eta.strftime("%H:%M")
+    for index, arrival in predict_stop_arrivals(geometry, match.along):
+        stops[index]["eta"] = arrival.strftime("%H:%M")
 
 @frappe.whitelist()
 def toggle_alert_subscription(alert_id):
@@ -569,4 +672,77 @@ def send_test_notification(device_id: str) -> dict:
         return {
             "status": "error",
             "message": str(e)
-        }
\ No newline at end of file
+        }
+@frappe.whitelist(allow_guest=True)
+def stops_near(latitude, longitude, radius=None, k=None):
+    """Get active stops near a point, nearest first
+
+    Pass `radius` (km) for every stop within that distance, or `k` for the
+    k nearest stops. Defaults to the 5 nearest.
+    """
+    try:
+        from .utils.stop_index import get_stop_index
+        
+        latitude, longitude = float(latitude), float(longitude)
+        if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+            frappe.throw(_("Invalid coordinates"))
+        
+        index = get_stop_index()
+        if radius:
+            stops = index.within(latitude, longitude, min(float(radius), MAX_STOP_SEARCH_RADIUS))
+        else:
+            stops = index.nearest(latitude, longitude, k=max(1, min(int(k or 5), MAX_NEAREST_STOPS)))
+        
+        return {
+            "status": "success",
+            "stops": stops
+        }
+        
+    except Exception as e:
+        return {
+            "status": "error",
+            "message": str(e)
+        }
+
+@frappe.whitelist(allow_guest=True)
+def get_stop_arrivals(stop, limit=None):
+    """Get the next buses arriving at a stop, soonest first"""
+    try:
+        from .utils.arrival_board import get_stop_boards
+        
+        return {
+            "status": "success",
+            "stop": stop,
+            "arrivals": get_stop_boards([stop], min(int(limit or 10), MAX_BOARD_ARRIVALS))[stop]
+        }
+        
+    except Exception as e:
+        return {
+            "status": "error",
+            "message": str(e)
+        }
+
+@frappe.whitelist(allow_guest=True)
+def get_arrivals_feed(stops, limit=None):
+    """Get arrival boards for many stops in one call, for digital signage
+
+    `stops` is a list (or JSON list) of Bus Stop names.
+    """
+    try:
+        from .utils.arrival_board import get_stop_boards
+        
+        if isinstance(stops, str):
+            stops = json.loads(stops)
+        if len(stops) > MAX_FEED_STOPS:
+            frappe.throw(_("At most {0} stops per request").format(MAX_FEED_STOPS))
+        
+        return {
+            "status": "success",
+            "boards": get_stop_boards(list(dict.fromkeys(stops)), min(int(limit or 10), MAX_BOARD_ARRIVALS))
+        }
+        
+    except Exception as e:
+        return {
+            "status": "error",
+            "message": str(e)
+        }
@@ -0,0 +1,388 @@
+"""Load-test seat booking under contention and check that no seat is sold twice.
+
+Seeds BENCH- trips with seat maps and BENCH- passengers, then has many
+workers book random seats through api.create_booking (which runs
+Booking.validate_seats) and Booking.submit (Booking.on_submit), each in
+its own database connection. Workers have to commit for the others to
+see their bookings, so the seeded data is committed too and deleted
+again afterwards. Each run is appended to a JSON lines results file and
+compared with the previous run of the same workload. Run from the bench
+directory:
+
+    ../env/bin/python -m public_transport.public_transport.benchmarks.booking_benchmark --site mysite
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import frappe
+import public_transport
+from public_transport.public_transport import api
+from public_transport.public_transport.doctype.booking.booking import SeatUnavailableError
+from public_transport.public_transport.utils.seat_reservations import (
+    SEAT_LAYOUT_KEY, SEAT_DRIFT_KEY, HELD_TRIPS_KEY, seat_keys
+)
+from public_transport.public_transport.utils.waiting_room import (
+    waiting_room_enabled, join_queue, get_queue_status
+)
+
+SYSTEM_FIELDS = ["name", "creation", "modified", "owner", "modified_by", "docstatus"]
+
+# Seats per row, left of the aisle first
+SEAT_COLUMNS = [("A", "Left"), ("B", "Left"), ("C", "Right"), ("D", "Right")]
+
+# How often a worker waiting in the booking queue polls it
+QUEUE_POLL_SECONDS = 0.2
+
+# Distinct unexpected errors shown in the report
+MAX_REPORTED_ERRORS = 10
+
+def trip_names(trips):
+    return [f"BENCH-TRIP-{t:04d}" for t in range(trips)]
+
+def user_name(worker):
+    return f"bench-passenger-{worker:03d}@example.com"
+
+def make_layout(seats):
+    layout = []
+    for index in range(seats):
+        row = str(index // len(SEAT_COLUMNS) + 1)
+        column, side = SEAT_COLUMNS[index % len(SEAT_COLUMNS)]
+        layout.append({
+            "seat_id": f"{row}{column}",
+            "side": side,
+            "row_identifier": row,
+            "column_identifier": column,
+            "price": 1500
+        })
+    return layout
+
+def seed(trips, seats, workers):
+    """Insert BENCH- trips with seat maps and one BENCH- passenger per worker"""
+    now = frappe.utils.now_datetime()
+    draft = [now, now, "Administrator", "Administrator", 0]
+    submitted = [now, now, "Administrator", "Administrator", 1]
+    departure = frappe.utils.add_days(now, 1)
+    layout = make_layout(seats)
+
+    frappe.db.bulk_insert(
+        "Bus",
+        SYSTEM_FIELDS + ["internal_bus_id", "registration_plate", "capacity"],
+        [["BENCH-BUS"] + draft + ["BENCH-BUS", "BENCH-0000", seats]]
+    )
+
+    trip_rows, seat_rows = [], []
+    for trip in trip_names(trips):
+        trip_rows.append([trip] + submitted + [
+            trip, "BENCH-BUS", "BENCH", "Administrator", "Luxury", 1,
+            departure, frappe.utils.add_to_date(departure, hours=6), "Scheduled"
+        ])
+        for idx, seat in enumerate(layout, 1):
+            seat_rows.append([f"{trip}-{seat['seat_id']}"] + submitted + [
+                trip, "Bus Trip", "seat_map_layout", idx, seat["seat_id"], seat["side"],
+                seat["row_identifier"], seat["column_identifier"], "Available", seat["price"]
+            ])
+
+    frappe.db.bulk_insert(
+        "Bus Trip",
+        SYSTEM_FIELDS + [
+            "trip_id", "bus", "route", "bus_operator", "bus_type", "long_trip_limited_seat",
+            "departure_time", "arrival_time", "trip_status"
+        ],
+        trip_rows
+    )
+    frappe.db.bulk_insert(
+        "Seat Map",
+        SYSTEM_FIELDS + [
+            "parent", "parenttype", "parentfield", "idx", "seat_id", "side",
+            "row_identifier", "column_identifier", "status", "price"
+        ],
+        seat_rows
+    )
+
+    users = [user_name(worker) for worker in range(workers)]
+    frappe.db.bulk_insert(
+        "User",
+        SYSTEM_FIELDS + ["email", "first_name", "full_name", "mobile_no", "enabled", "user_type"],
+        [
+            [user] + draft + [user, f"Passenger {w}", f"Passenger {w}", f"+9470{w:07d}", 1, "Website User"]
+            for w, user in enumerate(users)
+        ]
+    )
+    frappe.db.bulk_insert(
+        "Has Role",
+        SYSTEM_FIELDS + ["parent", "parenttype", "parentfield", "idx", "role"],
+        [[f"{user}-role"] + draft + [user, "User", "roles", 1, "Regular User"] for user in users]
+    )
+    frappe.db.commit()
+    return layout
+
+def cleanup(trips, workers):
+    """Delete everything seed and the workers created, in the database and in Redis"""
+    trips = tuple(trip_names(trips))
+    users = tuple(user_name(worker) for worker in range(workers))
+    bookings = tuple(frappe.get_all("Booking", filters={"bus_trip": ["in", trips]}, pluck="name"))
+
+    if bookings:
+        frappe.db.sql("DELETE FROM `tabSeat Map` WHERE parenttype = 'Booking' AND parent IN %(names)s", {"names": bookings})
+        frappe.db.sql("DELETE FROM `tabPayment` WHERE booking IN %(names)s", {"names": bookings})
+        frappe.db.sql("DELETE FROM `tabVersion` WHERE ref_doctype = 'Booking' AND docname IN %(names)s", {"names": bookings})
+        frappe.db.sql("DELETE FROM `tabBooking` WHERE name IN %(names)s", {"names": bookings})
+    frappe.db.sql("DELETE FROM `tabSeat Map` WHERE parenttype = 'Bus Trip' AND parent IN %(names)s", {"names": trips})
+    frappe.db.sql("DELETE FROM `tabBus Trip` WHERE name IN %(names)s", {"names": trips})
+    frappe.db.sql("DELETE FROM `tabBus` WHERE name = 'BENCH-BUS'")
+    frappe.db.sql("DELETE FROM `tabHas Role` WHERE parent IN %(names)s", {"names": users})
+    frappe.db.sql("DELETE FROM `tabUser` WHERE name IN %(names)s", {"names": users})
+    frappe.db.commit()
+
+    pipe = frappe.cache().pipeline()
+    for trip in trips:
+        pipe.delete(*seat_keys(trip), SEAT_LAYOUT_KEY.format(trip), SEAT_DRIFT_KEY.format(trip))
+    pipe.zrem(HELD_TRIPS_KEY, *trips)
+    pipe.execute()
+
+def wait_for_admission(trip_id):
+    """Queue for a trip like the booking page does; returns the token and seconds waited"""
+    start = time.perf_counter()
+    status = join_queue(trip_id, frappe.session.user)
+    token = status.token
+    while status.status != "admitted":
+        time.sleep(QUEUE_POLL_SECONDS)
+        status = get_queue_status(trip_id, frappe.session.user)
+        if status.status == "not_queued":
+            status = join_queue(trip_id, frappe.session.user)
+            token = status.token
+    return token, time.perf_counter() - start
+
+def run_worker(site, worker, trips, layout, attempts, max_seats, seed):
+    """Book random seats as one passenger; returns the outcome and timings of every attempt.
+
+    Losing a seat to another worker is expected: it is rejected by
+    create_booking or lost at submit. Anything else is an error.
+    """
+    frappe.init(site=site)
+    frappe.connect()
+    rng = random.Random(seed * 1000 + worker)
+    user = user_name(worker)
+    queued = waiting_room_enabled()
+    results = {"attempts": [], "started": time.time()}
+
+    try:
+        for _ in range(attempts):
+            trip_id = rng.choice(trips)
+            seats = [dict(seat, status="Booked") for seat in rng.sample(layout, rng.randint(1, max_seats))]
+            attempt = {"seats": len(seats), "queue": 0.0, "create": None, "submit": None}
+
+            frappe.set_user(user)
+            token = None
+            if queued:
+                token, attempt["queue"] = wait_for_admission(trip_id)
+
+            start = time.perf_counter()
+            result = api.create_booking(trip_id, seats, queue_token=token)
+            attempt["create"] = time.perf_counter() - start
+            if result["status"] != "success":
+                frappe.db.rollback()
+                if result["status"] == "unavailable":
+                    attempt["outcome"] = "rejected"
+                else:
+                    attempt["outcome"] = "error"
+                    attempt["error"] = f"create_booking: {result.get('message')}"
+                results["attempts"].append(attempt)
+                continue
+            frappe.db.commit()
+
+            # Passengers cannot submit; payment does that as a privileged user
+            frappe.set_user("Administrator")
+            start = time.perf_counter()
+            try:
+                frappe.get_doc("Booking", result["booking_id"]).submit()
+                frappe.db.commit()
+                attempt["outcome"] = "booked"
+            except SeatUnavailableError:
+                frappe.db.rollback()
+                attempt["outcome"] = "lost at submit"
+            except Exception as e:
+                frappe.db.rollback()
+                attempt["outcome"] = "error"
+                attempt["error"] = f"submit: {type(e).__name__}: {e}"
+            attempt["submit"] = time.perf_counter() - start
+            results["attempts"].append(attempt)
+    finally:
+        results["finished"] = time.time()
+        frappe.destroy()
+
+    return results
+
+def find_double_bookings(trips):
+    """Seats of a trip that appear in more than one submitted booking"""
+    return frappe.db.sql("""
+        SELECT booking.bus_trip, seat.seat_id, COUNT(*)
+        FROM `tabSeat Map` seat
+        JOIN `tabBooking` booking ON booking.name = seat.parent AND seat.parenttype = 'Booking'
+        WHERE booking.docstatus = 1 AND booking.bus_trip IN %(trips)s
+        GROUP BY booking.bus_trip, seat.seat_id
+        HAVING COUNT(*) > 1
+    """, {"trips": tuple(trips)})
+
+def find_unbooked_seats(trips):
+    """Seats sold by a submitted booking that the trip's seat map does not show as Booked"""
+    return frappe.db.sql("""
+        SELECT booking.bus_trip, seat.seat_id
+        FROM `tabSeat Map` seat
+        JOIN `tabBooking` booking ON booking.name = seat.parent AND seat.parenttype = 'Booking'
+        LEFT JOIN `tabSeat Map` trip_seat ON trip_seat.parent = booking.bus_trip
+            AND trip_seat.parenttype = 'Bus Trip' AND trip_seat.seat_id = seat.seat_id
+        WHERE booking.docstatus = 1 AND booking.bus_trip IN %(trips)s
+            AND IFNULL(trip_seat.status, '') != 'Booked'
+    """, {"trips": tuple(trips)})
+
+def percentiles(values):
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(np.array(values) * 1000, [50, 95, 99])
+    return {"p50": round(p50, 2), "p95": round(p95, 2), "p99": round(p99, 2)}
+
+def summarize(worker_results):
+    attempts = [attempt for result in worker_results for attempt in result["attempts"]]
+    booked = [attempt for attempt in attempts if attempt["outcome"] == "booked"]
+    elapsed = max(r["finished"] for r in worker_results) - min(r["started"] for r in worker_results)
+
+    outcomes, errors = {}, {}
+    for attempt in attempts:
+        outcomes[attempt["outcome"]] = outcomes.get(attempt["outcome"], 0) + 1
+        if attempt.get("error"):
+            errors[attempt["error"]] = errors.get(attempt["error"], 0) + 1
+
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "attempts": len(attempts),
+        "outcomes": outcomes,
+        "booked": len(booked),
+        "errors": sum(errors.values()),
+        "error_messages": sorted(errors.items(), key=lambda item: -item[1])[:MAX_REPORTED_ERRORS],
+        "bookings_per_s": round(len(booked) / elapsed, 2) if elapsed else None,
+        "seats_booked": sum(attempt["seats"] for attempt in booked),
+        "latency_ms": {
+            "create_booking": percentiles([attempt["create"] for attempt in attempts]),
+            "submit": percentiles([attempt["submit"] for attempt in attempts if attempt["submit"] is not None]),
+            "booked": percentiles([attempt["create"] + attempt["submit"] for attempt in booked]),
+            "queue": percentiles([attempt["queue"] for attempt in attempts if attempt["queue"]]),
+        }
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def previous_run(path, params):
+    """The last recorded run of the same workload, if any"""
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path) as results:
+        for line in results:
+            record = json.loads(line)
+            if record.get("params") == params:
+                previous = record
+    return previous
+
+def report(record, previous):
+    summary = record["summary"]
+    print(f"{summary['attempts']} attempts in {summary['elapsed_s']}s: {summary['outcomes']}")
+    print(f"{'bookings/s':<24}{summary['bookings_per_s']:>10}", end="")
+    if previous and previous["summary"]["bookings_per_s"]:
+        change = summary["bookings_per_s"] / previous["summary"]["bookings_per_s"] - 1
+        print(f"  ({change:+.0%} vs {previous['revision'] or previous['timestamp']})", end="")
+    print()
+
+    print(f"{'latency (ms)':<24}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name, values in summary["latency_ms"].items():
+        if values:
+            print(f"{name:<24}{values['p50']:>10.1f}{values['p95']:>10.1f}{values['p99']:>10.1f}")
+
+    print(f"double-booked seats: {len(record['double_booked'])}, "
+          f"sold but not Booked on the trip: {len(record['unbooked'])}")
+
+    if summary["errors"]:
+        print(f"unexpected errors: {summary['errors']}")
+        for message, count in summary["error_messages"]:
+            print(f"{count:>6}  {message}")
+
+def run(site, trips=4, seats=40, workers=16, attempts=40, max_seats=3, processes=True,
+        results_path="booking_benchmark.jsonl", seed_value=0):
+    frappe.init(site=site)
+    frappe.connect()
+    params = {
+        "trips": trips, "seats": seats, "workers": workers, "attempts": attempts,
+        "max_seats": max_seats, "processes": processes, "seed": seed_value
+    }
+    try:
+        layout = seed(trips, seats, workers)
+        names = trip_names(trips)
+
+        if processes:
+            pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            pool = ThreadPoolExecutor(workers)
+        with pool:
+            futures = [
+                pool.submit(run_worker, site, worker, names, layout, attempts, max_seats, seed_value)
+                for worker in range(workers)
+            ]
+            worker_results = [future.result() for future in futures]
+
+        record = {
+            "timestamp": frappe.utils.now(),
+            "version": public_transport.__version__,
+            "revision": git_revision(),
+            "params": params,
+            "summary": summarize(worker_results),
+            "double_booked": [list(row) for row in find_double_bookings(names)],
+            "unbooked": [list(row) for row in find_unbooked_seats(names)],
+        }
+    finally:
+        cleanup(trips, workers)
+        frappe.destroy()
+
+    previous = previous_run(results_path, params)
+    with open(results_path, "a") as results:
+        results.write(json.dumps(record) + "\n")
+    report(record, previous)
+
+    if record["double_booked"] or record["unbooked"]:
+        raise AssertionError(
+            f"Seat safety violated: {record['double_booked']} double-booked, {record['unbooked']} not marked Booked"
+        )
+    # A run that books nothing or fails for other reasons proves nothing about seat safety
+    if record["summary"]["errors"]:
+        raise AssertionError(f"{record['summary']['errors']} booking attempts failed with unexpected errors")
+    if not record["summary"]["booked"]:
+        raise AssertionError("No booking was submitted")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--site", required=True)
+    parser.add_argument("--trips", type=int, default=4)
+    parser.add_argument("--seats", type=int, default=40)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--attempts", type=int, default=40, help="booking attempts per worker")
+    parser.add_argument("--max-seats", type=int, default=3, help="most seats in one booking")
+    parser.add_argument("--threads", action="store_true", help="run workers as threads instead of processes")
+    parser.add_argument("--results", default="booking_benchmark.jsonl")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(
+        args.site, args.trips, args.seats, args.workers, args.attempts, args.max_seats,
+        not args.threads, args.results, args.seed
+    )
@@ -0,0 +1,82 @@
+"""Compare the vectorized distance kernels against per-pair geopy geodesic calls.
+
+Run from the app directory (no site needed):
+
+    python -m public_transport.public_transport.benchmarks.geo_benchmark
+"""
+import argparse
+import time
+import numpy as np
+from geopy.distance import geodesic
+from public_transport.public_transport.utils import geo
+
+# Bounding box of Sri Lanka
+LAT_RANGE = (5.9, 9.9)
+LNG_RANGE = (79.6, 81.9)
+
+def make_network(stops, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(*LAT_RANGE, stops), rng.uniform(*LNG_RANGE, stops)
+
+def timed(fn, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def run(stops=10000, sources=20, repeat=3):
+    lats, lngs = make_network(stops)
+    origin = (lats[0], lngs[0])
+    source_lats, source_lngs = lats[:sources], lngs[:sources]
+
+    cases = {
+        "one-to-many": (
+            lambda: np.array([geodesic(origin, (lat, lng)).kilometers for lat, lng in zip(lats, lngs)]),
+            lambda: geo.haversine_one_to_many(origin[0], origin[1], lats, lngs),
+            lambda: geo.equirectangular_one_to_many(origin[0], origin[1], lats, lngs),
+        ),
+        "pairwise": (
+            lambda: np.array([
+                geodesic((lats[i], lngs[i]), (lats[i + 1], lngs[i + 1])).kilometers
+                for i in range(stops - 1)
+            ]),
+            lambda: geo.haversine_pairwise(lats, lngs),
+            lambda: geo.equirectangular_pairwise(lats, lngs),
+        ),
+        f"many-to-many ({sources}x{stops})": (
+            lambda: np.array([
+                [geodesic((slat, slng), (lat, lng)).kilometers for lat, lng in zip(lats, lngs)]
+                for slat, slng in zip(source_lats, source_lngs)
+            ]),
+            lambda: geo.haversine_matrix(source_lats, source_lngs, lats, lngs),
+            lambda: geo.equirectangular_matrix(source_lats, source_lngs, lats, lngs),
+        ),
+    }
+
+    print(f"{stops} stops, best of {repeat}")
+    print(f"{'case':<28}{'geodesic':>12}{'haversine':>12}{'speedup':>10}{'max err':>10}"
+          f"{'equirect':>12}{'speedup':>10}{'max err':>10}")
+
+    for name, (reference, haversine, equirectangular) in cases.items():
+        # The geodesic loop is slow enough that one run is representative
+        ref_time, expected = timed(reference, 1)
+        hav_time, hav = timed(haversine, repeat)
+        eq_time, eq = timed(equirectangular, repeat)
+
+        mask = expected > 0
+        hav_err = np.max(np.abs(hav[mask] - expected[mask]) / expected[mask])
+        eq_err = np.max(np.abs(eq[mask] - expected[mask]) / expected[mask])
+
+        print(f"{name:<28}{ref_time * 1000:>10.1f}ms{hav_time * 1000:>10.2f}ms{ref_time / hav_time:>9.0f}x"
+              f"{hav_err:>10.3%}{eq_time * 1000:>10.2f}ms{ref_time / eq_time:>9.0f}x{eq_err:>10.3%}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stops", type=int, default=10000)
+    parser.add_argument("--sources", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run(args.stops, args.sources, args.repeat)
@@ -0,0 +1,102 @@
+"""Compare per-route stop loading against the bulk active route loader.
+
+Seeds synthetic routes and stops into a site's database inside a
+transaction that is rolled back afterwards. Run from the bench directory:
+
+    ../env/bin/python -m public_transport.public_transport.benchmarks.route_loader_benchmark --site mysite
+"""
+import argparse
+import time
+import numpy as np
+import frappe
+from public_transport.public_transport.utils import route_geometry
+
+# Bounding box of Sri Lanka
+LAT_RANGE = (5.9, 9.9)
+LNG_RANGE = (79.6, 81.9)
+
+SYSTEM_FIELDS = ["name", "creation", "modified", "owner", "modified_by", "docstatus"]
+
+def seed(routes, stops_per_route, stops, seed=0):
+    """Insert BENCH- routes drawing their stops from a shared pool"""
+    rng = np.random.default_rng(seed)
+    now = frappe.utils.now_datetime()
+    system = [now, now, "Administrator", "Administrator", 0]
+
+    stop_names = [f"BENCH-STOP-{i:05d}" for i in range(stops)]
+    lats, lngs = rng.uniform(*LAT_RANGE, stops), rng.uniform(*LNG_RANGE, stops)
+    frappe.db.bulk_insert(
+        "Bus Stop",
+        SYSTEM_FIELDS + ["stop_name", "latitude", "longitude", "address", "is_active"],
+        [[name] + system + [name, float(lat), float(lng), "-", 1] for name, lat, lng in zip(stop_names, lats, lngs)]
+    )
+
+    route_rows, stop_rows = [], []
+    for r in range(routes):
+        route = f"BENCH-ROUTE-{r:05d}"
+        route_rows.append([route] + system + [route, str(r), "Urban", "Active"])
+        for idx, stop in enumerate(rng.choice(stop_names, stops_per_route, replace=False), 1):
+            stop_rows.append(
+                [f"{route}-{idx}"] + system
+                + [route, "Route", "stops", idx, stop, idx, 2]
+            )
+
+    frappe.db.bulk_insert(
+        "Route",
+        SYSTEM_FIELDS + ["route_name", "route_number", "route_type", "status"],
+        route_rows
+    )
+    frappe.db.bulk_insert(
+        "Route Stop",
+        SYSTEM_FIELDS + ["parent", "parenttype", "parentfield", "idx", "stop", "sequence", "estimated_time_from_previous"],
+        stop_rows
+    )
+
+def load_per_route():
+    """What check_weather_conditions did before the bulk loader"""
+    points = {}
+    for route in frappe.get_all("Route", filters={"status": "Active"}, fields=["name", "route_name"]):
+        stops = frappe.get_all("Route Stop", filters={"parent": route.name}, fields=["stop"])
+        if not stops:
+            continue
+        first_stop = frappe.get_doc("Bus Stop", stops[0].stop)
+        last_stop = frappe.get_doc("Bus Stop", stops[-1].stop)
+        points[route.name] = [
+            (first_stop.latitude, first_stop.longitude),
+            (last_stop.latitude, last_stop.longitude)
+        ]
+    return points
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+def run(site, routes=2000, stops_per_route=20, stops=5000):
+    frappe.init(site=site)
+    frappe.connect()
+    try:
+        seed(routes, stops_per_route, stops)
+
+        legacy_time, legacy = timed(load_per_route)
+        bulk_time, snapshot = timed(route_geometry.load_active_routes)
+        route_geometry._snapshot = None
+        route_geometry.get_active_routes()
+        cached_time, _ = timed(route_geometry.get_active_routes)
+
+        print(f"{len(snapshot)} active routes, {stops_per_route} stops each")
+        print(f"{'per-route queries':<24}{legacy_time * 1000:>10.1f}ms  ({len(legacy)} routes)")
+        print(f"{'bulk joined query':<24}{bulk_time * 1000:>10.1f}ms  {legacy_time / bulk_time:>6.0f}x")
+        print(f"{'cached snapshot':<24}{cached_time * 1000:>10.3f}ms")
+    finally:
+        frappe.db.rollback()
+        frappe.destroy()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--site", required=True)
+    parser.add_argument("--routes", type=int, default=2000)
+    parser.add_argument("--stops-per-route", type=int, default=20)
+    parser.add_argument("--stops", type=int, default=5000)
+    args = parser.parse_args()
+    run(args.site, args.routes, args.stops_per_route, args.stops)
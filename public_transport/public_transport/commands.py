@@ -52,16 +52,12 @@ def send_trip_reminders():
             frappe.log_error(f"Failed to send reminder for booking {booking.name}: {str(e)}")
 
 def cleanup_expired_seat_locks():
-    """Remove expired seat locks from cache"""
-    from public_transport.public_transport.utils.realtime_sync import release_seat_lock
-    
-    # Get all keys starting with seat_lock:
-    keys = frappe.cache().get_keys("seat_lock:*")
-    for key in keys:
-        if not frappe.cache().exists(key):
-            # Key has expired, extract trip and seat info
-            _, trip_id, seat_id = key.split(":")
-            release_seat_lock(trip_id, seat_id)
+    """Return the seats of expired holds to their trips, with one update per trip to clients"""
+    from public_transport.public_transport.utils.seat_reservations import release_expired_holds
+    from public_transport.public_transport.utils.realtime_sync import notify_seat_changes
+
+    for trip_id, seat_ids in release_expired_holds().items():
+        notify_seat_changes(trip_id, seat_ids, "Available")
 
 def cleanup_gps_logs():
     """Remove GPS logs older than 30 days"""
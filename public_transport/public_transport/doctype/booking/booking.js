@@ -1,5 +1,26 @@
 frappe.ui.form.on('Booking', {
     refresh: function(frm) {
+        if (frm.doc.docstatus === 0 && !frm.is_new()) {
+            frm.add_custom_button(__('Keep Seats'), function() {
+                frappe.call({
+                    method: 'public_transport.public_transport.api.extend_booking_hold',
+                    args: {
+                        booking_id: frm.doc.name
+                    },
+                    callback: function(r) {
+                        if (r.message && r.message.status === 'success') {
+                            frappe.show_alert({
+                                message: __('Seats held for another {0} minutes', [Math.round(r.message.expires_in / 60)]),
+                                indicator: 'green'
+                            });
+                        } else if (r.message && r.message.message) {
+                            frappe.msgprint(r.message.message);
+                        }
+                    }
+                });
+            });
+        }
+
         if (frm.doc.docstatus === 1 && frm.doc.booking_status === "Confirmed") {
             frm.add_custom_button(__('Print Ticket'), function() {
                 frappe.call({
@@ -1,26 +1,58 @@
 import frappe
 from frappe.model.document import Document
-from ..utils.realtime_sync import notify_seat_status_change, notify_booking_confirmation, lock_seat, release_seat_lock
+from ...utils.realtime_sync import notify_seat_changes, notify_booking_confirmation
+from ...utils.seat_reservations import (
+    hold_seats, confirm_seats, release_seats, free_seats, book_seat_rows, free_seat_rows, sync_trip_seats
+)
+from ...utils.sms_service import send_booking_confirmation
+
+class SeatUnavailableError(frappe.ValidationError):
+    """A selected seat is taken, held by another booking or not on the trip"""
 
 class Booking(Document):
     def validate(self):
         self.validate_seats()
+        self.set_booking_id()
         self.set_booking_time()
         self.validate_booking_agent()
 
     def validate_seats(self):
         if not self.selected_seats:
             frappe.throw("At least one seat must be selected")
-            
-        trip = frappe.get_doc("Bus Trip", self.bus_trip)
-        available_seats = {seat.seat_id: seat for seat in trip.seat_map_layout if seat.status == "Available"}
-        
-        for seat in self.selected_seats:
-            if seat.seat_id not in available_seats:
-                frappe.throw(f"Seat {seat.seat_id} is not available")
-            # Try to lock the seat during booking
-            if not lock_seat(self.bus_trip, seat.seat_id, frappe.session.user):
-                frappe.throw(f"Seat {seat.seat_id} is currently being booked by another user")
+
+        # Seats are booked by then and no longer change after submit
+        if self._action == "update_after_submit":
+            return
+
+        seat_ids = [seat.seat_id for seat in self.selected_seats]
+        if len(set(seat_ids)) != len(seat_ids):
+            frappe.throw("A seat can only be selected once")
+
+        # Hold every selected seat for this booking, or none of them
+        conflicts = hold_seats(self.bus_trip, seat_ids, self.name)
+        if conflicts:
+            messages = {
+                "unknown": "does not exist on this trip",
+                "booked": "is not available",
+                "blocked": "is not available",
+                "held": "is currently being booked by another user"
+            }
+            frappe.throw("<br>".join(
+                f"Seat {seat_id} {messages.get(reason, 'is not available')}"
+                for seat_id, reason in conflicts.items()
+            ), SeatUnavailableError)
+
+        # Seats dropped from a saved draft go back to other bookings
+        previous = self.get_doc_before_save()
+        if previous and previous.bus_trip == self.bus_trip:
+            dropped = {seat.seat_id for seat in previous.selected_seats} - set(seat_ids)
+            release_seats(self.bus_trip, dropped, self.name)
+        elif previous:
+            release_seats(previous.bus_trip, [seat.seat_id for seat in previous.selected_seats], self.name)
+
+    def set_booking_id(self):
+        if not self.booking_id:
+            self.booking_id = self.name
 
     def set_booking_time(self):
         if self.is_new():
@@ -31,24 +63,40 @@ class Booking(Document):
             frappe.throw("Booking Agent must be specified for bookings made by agents")
 
     def on_trash(self):
-        # Release any seat locks if booking is cancelled
-        for seat in self.selected_seats:
-            release_seat_lock(self.bus_trip, seat.seat_id)
+        # Release any seat holds if booking is deleted
+        release_seats(self.bus_trip, [seat.seat_id for seat in self.selected_seats], self.name)
 
     def on_submit(self):
-        # Update seat status in the trip
-        trip = frappe.get_doc("Bus Trip", self.bus_trip)
-        for seat in self.selected_seats:
-            for trip_seat in trip.seat_map_layout:
-                if trip_seat.seat_id == seat.seat_id:
-                    trip_seat.status = "Booked"
-                    notify_seat_status_change(self.bus_trip, seat.seat_id, "Booked")
-        trip.save()
+        seat_ids = [seat.seat_id for seat in self.selected_seats]
+
+        # Only rows still Available are flipped, so a short count means another booking won
+        if book_seat_rows(self.bus_trip, seat_ids) != len(seat_ids):
+            release_seats(self.bus_trip, seat_ids, self.name)
+            frappe.throw("Some of the selected seats have just been booked by someone else. Please select your seats again.", SeatUnavailableError)
+
+        if confirm_seats(self.bus_trip, seat_ids, self.name):
+            # The holds lapsed meanwhile; take the Booked rows written above
+            sync_trip_seats(self.bus_trip)
+        # Give the seats back if the submit does not make it to the database
+        frappe.db.after_rollback.add(lambda: free_seats(self.bus_trip, seat_ids))
+
+        notify_seat_changes(self.bus_trip, seat_ids, "Booked")
 
         # Create payment record
         if self.booking_status == "Confirmed":
             self.create_payment()
             notify_booking_confirmation(self.name)
+            send_booking_confirmation(self.name)
+
+    def on_cancel(self):
+        seat_ids = [seat.seat_id for seat in self.selected_seats]
+        free_seat_rows(self.bus_trip, seat_ids)
+
+        # Other bookings may only take the seats once their rows are Available in the database
+        frappe.db.after_commit.add(lambda: free_seats(self.bus_trip, seat_ids))
+        notify_seat_changes(self.bus_trip, seat_ids, "Available")
+
+        self.db_set("booking_status", "Cancelled")
 
     def create_payment(self):
         # Calculate total amount from selected seats
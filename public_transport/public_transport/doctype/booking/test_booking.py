@@ -0,0 +1,131 @@
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, add_to_date, now_datetime
+from .booking import Booking, SeatUnavailableError
+from ...api import extend_booking_hold
+from ...utils.seat_reservations import HELD_TRIPS_KEY, get_seat_states, hold_seats, seat_keys
+
+SEATS = ["1A", "1B", "1C"]
+
+def make_seat(seat_id, status):
+    return {
+        "seat_id": seat_id,
+        "side": "Left",
+        "row_identifier": seat_id[:-1],
+        "column_identifier": seat_id[-1],
+        "status": status,
+        "price": 1000
+    }
+
+def make_trip():
+    bus = frappe.get_doc({
+        "doctype": "Bus",
+        "internal_bus_id": "TEST-BUS",
+        "registration_plate": "TEST-BOOKING-0001",
+        "capacity": 40
+    }).insert()
+
+    departure = add_days(now_datetime(), 1)
+    return frappe.get_doc({
+        "doctype": "Bus Trip",
+        "trip_id": "TEST-BOOKING-TRIP",
+        "bus": bus.name,
+        "route": "Test Route",
+        "bus_operator": "Administrator",
+        "bus_type": "Luxury",
+        "long_trip_limited_seat": 1,
+        "departure_time": departure,
+        "arrival_time": add_to_date(departure, hours=6),
+        "seat_map_layout": [make_seat(seat_id, "Available") for seat_id in SEATS]
+    }).insert()
+
+def make_booking(trip, seat_ids):
+    return frappe.get_doc({
+        "doctype": "Booking",
+        "bus_trip": trip.name,
+        "selected_seats": [make_seat(seat_id, "Booked") for seat_id in seat_ids],
+        "passenger_name": "Test Passenger",
+        "passenger_contact": "+94700000000",
+        "user_role": "Regular User",
+        "payment_mode": "Cash",
+        "booking_status": "Pending"
+    })
+
+class TestBooking(FrappeTestCase):
+    def setUp(self):
+        self.trip = make_trip()
+
+    def tearDown(self):
+        frappe.db.rollback()
+        pipe = frappe.cache().pipeline()
+        pipe.delete(*seat_keys(self.trip.name))
+        pipe.zrem(HELD_TRIPS_KEY, self.trip.name)
+        pipe.execute()
+
+    def test_insert_holds_selected_seats(self):
+        booking = make_booking(self.trip, ["1A", "1B"])
+        booking.insert()
+
+        self.assertIsInstance(booking, Booking)
+        self.assertEqual(booking.booking_id, booking.name)
+        self.assertEqual(
+            get_seat_states(self.trip.name, SEATS),
+            {"1A": "Held", "1B": "Held", "1C": "Available"}
+        )
+
+    def test_seat_held_by_another_booking_is_rejected(self):
+        make_booking(self.trip, ["1A"]).insert()
+
+        with self.assertRaises(SeatUnavailableError):
+            make_booking(self.trip, ["1A", "1C"]).insert()
+
+        # All or nothing: the free seat of the rejected booking is not held either
+        self.assertEqual(get_seat_states(self.trip.name, ["1C"]), {"1C": "Available"})
+
+    def test_duplicate_seat_is_rejected(self):
+        with self.assertRaises(frappe.ValidationError):
+            make_booking(self.trip, ["1A", "1A"]).insert()
+
+    def test_submit_books_seats(self):
+        booking = make_booking(self.trip, ["1B"])
+        booking.insert()
+        booking.submit()
+
+        status = frappe.db.get_value(
+            "Seat Map", {"parent": self.trip.name, "parenttype": "Bus Trip", "seat_id": "1B"}, "status"
+        )
+        self.assertEqual(status, "Booked")
+        self.assertEqual(get_seat_states(self.trip.name, ["1B"]), {"1B": "Booked"})
+
+        with self.assertRaises(SeatUnavailableError):
+            make_booking(self.trip, ["1B"]).insert()
+
+    def test_extend_hold_keeps_seats_until_taken(self):
+        booking = make_booking(self.trip, ["1A"])
+        booking.insert()
+        self.assertEqual(extend_booking_hold(booking.name)["status"], "success")
+
+        # Let the hold lapse and another booking take the seat
+        hold_seats(self.trip.name, ["1A"], booking.name, seconds=-1)
+        make_booking(self.trip, ["1A"]).insert()
+
+        result = extend_booking_hold(booking.name)
+        self.assertEqual(result["status"], "unavailable")
+        self.assertEqual(result["seats"], ["1A"])
+
+    def test_cancel_frees_seats(self):
+        booking = make_booking(self.trip, ["1C"])
+        booking.insert()
+        booking.submit()
+        booking.cancel()
+        # What a commit would run, without committing the test's records
+        frappe.db.after_commit.run()
+
+        status = frappe.db.get_value(
+            "Seat Map", {"parent": self.trip.name, "parenttype": "Bus Trip", "seat_id": "1C"}, "status"
+        )
+        self.assertEqual(status, "Available")
+        self.assertEqual(get_seat_states(self.trip.name, ["1C"]), {"1C": "Available"})
+        self.assertEqual(booking.booking_status, "Cancelled")
+
+        make_booking(self.trip, ["1C"]).insert()
@@ -0,0 +1,20 @@
+import frappe
+from frappe.model.document import Document
+
+class BookingQueueSettings(Document):
+    def validate(self):
+        if not self.enable_waiting_room:
+            return
+
+        if (self.max_concurrent_bookers or 0) < 1:
+            frappe.throw("At least one concurrent booker per trip is required")
+
+        if (self.admission_seconds or 0) < 30:
+            frappe.throw("The admission window must be at least 30 seconds")
+
+        if (self.waiting_timeout or 0) < 10:
+            frappe.throw("The waiting timeout must be at least 10 seconds")
+
+def get_queue_settings():
+    """Cached Booking Queue Settings; the cache is cleared when they are saved"""
+    return frappe.get_cached_doc("Booking Queue Settings")
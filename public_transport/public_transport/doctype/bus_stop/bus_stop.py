@@ -1,5 +1,7 @@
 import frappe
 from frappe.model.document import Document
+from ...utils.route_geometry import invalidate_route_geometry
+from ...utils.stop_index import update_stop
 
 class BusStop(Document):
     def validate(self):
@@ -24,11 +26,22 @@ class BusStop(Document):
     
     def on_update(self):
         """Update all routes using this stop"""
+        # After commit, so a worker that reloads stops from the database sees this change
+        frappe.db.after_commit.add(
+            lambda: update_stop(self.name, self.latitude, self.longitude, self.stop_name, active=self.is_active)
+        )
+        
         routes = frappe.get_all(
             "Route Stop",
-            filters={"stop": self.name},
+            filters={"stop": self.name, "parenttype": "Route"},
             fields=["parent"]
         )
         
         for route in routes:
-            frappe.get_doc("Route", route.parent).save()
\ No newline at end of file
+            invalidate_route_geometry(route.parent)
+            frappe.get_doc("Route", route.parent).save()
+    
+    def on_trash(self):
+        frappe.db.after_commit.add(
+            lambda: update_stop(self.name, self.latitude, self.longitude, self.stop_name, active=False)
+        )
\ No newline at end of file
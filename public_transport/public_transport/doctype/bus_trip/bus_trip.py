@@ -1,11 +1,17 @@
 import frappe
 from frappe.model.document import Document
+from ...utils.trip_resolver import refresh_bus, get_trip_status
+from ...utils.arrival_board import remove_trip_arrivals
+from ...utils.seat_reservations import sync_trip_seats, free_seats
+from ...utils.seat_map_cache import invalidate_seat_layout
 
 class BusTrip(Document):
     def validate(self):
         self.validate_dates()
+        self.set_trip_status()
         if self.long_trip_limited_seat:
             self.validate_seat_map()
+            self.validate_booked_seats()
 
     def validate_dates(self):
         if self.departure_time >= self.arrival_time:
@@ -27,6 +33,73 @@ class BusTrip(Document):
         if len(self.seat_map_layout) > bus_doc.capacity:
             frappe.throw(f"Seat map exceeds bus capacity of {bus_doc.capacity}")
 
+    def validate_booked_seats(self):
+        """Keep a stale form from reopening seats that bookings took since it was loaded"""
+        if self.is_new():
+            return
+
+        reopened = [seat.seat_id for seat in self.seat_map_layout if seat.status == "Available"]
+        if not reopened:
+            return
+
+        booked = frappe.db.sql("""
+            SELECT seat.seat_id, booking.name
+            FROM `tabSeat Map` seat
+            JOIN `tabBooking` booking ON booking.name = seat.parent
+            WHERE seat.parenttype = 'Booking'
+                AND booking.bus_trip = %(trip)s
+                AND booking.docstatus = 1
+                AND seat.seat_id IN %(seats)s
+        """, {"trip": self.name, "seats": tuple(reopened)})
+
+        for seat_id, booking in booked:
+            frappe.throw(f"Seat {seat_id} is booked by {booking}. Reload the trip, or cancel the booking first.")
+
+    def set_trip_status(self):
+        """Materialize the trip status from its schedule"""
+        self.trip_status = get_trip_status(self.departure_time, self.arrival_time)
+
+    def on_update(self):
+        self.sync_seat_states()
+
+    def on_submit(self):
+        refresh_bus(self.bus)
+
+    def on_cancel(self):
+        self.db_set("trip_status", "Cancelled")
+        refresh_bus(self.bus)
+        remove_trip_arrivals(self)
+
+    def on_update_after_submit(self):
+        # The bus may have been reassigned, so refresh both indexes
+        previous = self.get_doc_before_save()
+        if previous and previous.bus != self.bus:
+            refresh_bus(previous.bus)
+            remove_trip_arrivals(previous)
+        refresh_bus(self.bus)
+        self.sync_seat_states()
+
+    def sync_seat_states(self):
+        """Push seat map edits to the seat reservation engine"""
+        if not self.long_trip_limited_seat:
+            return
+
+        sync_trip_seats(self.name, [(seat.seat_id, seat.status) for seat in self.seat_map_layout])
+        # Once committed, so a concurrent read cannot cache the old layout again
+        frappe.db.after_commit.add(lambda: invalidate_seat_layout(self.name))
+
+        # Seats set back to Available by hand, e.g. after a cancelled booking
+        previous = self.get_doc_before_save()
+        if previous:
+            was_taken = {seat.seat_id for seat in previous.seat_map_layout if seat.status != "Available"}
+            free_seats(self.name, [
+                seat.seat_id for seat in self.seat_map_layout
+                if seat.status == "Available" and seat.seat_id in was_taken
+            ])
+
+    def on_trash(self):
+        refresh_bus(self.bus)
+
 def has_permission(doc, ptype, user):
     """Custom permission check for Bus Trip"""
     if not user:
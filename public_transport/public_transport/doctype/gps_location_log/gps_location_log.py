@@ -10,15 +10,3 @@ class GPSLocationLog(Document):
             frappe.throw("Latitude must be between -90 and 90 degrees")
         if not -180 <= self.longitude <= 180:
             frappe.throw("Longitude must be between -180 and 180 degrees")
-            
-    def after_insert(self):
-        """Notify subscribed clients about location update"""
-        frappe.publish_realtime(
-            'gps_update',
-            {
-                'bus': self.bus,
-                'latitude': self.latitude,
-                'longitude': self.longitude,
-                'timestamp': str(self.timestamp)
-            }
-        )
\ No newline at end of file
@@ -0,0 +1,30 @@
+import frappe
+from frappe.model.document import Document
+
+class GPSTrackingSettings(Document):
+    def validate(self):
+        if self.deviation_mode == "Batch" and not 1 <= (self.evaluation_interval or 0) <= 60:
+            frappe.throw("Evaluation interval must be between 1 and 60 seconds")
+
+        if self.deviation_mode == "Batch" and (self.evaluator_processes or 0) < 1:
+            frappe.throw("At least one evaluator process is required")
+
+        if self.broadcast_interval and not 0.5 <= self.broadcast_interval <= 30:
+            frappe.throw("Broadcast interval must be between 0.5 and 30 seconds")
+
+def get_tracking_settings():
+    """Cached GPS Tracking Settings; the cache is cleared when they are saved"""
+    return frappe.get_cached_doc("GPS Tracking Settings")
+
+def read_tracking_settings():
+    """GPS Tracking Settings from the database, for long-running loops.
+
+    A process that never finishes a request keeps the first copy
+    get_cached_doc returns, so loops read the settings afresh each cycle.
+    The caller must end its transaction first to see changes committed
+    since.
+    """
+    return frappe.db.get_singles_dict("GPS Tracking Settings", cast=True)
+
+def batch_deviation_mode():
+    return get_tracking_settings().deviation_mode == "Batch"
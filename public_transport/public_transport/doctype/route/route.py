@@ -1,6 +1,8 @@
 import frappe
 from frappe.model.document import Document
-from geopy.distance import geodesic
+from ...utils.geo import haversine_pairwise, distance_km
+from ...utils.route_geometry import invalidate_route_geometry, get_stop_coordinates
+from ...utils.travel_time_model import get_travel_time_table
 
 class Route(Document):
     def validate(self):
@@ -35,25 +37,29 @@ class Route(Document):
         total_distance = 0
         total_time = 0
         
+        # Distances between consecutive stops in one vectorized pass
+        coordinates = get_stop_coordinates([stop.stop for stop in self.stops])
+        points = [coordinates[stop.stop] for stop in self.stops]
+        distances = haversine_pairwise([p[0] for p in points], [p[1] for p in points])
+        travel_times = get_travel_time_table(self.name)
+        
         for i in range(len(self.stops) - 1):
-            current_stop = frappe.get_doc("Bus Stop", self.stops[i].stop)
-            next_stop = frappe.get_doc("Bus Stop", self.stops[i + 1].stop)
-            
-            # Calculate distance between stops
-            distance = geodesic(
-                (current_stop.latitude, current_stop.longitude),
-                (next_stop.latitude, next_stop.longitude)
-            ).kilometers
+            distance = float(distances[i])
             
             self.stops[i].distance_from_previous = distance if i > 0 else 0
             total_distance += distance
             
-            # Estimate time based on route type and distance
-            speed = self.get_average_speed()
-            time_minutes = (distance / speed) * 60
-            
-            # Add stop time
-            time_minutes += self.get_stop_time()
+            observed = travel_times.typical(self.stops[i].stop, self.stops[i + 1].stop)
+            if observed is not None:
+                # Observed stop-to-stop times already include dwell time
+                time_minutes = observed / 60
+            else:
+                # Estimate time based on route type and distance
+                speed = self.get_average_speed()
+                time_minutes = (distance / speed) * 60
+                
+                # Add stop time
+                time_minutes += self.get_stop_time()
             
             self.stops[i].estimated_time_from_previous = round(time_minutes)
             total_time += time_minutes
@@ -63,13 +69,7 @@ class Route(Document):
         
         # For circular routes, add return to start
         if self.is_circular:
-            first_stop = frappe.get_doc("Bus Stop", self.stops[0].stop)
-            last_stop = frappe.get_doc("Bus Stop", self.stops[-1].stop)
-            
-            return_distance = geodesic(
-                (last_stop.latitude, last_stop.longitude),
-                (first_stop.latitude, first_stop.longitude)
-            ).kilometers
+            return_distance = distance_km(points[-1], points[0])
             
             self.distance += return_distance
             self.estimated_time += round((return_distance / self.get_average_speed()) * 60)
@@ -96,6 +96,8 @@ class Route(Document):
     
     def on_update(self):
         """Update all bus trips using this route"""
+        invalidate_route_geometry(self.name)
+        
         trips = frappe.get_all(
             "Bus Trip",
             filters={"route": self.route_number},
@@ -109,4 +111,7 @@ class Route(Document):
                     continue
                 trip_doc.save()
             except Exception as e:
-                frappe.log_error(f"Failed to update trip {trip.name}: {str(e)}")
\ No newline at end of file
+                frappe.log_error(f"Failed to update trip {trip.name}: {str(e)}")
+    
+    def on_trash(self):
+        invalidate_route_geometry(self.name)
\ No newline at end of file
@@ -1,7 +1,8 @@
 import frappe
 from frappe.model.document import Document
 from datetime import datetime
-from geopy.distance import geodesic
+from ...utils.geo import haversine_pairwise
+from ...utils.route_geometry import get_stop_coordinates
 
 class RouteDeviation(Document):
     def validate(self):
@@ -13,7 +14,10 @@ class RouteDeviation(Document):
         if self.end_time <= self.start_time:
             frappe.throw("End time must be after start time")
             
-        if self.start_time < frappe.utils.now_datetime():
+        # Deviations detected from GPS start "now", so allow a minute of slack;
+        # saves after insert (e.g. notify_affected_parties) are not re-checked
+        earliest = frappe.utils.add_to_date(frappe.utils.now_datetime(), minutes=-1)
+        if self.is_new() and frappe.utils.get_datetime(self.start_time) < earliest:
             frappe.throw("Start time cannot be in the past")
     
     def validate_stops(self):
@@ -33,14 +37,12 @@ class RouteDeviation(Document):
         total_distance = 0
         total_time = 0
         
+        coordinates = get_stop_coordinates([stop.stop for stop in self.alternate_stops])
+        points = [coordinates[stop.stop] for stop in self.alternate_stops]
+        distances = haversine_pairwise([p[0] for p in points], [p[1] for p in points])
+        
         for i in range(len(self.alternate_stops) - 1):
-            current = frappe.get_doc("Bus Stop", self.alternate_stops[i].stop)
-            next_stop = frappe.get_doc("Bus Stop", self.alternate_stops[i + 1].stop)
-            
-            distance = geodesic(
-                (current.latitude, current.longitude),
-                (next_stop.latitude, next_stop.longitude)
-            ).kilometers
+            distance = float(distances[i])
             
             self.alternate_stops[i].distance_from_previous = distance if i > 0 else 0
             total_distance += distance
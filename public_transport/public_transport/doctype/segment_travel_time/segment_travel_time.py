@@ -0,0 +1,10 @@
+import frappe
+from frappe.model.document import Document
+
+class SegmentTravelTime(Document):
+    def validate(self):
+        if not 0 <= self.weekday <= 6:
+            frappe.throw("Weekday must be between 0 (Monday) and 6 (Sunday)")
+            
+        if not 0 <= self.hour <= 23:
+            frappe.throw("Hour must be between 0 and 23")
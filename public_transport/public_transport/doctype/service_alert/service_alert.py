@@ -1,6 +1,6 @@
 import frappe
 from frappe.model.document import Document
-from frappe.utils import now_datetime
+from frappe.utils import now_datetime, add_to_date, get_datetime
 from .notification_manager import ServiceAlertNotificationManager
 
 class ServiceAlert(Document):
@@ -12,7 +12,9 @@ class ServiceAlert(Document):
         if self.end_time <= self.start_time:
             frappe.throw("End time must be after start time")
         
-        if self.start_time < now_datetime() and self.is_new():
+        # Generated alerts start "now", so allow a minute of slack
+        earliest = add_to_date(now_datetime(), minutes=-1)
+        if self.is_new() and get_datetime(self.start_time) < earliest:
             frappe.throw("Start time cannot be in the past for new alerts")
     
     def validate_affected_routes(self):
@@ -18,6 +18,15 @@ class WeatherAPISettings(Document):
             
         if self.default_duration <= 0:
             frappe.throw("Alert duration must be positive")
+            
+        if self.cache_ttl <= 0:
+            frappe.throw("Cache duration must be positive")
+            
+        if not 1 <= self.geohash_precision <= 8:
+            frappe.throw("Geohash precision must be between 1 and 8")
+            
+        if self.request_timeout <= 0 or self.max_concurrent_requests <= 0:
+            frappe.throw("Request timeout and concurrency must be positive")
     
     def test_api_connection(self):
         """Test connection to weather API"""
@@ -1,7 +1,10 @@
 import frappe
-from frappe.realtime import get_redis_server
-from frappe.utils import now_datetime
+from frappe.utils import now_datetime, flt, cint
 import json
+from .utils.position_broadcaster import queue_position, get_last_position
+from .utils.location_cache import get_latest_positions
+from .utils.subscriber_registry import add_follower, remove_follower, get_followers, expire_followers, SUBSCRIPTION_TTL
+from .utils.viewport_grid import viewport_tiles, set_viewport, clear_viewport, VIEWPORT_TTL
 
 def handle_gps_update(data):
     """Handle real-time GPS updates from devices"""
@@ -19,74 +22,76 @@ def handle_gps_update(data):
             'longitude': data['longitude'],
             'timestamp': data.get('timestamp') or now_datetime()
         })
+        # Subscribed clients are notified from the GPS Location Log after_insert hook
         log_entry.insert()
 
-        # Notify subscribed clients
-        notify_tracking_clients(data['bus_id'], {
-            'location': {
-                'lat': data['latitude'],
-                'lng': data['longitude'],
-                'timestamp': str(log_entry.timestamp)
-            }
-        })
-
         return {'status': 'success'}
     except Exception as e:
         frappe.log_error(f"GPS Update Failed: {str(e)}")
         return {'status': 'error', 'message': str(e)}
 
-def notify_tracking_clients(bus_id, data):
-    """Notify clients tracking specific bus"""
-    frappe.publish_realtime(
-        f'bus_location_{bus_id}',
-        data,
-        after_commit=True
+def notify_tracking_clients(bus_id, latitude, longitude, timestamp, speed=None, heading=None, deviation=None):
+    """Queue a bus's position for the throttled broadcaster; only the newest per bus is sent"""
+    queue_position(bus_id, latitude, longitude, timestamp, speed=speed, heading=heading, deviation=deviation)
+
+@frappe.whitelist()
+def subscribe_to_bus(bus_id):
+    """Subscribe the current user to bus location updates.
+
+    Clients call this again every renew_after seconds as a heartbeat;
+    subscriptions without one lapse after SUBSCRIPTION_TTL seconds. The
+    bus's full latest position comes back, since updates are deltas.
+    """
+    add_follower(bus_id, frappe.session.user)
+    return {"renew_after": SUBSCRIPTION_TTL // 3, "position": get_last_position(bus_id)}
+
+@frappe.whitelist()
+def unsubscribe_from_bus(bus_id):
+    """Unsubscribe the current user from bus location updates"""
+    remove_follower(bus_id, frappe.session.user)
+
+@frappe.whitelist()
+def subscribe_viewport(south, west, north, east, zoom=None):
+    """Receive bus_positions events for the buses inside a map viewport.
+
+    The viewport is mapped onto grid tiles and must be renewed within
+    VIEWPORT_TTL seconds. Returns the buses currently inside it so the
+    map can be drawn before the next broadcast.
+    """
+    south, west, north, east = flt(south), flt(west), flt(north), flt(east)
+    if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+        frappe.throw("Invalid viewport bounds")
+
+    set_viewport(frappe.session.user, viewport_tiles(south, west, north, east, cint(zoom) if zoom else None))
+
+    buses = frappe.get_all(
+        "Bus Trip",
+        filters={"trip_status": "Running", "docstatus": 1},
+        pluck="bus"
     )
+    buses_in_view = [
+        {
+            "bus": bus,
+            "lat": position.latitude,
+            "lng": position.longitude,
+            "ts": str(position.timestamp),
+            "hdg": position.heading
+        }
+        for bus, position in get_latest_positions(buses).items()
+        if south <= position.latitude <= north and west <= position.longitude <= east
+    ]
 
-def subscribe_to_bus(bus_id, user=None):
-    """Subscribe user to bus location updates"""
-    if not user:
-        user = frappe.session.user
-    
-    redis = get_redis_server()
-    key = f'bus_tracking:{bus_id}:subscribers'
-    redis.sadd(key, user)
+    return {"buses": buses_in_view, "renew_after": VIEWPORT_TTL // 2}
 
-def unsubscribe_from_bus(bus_id, user=None):
-    """Unsubscribe user from bus location updates"""
-    if not user:
-        user = frappe.session.user
-        
-    redis = get_redis_server()
-    key = f'bus_tracking:{bus_id}:subscribers'
-    redis.srem(key, user)
+@frappe.whitelist()
+def unsubscribe_viewport():
+    """Stop receiving bus_positions events"""
+    clear_viewport(frappe.session.user)
 
 def get_active_subscribers(bus_id):
     """Get list of users tracking a bus"""
-    redis = get_redis_server()
-    key = f'bus_tracking:{bus_id}:subscribers'
-    return list(redis.smembers(key))
+    return get_followers([bus_id]).get(bus_id, [])
 
 def cleanup_subscriptions():
-    """Remove stale subscriptions"""
-    redis = get_redis_server()
-    pattern = 'bus_tracking:*:subscribers'
-    keys = redis.keys(pattern)
-    
-    for key in keys:
-        bus_id = key.split(':')[1]
-        # Check if bus has any active trips
-        active_trips = frappe.get_all(
-            'Bus Trip',
-            filters={
-                'bus': bus_id,
-                'departure_time': ['<=', now_datetime()],
-                'arrival_time': ['>', now_datetime()],
-                'docstatus': 1
-            },
-            limit=1
-        )
-        
-        if not active_trips:
-            # No active trips, remove all subscribers
-            redis.delete(key)
\ No newline at end of file
+    """Remove subscriptions whose heartbeat lapsed"""
+    expire_followers()
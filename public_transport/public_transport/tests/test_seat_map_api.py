@@ -0,0 +1,57 @@
+import frappe
+from frappe.tests.test_api import FrappeAPITestCase
+from ..api import etag_matches
+from ..doctype.booking.test_booking import make_trip
+from ..utils.seat_map_cache import invalidate_seat_layout
+from ..utils.seat_reservations import seat_keys
+
+SEAT_MAP_PATH = "/api/method/public_transport.public_transport.api.get_seat_map"
+
+class TestSeatMapAPI(FrappeAPITestCase):
+    def setUp(self):
+        # Requests run on their own connection, so the trip has to be committed
+        self.trip = make_trip()
+        frappe.db.commit()
+
+    def tearDown(self):
+        frappe.delete_doc("Bus Trip", self.trip.name, force=True)
+        frappe.delete_doc("Bus", self.trip.bus, force=True)
+        frappe.db.commit()
+
+        invalidate_seat_layout(self.trip.name)
+        pipe = frappe.cache().pipeline()
+        pipe.delete(*seat_keys(self.trip.name))
+        pipe.execute()
+
+    def get_seat_map(self, **headers):
+        return self.get(
+            SEAT_MAP_PATH,
+            {"trip_id": self.trip.name},
+            headers={"X-Frappe-Site-Name": frappe.local.site, **headers}
+        )
+
+    def test_unchanged_seat_map_is_not_modified(self):
+        response = self.get_seat_map()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["message"]["status"], "AAA")
+
+        etag = response.headers["ETag"]
+        response = self.get_seat_map(**{"If-None-Match": etag})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+        self.assertEqual(response.headers["ETag"], etag)
+
+    def test_stale_etag_gets_the_seat_map(self):
+        response = self.get_seat_map(**{"If-None-Match": f'"{self.trip.name}:0"'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["message"]["status"], "AAA")
+
+    def test_etag_matches(self):
+        self.assertTrue(etag_matches('"T1:4"', '"T1:4"'))
+        self.assertTrue(etag_matches('W/"T1:4"', '"T1:4"'))
+        self.assertTrue(etag_matches('"T1:3", W/"T1:4"', '"T1:4"'))
+        self.assertTrue(etag_matches("*", '"T1:4"'))
+        self.assertFalse(etag_matches('"T1:3"', '"T1:4"'))
+        self.assertFalse(etag_matches(None, '"T1:4"'))
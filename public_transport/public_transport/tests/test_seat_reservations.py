@@ -0,0 +1,43 @@
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from ..doctype.booking.test_booking import make_trip
+from ..utils.seat_reservations import (
+    HELD_TRIPS_KEY, SEAT_DRIFT_KEY, get_seat_counts, get_seat_states, hold_seats, confirm_seats,
+    reconcile_seat_counts, seat_keys
+)
+
+class TestSeatReconciliation(FrappeTestCase):
+    def setUp(self):
+        # Only submitted trips are reconciled
+        self.trip = make_trip()
+        self.trip.submit()
+
+    def tearDown(self):
+        frappe.db.rollback()
+        pipe = frappe.cache().pipeline()
+        pipe.delete(*seat_keys(self.trip.name), SEAT_DRIFT_KEY.format(self.trip.name))
+        pipe.zrem(HELD_TRIPS_KEY, self.trip.name)
+        pipe.execute()
+
+    def test_booked_seat_never_committed_is_freed_on_second_run(self):
+        # A worker confirmed 1A and died before writing the Seat Map row
+        hold_seats(self.trip.name, ["1A"], "BOOKING-1")
+        confirm_seats(self.trip.name, ["1A"], "BOOKING-1")
+
+        # The first run may be looking at a submit that has not committed yet
+        self.assertNotIn(self.trip.name, reconcile_seat_counts())
+        self.assertEqual(get_seat_states(self.trip.name, ["1A"]), {"1A": "Booked"})
+
+        self.assertEqual(reconcile_seat_counts().get(self.trip.name), {"Available": ["1A"]})
+        self.assertEqual(get_seat_states(self.trip.name, ["1A"]), {"1A": "Available"})
+        self.assertEqual(get_seat_counts([self.trip.name])[self.trip.name].available, 3)
+
+    def test_booked_row_wins_over_hold(self):
+        hold_seats(self.trip.name, ["1B"], "BOOKING-1")
+        frappe.db.set_value(
+            "Seat Map", {"parent": self.trip.name, "parenttype": "Bus Trip", "seat_id": "1B"}, "status", "Booked"
+        )
+
+        self.assertEqual(reconcile_seat_counts().get(self.trip.name), {"Booked": ["1B"]})
+        self.assertEqual(get_seat_states(self.trip.name, ["1B"]), {"1B": "Booked"})
+        self.assertEqual(frappe.cache().zscore(HELD_TRIPS_KEY, self.trip.name), None)
@@ -0,0 +1,86 @@
+import time
+import frappe
+from frappe.utils import get_datetime
+
+# Active alert per fingerprint, "pending" while the alert is being created
+FINGERPRINT_KEY = "alert_fingerprint:{}"
+
+# How long a claim waits for the alert to be created before it lapses
+CLAIM_SECONDS = 60
+
+SEVERITY_BANDS = {
+    "Low": "minor",
+    "Medium": "minor",
+    "High": "major",
+    "Critical": "major"
+}
+
+def alert_fingerprint(alert_type, route, severity, bucket):
+    return f"{alert_type}|{route}|{SEVERITY_BANDS.get(severity, severity)}|{bucket}"
+
+def raise_alert(alert, route, bucket_hours):
+    """Insert and submit an auto-generated Service Alert, or extend the equivalent active one.
+
+    Alerts are fingerprinted by (type, route, severity band, time bucket of
+    bucket_hours). While a condition persists, the alert with the same
+    fingerprint in the current or previous bucket has its end_time moved
+    out instead of a new alert being submitted and fanned out again.
+    Returns (alert name, created).
+    """
+    bucket = int(time.time() // (bucket_hours * 3600))
+    ttl = int(bucket_hours * 3600 * 2)
+    current = FINGERPRINT_KEY.format(alert_fingerprint(alert["alert_type"], route, alert["severity"], bucket))
+    previous = FINGERPRINT_KEY.format(alert_fingerprint(alert["alert_type"], route, alert["severity"], bucket - 1))
+
+    pipe = frappe.cache().pipeline()
+    pipe.set(current, "pending", nx=True, ex=CLAIM_SECONDS)
+    pipe.get(current)
+    pipe.get(previous)
+    claimed, existing, carried = (
+        v.decode() if isinstance(v, bytes) else v
+        for v in pipe.execute()
+    )
+
+    if not claimed:
+        # Another worker is creating this alert right now
+        if existing == "pending":
+            return None, False
+        if extend_alert(existing, alert["end_time"]):
+            return existing, False
+    elif carried and carried != "pending" and extend_alert(carried, alert["end_time"]):
+        # The condition outlasted its bucket; carry the alert into this one
+        remember(current, carried, ttl)
+        return carried, False
+
+    doc = frappe.get_doc(alert)
+    try:
+        doc.insert()
+        doc.submit()
+    except Exception:
+        pipe = frappe.cache().pipeline()
+        pipe.delete(current)
+        pipe.execute()
+        raise
+
+    remember(current, doc.name, ttl)
+    return doc.name, True
+
+def extend_alert(name, end_time):
+    """Move an active alert's end_time out; False when it is no longer active"""
+    if not name:
+        return False
+
+    alert = frappe.db.get_value("Service Alert", name, ["status", "end_time", "docstatus"], as_dict=True)
+    if not alert or alert.status != "Active" or alert.docstatus != 1:
+        return False
+
+    if get_datetime(end_time) > alert.end_time:
+        frappe.db.set_value("Service Alert", name, "end_time", end_time, update_modified=False)
+        frappe.get_doc("Service Alert", name).publish_realtime_update(update_type="update")
+
+    return True
+
+def remember(key, name, ttl):
+    pipe = frappe.cache().pipeline()
+    pipe.set(key, name, ex=ttl)
+    pipe.execute()
@@ -1,28 +1,15 @@
 import frappe
 from frappe.utils import now_datetime, add_to_date
-import requests
-from geopy.distance import geodesic
+from .weather_cache import get_weather_observations
+from .route_geometry import get_active_routes
+from .speed_stats import get_speed_stats, clear_speed_stats
+from .alert_fingerprints import raise_alert
 
+# Speed statistics older than this (seconds) are ignored by the traffic check
+SPEED_STATS_MAX_AGE = 600
 
-def get_weather_data(api_key, coordinates):
-    """Get weather data for given coordinates"""
-    weather_data = []
-    
-    for lat, lon in coordinates:
-        response = requests.get(
-            f"https://api.openweathermap.org/data/2.5/weather",
-            params={
-                "lat": lat,
-                "lon": lon,
-                "appid": api_key,
-                "units": "metric"
-            }
-        )
-        
-        if response.status_code == 200:
-            weather_data.append(response.json())
-            
-    return weather_data
+# A bus standing still longer than this (seconds) is laying over or broken down, not in traffic
+LAYOVER_SECONDS = 900
 
 
 def check_weather_conditions():
@@ -33,36 +20,32 @@ def check_weather_conditions():
         if not settings.enabled:
             return
             
-        # Get active routes
-        routes = frappe.get_all(
-            "Route",
-            filters={"status": "Active"},
-            fields=["name", "route_name"]
+        # Active routes with their stops in sequence, from the shared snapshot
+        routes = [geometry for geometry in get_active_routes().values() if geometry.stops]
+        
+        # Weather is checked at the first and last stop of each route
+        route_points = {
+            route.route: [
+                (float(route.latitudes[0]), float(route.longitudes[0])),
+                (float(route.latitudes[-1]), float(route.longitudes[-1]))
+            ]
+            for route in routes
+        }
+        
+        # One lookup per geohash cell across every route, cached and fetched concurrently
+        observations = get_weather_observations(
+            settings,
+            {point for points in route_points.values() for point in points}
         )
         
         for route in routes:
-            # Get route stops for weather checking
-            stops = frappe.get_all(
-                "Route Stop",
-                filters={"parent": route.name},
-                fields=["stop"]
-            )
-            
-            if not stops:
-                continue
-                
-            # Check weather at first and last stop
-            first_stop = frappe.get_doc("Bus Stop", stops[0].stop)
-            last_stop = frappe.get_doc("Bus Stop", stops[-1].stop)
-            
-            weather_data = get_weather_data(
-                settings.api_key,
-                [(first_stop.latitude, first_stop.longitude),
-                 (last_stop.latitude, last_stop.longitude)]
-            )
+            weather_data = [observations[point] for point in route_points[route.route] if observations[point]]
             
             if should_create_weather_alert(weather_data):
-                create_weather_alert(route, weather_data)
+                create_weather_alert(
+                    frappe._dict({"name": route.route, "route_name": route.route_name}),
+                    weather_data
+                )
     except Exception as e:
         frappe.log_error(f"Error checking weather conditions: {str(e)}", "Weather Alert Error")
 
@@ -108,7 +91,7 @@ def create_weather_alert(route, weather_data):
                 f"{desc}, Temperature: {temp}°C, Wind: {wind}m/s"
             )
     
-    alert = frappe.get_doc({
+    alert = {
         "doctype": "Service Alert",
         "alert_type": "Weather Warning",
         "severity": get_weather_severity(weather_data),
@@ -123,10 +106,9 @@ def create_weather_alert(route, weather_data):
         "action_required": "Expect delays and drive with caution.",
         "notification_channels": "All Channels",
         "status": "Active"
-    })
+    }
     
-    alert.insert()
-    alert.submit()
+    raise_alert(alert, route.name, bucket_hours=6)
 
 
 def get_weather_severity(weather_data):
@@ -165,49 +147,37 @@ def check_traffic_incidents():
         active_trips = frappe.get_all(
             "Bus Trip",
             filters={
-                "departure_time": ["<=", now_datetime()],
-                "arrival_time": [">", now_datetime()],
+                "trip_status": "Running",
                 "docstatus": 1
             },
             fields=["name", "bus", "route"]
         )
         
+        # Rolling speeds maintained at GPS ingest, for every bus in one read
+        speed_stats = get_speed_stats()
+        now = now_datetime()
+        
         for trip in active_trips:
-            # Get recent GPS logs for the bus
-            logs = frappe.get_all(
-                "GPS Location Log",
-                filters={"bus": trip.bus},
-                fields=["latitude", "longitude", "timestamp"],
-                order_by="timestamp desc",
-                limit=10
-            )
-            
-            if len(logs) < 2:
+            stats = speed_stats.get(trip.bus)
+            if not stats or stats.window_speed is None:
                 continue
                 
-            # Calculate average speed
-            distances = []
-            times = []
-            
-            for i in range(len(logs) - 1):
-                pos1 = (logs[i].latitude, logs[i].longitude)
-                pos2 = (logs[i + 1].latitude, logs[i + 1].longitude)
-                
-                distance = geodesic(pos1, pos2).kilometers
-                time_diff = (logs[i].timestamp - logs[i + 1].timestamp).total_seconds() / 3600  # hours
-                
-                if time_diff > 0:
-                    distances.append(distance)
-                    times.append(time_diff)
-            
-            if not distances or not times:
+            # A bus that stopped reporting is not evidence of traffic
+            if (now - stats.updated).total_seconds() > SPEED_STATS_MAX_AGE:
+                continue
+
+            if stats.stationary_seconds > LAYOVER_SECONDS:
                 continue
                 
-            avg_speed = sum(distances) / sum(times)
-            
             # If average speed is very low, create traffic alert
-            if avg_speed < 10:  # km/h
-                create_traffic_alert(trip, avg_speed)
+            if stats.window_speed < 10:  # km/h
+                create_traffic_alert(trip, stats.window_speed)
+        
+        # Drop statistics of buses that have not reported for a day
+        clear_speed_stats([
+            bus for bus, stats in speed_stats.items()
+            if (now - stats.updated).total_seconds() > 86400
+        ])
     except Exception as e:
         frappe.log_error(f"Error checking traffic incidents: {str(e)}", "Traffic Alert Error")
 
@@ -216,7 +186,7 @@ def create_traffic_alert(trip, speed):
     """Create a traffic-based service alert"""
     route = frappe.get_doc("Route", trip.route)
     
-    alert = frappe.get_doc({
+    alert = {
         "doctype": "Service Alert",
         "alert_type": "Traffic Delay",
         "severity": "High" if speed < 5 else "Medium",
@@ -231,7 +201,6 @@ def create_traffic_alert(trip, speed):
         "action_required": "Expect significant delays. Consider alternative routes.",
         "notification_channels": "All Channels",
         "status": "Active"
-    })
+    }
     
-    alert.insert()
-    alert.submit()
\ No newline at end of file
+    raise_alert(alert, route.name, bucket_hours=2)
\ No newline at end of file
@@ -0,0 +1,116 @@
+import json
+import time
+from datetime import datetime
+import frappe
+from .trip_resolver import active_trip
+from .route_geometry import get_route_geometry
+from .map_matching import match_to_route, get_cursor
+from .travel_time_model import predict_stop_arrivals
+from .deviation_detection import DEVIATION_THRESHOLD_KM
+
+# Per-stop sorted set of JSON [trip, bus, route] scored by predicted arrival epoch
+BOARD_KEY = "stop_arrivals:{}"
+
+# Stops that have a board, so stale entries can be pruned without KEYS
+BOARD_STOPS_KEY = "stop_arrivals:stops"
+
+# Boards of stops no bus is heading for expire after a day
+BOARD_TTL = 86400
+
+# Predicted arrivals stay on the board this long after they are due
+GRACE_SECONDS = 120
+
+def update_bus_arrivals(bus_id, latitude, longitude, at=None):
+    """Re-predict the active trip's arrivals at its upcoming stops from a new fix"""
+    try:
+        trip = active_trip(bus_id)
+        if not trip:
+            return
+
+        geometry = get_route_geometry(trip.route)
+        match = match_to_route(
+            geometry, latitude, longitude,
+            DEVIATION_THRESHOLD_KM,
+            cursor=get_cursor(bus_id, geometry.route)
+        )
+        if not match:
+            return
+
+        update_trip_arrivals(trip, geometry, predict_stop_arrivals(geometry, match.along, at))
+
+    except Exception as e:
+        frappe.log_error(f"Arrival board update failed: {str(e)}")
+
+def update_trip_arrivals(trip, geometry, arrivals):
+    """Write a trip's predicted arrivals and drop it from the stops it has passed"""
+    member = trip_member(trip)
+
+    # A stop served twice (circular routes) shows the earlier arrival
+    upcoming = {}
+    for index, arrival in arrivals:
+        upcoming.setdefault(geometry.stops[index], arrival)
+
+    pipe = frappe.cache().pipeline()
+    for stop in set(geometry.stops) - set(upcoming):
+        pipe.zrem(BOARD_KEY.format(stop), member)
+    for stop, arrival in upcoming.items():
+        key = BOARD_KEY.format(stop)
+        pipe.zadd(key, {member: arrival.timestamp()})
+        pipe.expire(key, BOARD_TTL)
+    if upcoming:
+        pipe.sadd(BOARD_STOPS_KEY, *upcoming)
+    pipe.execute()
+
+def remove_trip_arrivals(trip):
+    """Take a trip off every stop of its route"""
+    member = trip_member(trip)
+
+    pipe = frappe.cache().pipeline()
+    for stop in set(get_route_geometry(trip.route).stops):
+        pipe.zrem(BOARD_KEY.format(stop), member)
+    pipe.execute()
+
+def trip_member(trip):
+    return json.dumps([trip.name, trip.bus, trip.route], separators=(",", ":"))
+
+def get_stop_boards(stops, limit=10):
+    """Upcoming arrivals for several stops, one sorted set read per stop"""
+    now = time.time()
+
+    pipe = frappe.cache().pipeline()
+    for stop in stops:
+        pipe.zrangebyscore(BOARD_KEY.format(stop), now - GRACE_SECONDS, "+inf", start=0, num=limit, withscores=True)
+
+    boards = {}
+    for stop, entries in zip(stops, pipe.execute()):
+        boards[stop] = [parse_entry(member, score) for member, score in entries]
+    return boards
+
+def parse_entry(member, score):
+    trip, bus, route = json.loads(member)
+    return {
+        "trip": trip,
+        "bus": bus,
+        "route": route,
+        "eta": datetime.fromtimestamp(score)
+    }
+
+def prune_stop_arrivals():
+    """Drop arrivals that are past their grace period from every board"""
+    pipe = frappe.cache().pipeline()
+    pipe.smembers(BOARD_STOPS_KEY)
+    stops = [s.decode() if isinstance(s, bytes) else s for s in pipe.execute()[0]]
+
+    cutoff = time.time() - GRACE_SECONDS
+    pipe = frappe.cache().pipeline()
+    for stop in stops:
+        pipe.zremrangebyscore(BOARD_KEY.format(stop), "-inf", cutoff)
+        pipe.zcard(BOARD_KEY.format(stop))
+    results = pipe.execute()
+
+    # Forget stops whose board is now empty
+    empty = [stop for stop, count in zip(stops, results[1::2]) if not count]
+    if empty:
+        pipe = frappe.cache().pipeline()
+        pipe.srem(BOARD_STOPS_KEY, *empty)
+        pipe.execute()
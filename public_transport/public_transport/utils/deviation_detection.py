@@ -1,6 +1,18 @@
 import frappe
-from geopy.distance import geodesic
 from datetime import datetime, timedelta
+from .trip_resolver import active_trip
+from .route_geometry import get_route_geometry, get_active_routes, get_stop_coordinates
+from .geo import haversine_pairwise
+from .map_matching import match_to_route, get_cursor, set_cursor
+from .stop_index import get_stop_index
+from .alert_fingerprints import raise_alert
+from .deviation_state import (
+    advance_deviation_state, set_deviation_state,
+    ON_ROUTE, SUSPECT, DEVIATING, RECOVERING
+)
+
+# Cross-track distance (km) beyond which a fix counts as off route
+DEVIATION_THRESHOLD_KM = 0.5
 
 def check_route_deviation(bus_id, current_position):
     """Check if bus has deviated from planned route"""
@@ -10,135 +22,66 @@ def check_route_deviation(bus_id, current_position):
         if not current_trip:
             return None
             
-        # Get route and calculate expected position
-        route = frappe.get_doc("Route", current_trip.route)
-        expected_position = calculate_expected_position(current_trip, route)
+        # Match the fix to the route polyline, starting from the bus's last matched segment
+        geometry = get_active_routes().get(current_trip.route) or get_route_geometry(current_trip.route)
+        match = match_to_route(
+            geometry,
+            current_position["latitude"],
+            current_position["longitude"],
+            DEVIATION_THRESHOLD_KM,
+            cursor=get_cursor(bus_id, geometry.route)
+        )
         
-        if not expected_position:
+        if not match:
             return None
             
-        # Calculate distance from expected position
-        actual_pos = (current_position["latitude"], current_position["longitude"])
-        expected_pos = (expected_position["latitude"], expected_position["longitude"])
-        
-        deviation_distance = geodesic(actual_pos, expected_pos).kilometers
-        
-        # If deviation is significant (more than 500m)
-        if deviation_distance > 0.5:
-            return handle_deviation(current_trip, route, current_position, deviation_distance)
-            
-        return None
+        if match.distance <= DEVIATION_THRESHOLD_KM:
+            set_cursor(bus_id, geometry.route, match.segment)
+
+        return record_deviation_observation(bus_id, current_trip, current_position, match.distance)
         
     except Exception as e:
         frappe.log_error(f"Deviation check failed: {str(e)}")
         return None
 
-def get_active_trip(bus_id):
-    """Get currently active trip for bus"""
-    trips = frappe.get_all(
-        "Bus Trip",
-        filters={
-            "bus": bus_id,
-            "departure_time": ["<=", frappe.utils.now_datetime()],
-            "arrival_time": [">", frappe.utils.now_datetime()],
-            "docstatus": 1
-        },
-        fields=["name", "route", "departure_time"],
-        limit=1
+def record_deviation_observation(bus_id, trip, position, distance):
+    """Feed a fix's cross-track distance into the bus's deviation state.
+
+    Only state transitions touch the database: the Route Deviation is
+    created on entering a deviation and resolved on leaving it.
+    """
+    off_route = distance > DEVIATION_THRESHOLD_KM
+    previous, state = advance_deviation_state(
+        bus_id,
+        trip.name,
+        off_route,
+        position.get("timestamp") or frappe.utils.now_datetime()
     )
-    
-    return frappe.get_doc("Bus Trip", trips[0].name) if trips else None
 
-def calculate_expected_position(trip, route):
-    """Calculate where the bus should be based on schedule"""
-    try:
-        # Calculate time elapsed since departure
-        elapsed = (frappe.utils.now_datetime() - trip.departure_time).total_seconds() / 3600  # hours
-        
-        # Calculate total route time
-        total_time = sum(stop.estimated_time_from_previous or 0 for stop in route.stops) / 60  # hours
-        
-        if total_time == 0:
-            return None
-            
-        # Calculate progress through route (0-1)
-        progress = min(elapsed / total_time, 1)
-        
-        # Find expected position by interpolating between stops
-        return interpolate_position(route.stops, progress)
-        
-    except Exception as e:
-        frappe.log_error(f"Position calculation failed: {str(e)}")
-        return None
+    if previous.deviation and previous.trip != state.trip:
+        resolve_deviation(previous.deviation, previous.alert)
 
-def interpolate_position(stops, progress):
-    """Interpolate position between stops based on progress"""
-    if not stops or len(stops) < 2:
-        return None
-        
-    # Calculate cumulative distances
-    total_distance = 0
-    distances = []
-    
-    for i in range(len(stops) - 1):
-        current = frappe.get_doc("Bus Stop", stops[i].stop)
-        next_stop = frappe.get_doc("Bus Stop", stops[i + 1].stop)
-        
-        distance = geodesic(
-            (current.latitude, current.longitude),
-            (next_stop.latitude, next_stop.longitude)
-        ).kilometers
-        
-        total_distance += distance
-        distances.append(distance)
-    
-    if total_distance == 0:
-        return None
-    
-    # Find segment where bus should be
-    target_distance = total_distance * progress
-    current_distance = 0
-    
-    for i in range(len(distances)):
-        if current_distance + distances[i] >= target_distance:
-            # Interpolate between these stops
-            segment_progress = (target_distance - current_distance) / distances[i]
-            
-            current = frappe.get_doc("Bus Stop", stops[i].stop)
-            next_stop = frappe.get_doc("Bus Stop", stops[i + 1].stop)
-            
-            return {
-                "latitude": current.latitude + (next_stop.latitude - current.latitude) * segment_progress,
-                "longitude": current.longitude + (next_stop.longitude - current.longitude) * segment_progress
-            }
-            
-        current_distance += distances[i]
-    
-    # If we're at the end, return last stop
-    last_stop = frappe.get_doc("Bus Stop", stops[-1].stop)
-    return {
-        "latitude": last_stop.latitude,
-        "longitude": last_stop.longitude
-    }
+    if state.state == DEVIATING and previous.state == SUSPECT:
+        route = frappe.get_doc("Route", trip.route)
+        deviation, alert = handle_deviation(trip, route, position, distance)
+        if deviation:
+            state.update({"deviation": deviation.name, "alert": alert})
+            set_deviation_state(bus_id, state)
+        return deviation
+
+    # No record exists when creating the deviation failed, so there is nothing to resolve
+    if state.state == ON_ROUTE and previous.state == RECOVERING and previous.deviation:
+        resolve_deviation(previous.deviation, previous.alert)
+
+    return None
+
+def get_active_trip(bus_id):
+    """Get currently active trip for bus"""
+    return active_trip(bus_id)
 
 def handle_deviation(trip, route, current_position, deviation_distance):
     """Handle detected route deviation"""
     try:
-        # Check for existing active deviation
-        existing = frappe.get_all(
-            "Route Deviation",
-            filters={
-                "route": route.name,
-                "status": "Active",
-                "start_time": ["<=", frappe.utils.now_datetime()],
-                "end_time": [">", frappe.utils.now_datetime()]
-            },
-            limit=1
-        )
-        
-        if existing:
-            return None
-        
         # Find nearest stops for alternate route
         nearest_stops = find_nearest_stops(current_position)
         
@@ -150,7 +93,8 @@ def handle_deviation(trip, route, current_position, deviation_distance):
             "end_time": frappe.utils.add_to_date(None, hours=1),
             "reason": "Traffic",
             "description": f"Automatic deviation detection: {deviation_distance:.2f}km off route",
-            "status": "Active"
+            "status": "Active",
+            "auto_detected": 1
         })
         
         # Add stops to deviation
@@ -165,21 +109,49 @@ def handle_deviation(trip, route, current_position, deviation_distance):
         deviation.insert()
         
         # Create service alert for the deviation
-        create_deviation_alert(deviation, trip, route)
+        alert = create_deviation_alert(deviation, trip, route)
         
         # Send notifications
         notify_deviation(deviation, trip)
         
-        return deviation
+        return deviation, alert
         
     except Exception as e:
         frappe.log_error(f"Deviation handling failed: {str(e)}")
-        return None
+        return None, None
+
+def resolve_deviation(deviation, alert=None):
+    """Close an automatically detected deviation once its bus is back on route.
+
+    Buses deviating on one route share an alert, so the alert is only
+    resolved once no other detected deviation on the route is active.
+    Deviations past their end time no longer count, so a bus that stopped
+    reporting cannot keep the alert open.
+    """
+    try:
+        now = frappe.utils.now_datetime()
+        route = frappe.db.get_value("Route Deviation", deviation, "route")
+        frappe.db.set_value("Route Deviation", deviation, {"status": "Resolved", "end_time": now})
+
+        still_deviating = frappe.db.exists("Route Deviation", {
+            "route": route,
+            "status": "Active",
+            "name": ["!=", deviation],
+            "auto_detected": 1,
+            "end_time": [">", now]
+        })
+
+        if alert and not still_deviating:
+            frappe.db.set_value("Service Alert", alert, {"status": "Resolved", "end_time": now})
+            frappe.get_doc("Service Alert", alert).publish_realtime_update(update_type="resolve")
+            
+    except Exception as e:
+        frappe.log_error(f"Deviation resolution failed: {str(e)}")
 
 def create_deviation_alert(deviation, trip, route):
     """Create service alert for route deviation"""
     try:
-        alert = frappe.get_doc({
+        alert = {
             "doctype": "Service Alert",
             "alert_type": "Route Deviation",
             "severity": "High",
@@ -197,13 +169,15 @@ def create_deviation_alert(deviation, trip, route):
             ),
             "notification_channels": "All Channels",
             "status": "Active"
-        })
+        }
         
-        alert.insert()
-        alert.submit()
+        # Buses deviating on the same route share one alert
+        name, _ = raise_alert(alert, route.name, bucket_hours=1)
+        return name
         
     except Exception as e:
         frappe.log_error(f"Deviation alert creation failed: {str(e)}")
+        return None
 
 def notify_deviation(deviation, trip):
     """Send notifications for route deviation"""
@@ -246,24 +220,15 @@ def notify_deviation(deviation, trip):
 def calculate_new_eta(deviation, trip):
     """Calculate new ETA based on deviation route"""
     try:
-        total_distance = 0
-        total_time = 0
-        
         # Calculate distance and time for alternate route
-        for i in range(len(deviation.alternate_stops) - 1):
-            current = frappe.get_doc("Bus Stop", deviation.alternate_stops[i].stop)
-            next_stop = frappe.get_doc("Bus Stop", deviation.alternate_stops[i + 1].stop)
-            
-            distance = geodesic(
-                (current.latitude, current.longitude),
-                (next_stop.latitude, next_stop.longitude)
-            ).kilometers
-            
-            total_distance += distance
-            
-            # Estimate time (assume slower speed due to deviation)
-            time_minutes = (distance / 20) * 60  # Assume 20 km/h average speed
-            total_time += time_minutes
+        stops = [stop.stop for stop in deviation.alternate_stops]
+        coordinates = get_stop_coordinates(stops)
+        
+        points = [coordinates[stop] for stop in stops]
+        total_distance = float(haversine_pairwise([p[0] for p in points], [p[1] for p in points]).sum())
+        
+        # Estimate time (assume slower speed due to deviation)
+        total_time = (total_distance / 20) * 60  # Assume 20 km/h average speed
         
         # Update trip ETA
         new_eta = frappe.utils.add_to_date(
@@ -281,19 +246,4 @@ def calculate_new_eta(deviation, trip):
 
 def find_nearest_stops(position):
     """Find nearest stops to create alternate route"""
-    stops = frappe.get_all(
-        "Bus Stop",
-        fields=["name", "latitude", "longitude"],
-        filters={"is_active": 1}
-    )
-    
-    # Calculate distances
-    for stop in stops:
-        stop.distance = geodesic(
-            (position["latitude"], position["longitude"]),
-            (stop.latitude, stop.longitude)
-        ).kilometers
-    
-    # Sort by distance and return closest 3 stops
-    stops.sort(key=lambda x: x.distance)
-    return stops[:3]
\ No newline at end of file
+    return get_stop_index().nearest(position["latitude"], position["longitude"], k=3)
\ No newline at end of file
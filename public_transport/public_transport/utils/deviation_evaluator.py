@@ -0,0 +1,172 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import frappe
+from frappe.utils import get_datetime, cint
+from .location_cache import get_cached_positions
+from .route_geometry import RouteGeometry, get_route_geometry, get_active_routes
+from .map_matching import get_route_segments
+from .deviation_detection import record_deviation_observation
+from ..doctype.gps_tracking_settings.gps_tracking_settings import read_tracking_settings
+
+# Timestamp of the last fix evaluated per bus, so each fix is counted once
+EVALUATED_KEY = "deviation_evaluator:evaluated"
+
+# Figures from the most recent cycle
+STATS_KEY = "deviation_evaluator:stats"
+
+# How long to wait before checking again while batch mode is off
+IDLE_SECONDS = 30
+
+def run_deviation_evaluator():
+    """Evaluate the fleet every evaluation_interval seconds while batch mode is on, forever.
+
+    Runs in its own long-lived process (bench run-deviation-evaluator),
+    so it never holds a scheduler worker. The process pool is started
+    once and only replaced when evaluator_processes changes.
+    """
+    pool, processes = None, 1
+    try:
+        while True:
+            cycle_started = time.monotonic()
+            # A fresh transaction, so settings and trips saved since the last cycle are seen
+            frappe.db.rollback()
+            settings = read_tracking_settings()
+            if settings.deviation_mode != "Batch":
+                time.sleep(IDLE_SECONDS)
+                continue
+
+            wanted = max(cint(settings.evaluator_processes), 1)
+            if wanted != processes:
+                if pool:
+                    pool.shutdown()
+                pool = ProcessPoolExecutor(max_workers=wanted) if wanted > 1 else None
+                processes = wanted
+
+            try:
+                evaluate_fleet(pool)
+                frappe.db.commit()
+            except Exception as e:
+                frappe.db.rollback()
+                frappe.log_error(title="Deviation evaluation failed")
+                if isinstance(e, BrokenProcessPool):
+                    # A pool process died; start a new pool next cycle
+                    pool.shutdown(wait=False)
+                    pool, processes = None, 1
+
+            interval = cint(settings.evaluation_interval) or 15
+            time.sleep(max(interval - (time.monotonic() - cycle_started), 0))
+    finally:
+        if pool:
+            pool.shutdown()
+
+def evaluate_fleet(pool=None):
+    """One evaluation cycle over the newest fix of every running trip's bus.
+
+    Fixes are grouped by route and each route's cross-track distances are
+    computed in one vectorized pass, spread across `pool` when given. Only
+    the state machine updates run in this process. Returns the cycle's stats.
+    """
+    cycle_started = time.perf_counter()
+
+    trips = frappe.get_all(
+        "Bus Trip",
+        filters={"docstatus": 1, "trip_status": "Running"},
+        fields=["name", "bus", "route", "bus_operator", "departure_time", "arrival_time"]
+    )
+    positions = get_cached_positions([trip.bus for trip in trips])
+    evaluated = get_evaluated_timestamps()
+
+    # Newest unevaluated fix per bus, grouped by route
+    by_route = {}
+    for trip in trips:
+        position = positions.get(trip.bus)
+        if not position or (trip.bus in evaluated and position.timestamp <= evaluated[trip.bus]):
+            continue
+        by_route.setdefault(trip.route, []).append((trip, position))
+
+    active_routes = get_active_routes()
+    jobs, observations = [], []
+    for route, entries in by_route.items():
+        geometry = active_routes.get(route) or get_route_geometry(route)
+        if len(geometry.stops) < 2:
+            continue
+        jobs.append((
+            # Pool processes get the plain data; this process keeps its compiled segments
+            geometry.as_dict() if pool else geometry,
+            [position.latitude for _, position in entries],
+            [position.longitude for _, position in entries]
+        ))
+        observations.append(entries)
+
+    results = pool.map(evaluate_route_job, jobs) if pool else map(evaluate_route_job, jobs)
+
+    evaluated_fixes = []
+    for entries, distances in zip(observations, results):
+        for (trip, position), distance in zip(entries, distances):
+            record_deviation_observation(trip.bus, trip, position, distance)
+        evaluated_fixes.extend(entries)
+
+    set_evaluated_timestamps({trip.bus: position.timestamp for trip, position in evaluated_fixes})
+
+    stats = {
+        "latency_ms": round((time.perf_counter() - cycle_started) * 1000, 1),
+        "routes": len(jobs),
+        "buses": len(evaluated_fixes),
+        "evaluated_at": str(frappe.utils.now_datetime())
+    }
+    record_cycle_stats(stats)
+    return stats
+
+def evaluate_route_job(job):
+    """evaluate_route for one (geometry, latitudes, longitudes) job; runs in pool processes"""
+    geometry, latitudes, longitudes = job
+    if isinstance(geometry, dict):
+        geometry = RouteGeometry.from_dict(geometry)
+    return evaluate_route(geometry, latitudes, longitudes)
+
+def evaluate_route(geometry, latitudes, longitudes):
+    """Cross-track distances (km) of many fixes to one route"""
+    distances, _, _ = get_route_segments(geometry).nearest(
+        np.asarray(latitudes, dtype=float),
+        np.asarray(longitudes, dtype=float)
+    )
+    return [float(distance) for distance in distances]
+
+def get_evaluated_timestamps():
+    pipe = frappe.cache().pipeline()
+    pipe.hgetall(EVALUATED_KEY)
+    return {
+        (k.decode() if isinstance(k, bytes) else k): get_datetime(v.decode() if isinstance(v, bytes) else v)
+        for k, v in pipe.execute()[0].items()
+    }
+
+def set_evaluated_timestamps(timestamps):
+    if not timestamps:
+        return
+    pipe = frappe.cache().pipeline()
+    pipe.hset(EVALUATED_KEY, mapping={bus: str(timestamp) for bus, timestamp in timestamps.items()})
+    pipe.execute()
+
+def record_cycle_stats(stats):
+    """Keep the latest cycle's latency in Redis and the evaluator log"""
+    pipe = frappe.cache().pipeline()
+    pipe.hset(STATS_KEY, mapping={key: str(value) for key, value in stats.items()})
+    pipe.execute()
+
+    frappe.logger("deviation_evaluator").info(
+        f"Evaluated {stats['buses']} buses on {stats['routes']} routes in {stats['latency_ms']} ms"
+    )
+
+@frappe.whitelist()
+def get_evaluator_stats():
+    """Latest batch evaluation cycle's latency and size"""
+    frappe.only_for("System Manager")
+
+    pipe = frappe.cache().pipeline()
+    pipe.hgetall(STATS_KEY)
+    return {
+        (k.decode() if isinstance(k, bytes) else k): (v.decode() if isinstance(v, bytes) else v)
+        for k, v in pipe.execute()[0].items()
+    }
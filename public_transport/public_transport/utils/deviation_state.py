@@ -0,0 +1,97 @@
+import frappe
+from frappe.utils import get_datetime, cint
+
+# Per-bus Redis hash holding the deviation state of the bus's current trip
+STATE_KEY = "bus_deviation_state:{}"
+STATE_FIELDS = ("state", "trip", "count", "since", "deviation", "alert")
+
+# States left behind by buses that stop reporting expire after a day
+STATE_TTL = 86400
+
+ON_ROUTE = "on_route"
+SUSPECT = "suspect"
+DEVIATING = "deviating"
+RECOVERING = "recovering"
+
+# Consecutive fixes, spanning at least this many seconds, needed to change state
+ENTER_FIXES = 3
+ENTER_SECONDS = 30
+EXIT_FIXES = 3
+EXIT_SECONDS = 30
+
+def get_deviation_state(bus_id):
+    """Get a bus's deviation state, on route when none is stored"""
+    pipe = frappe.cache().pipeline()
+    pipe.hgetall(STATE_KEY.format(bus_id))
+    return parse_state(pipe.execute()[0])
+
+def set_deviation_state(bus_id, state):
+    """Replace a bus's deviation state"""
+    key = STATE_KEY.format(bus_id)
+    pipe = frappe.cache().pipeline()
+    pipe.delete(key)
+    pipe.hset(key, mapping={
+        field: str(state[field])
+        for field in STATE_FIELDS
+        if state.get(field) is not None
+    })
+    pipe.expire(key, STATE_TTL)
+    pipe.execute()
+
+def advance_deviation_state(bus_id, trip, off_route, timestamp):
+    """Feed one fix into a bus's deviation state machine.
+
+    on_route -> suspect -> deviating -> recovering -> on_route, where
+    suspect and recovering fall back as soon as a fix disagrees. Returns
+    (previous, current) states; Redis is only written while a transition
+    is pending or made, never for fixes that leave the state unchanged.
+    """
+    timestamp = get_datetime(timestamp)
+    previous = get_deviation_state(bus_id)
+
+    if previous.trip != trip:
+        # Every trip starts on route; the caller closes anything left open
+        state = frappe._dict({"state": ON_ROUTE, "trip": trip, "count": 0})
+    else:
+        state = frappe._dict(previous)
+
+    if state.state == ON_ROUTE and off_route:
+        state.update({"state": SUSPECT, "count": 1, "since": timestamp})
+    elif state.state == SUSPECT and not off_route:
+        state.update({"state": ON_ROUTE, "count": 0, "since": None})
+    elif state.state == SUSPECT:
+        state.count += 1
+        if confirmed(state, timestamp, ENTER_FIXES, ENTER_SECONDS):
+            state.update({"state": DEVIATING, "count": 0, "since": None})
+    elif state.state == DEVIATING and not off_route:
+        state.update({"state": RECOVERING, "count": 1, "since": timestamp})
+    elif state.state == RECOVERING and off_route:
+        state.update({"state": DEVIATING, "count": 0, "since": None})
+    elif state.state == RECOVERING:
+        state.count += 1
+        if confirmed(state, timestamp, EXIT_FIXES, EXIT_SECONDS):
+            state.update({"state": ON_ROUTE, "count": 0, "since": None, "deviation": None, "alert": None})
+
+    if state != previous:
+        set_deviation_state(bus_id, state)
+
+    return previous, state
+
+def confirmed(state, timestamp, fixes, seconds):
+    """Whether enough consecutive fixes over enough time back a pending transition"""
+    return state.count >= fixes and (timestamp - state.since).total_seconds() >= seconds
+
+def parse_state(raw):
+    """Convert a raw Redis hash into a state dict"""
+    values = {
+        (k.decode() if isinstance(k, bytes) else k): (v.decode() if isinstance(v, bytes) else v)
+        for k, v in (raw or {}).items()
+    }
+    return frappe._dict({
+        "state": values.get("state") or ON_ROUTE,
+        "trip": values.get("trip"),
+        "count": cint(values.get("count")),
+        "since": get_datetime(values["since"]) if values.get("since") else None,
+        "deviation": values.get("deviation"),
+        "alert": values.get("alert")
+    })
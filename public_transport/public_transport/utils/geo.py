@@ -0,0 +1,69 @@
+"""Vectorized great-circle distance kernels.
+
+All functions take degrees, return kilometres and accept scalars or
+NumPy arrays. Distances are computed on a sphere of mean Earth radius,
+so they differ from the WGS-84 ellipsoidal distance returned by
+geopy.distance.geodesic:
+
+* haversine: within 0.57% of geodesic at any separation.
+* equirectangular: within 0.004% of haversine (so within 0.6% of
+  geodesic) for separations up to 100 km between latitudes -60 and 60.
+  The error grows with separation and towards the poles; use it for
+  stop-to-stop and fix-to-stop distances, not for long-haul legs.
+"""
+import numpy as np
+
+# IUGG mean Earth radius
+EARTH_RADIUS_KM = 6371.0088
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Element-wise haversine distance with NumPy broadcasting"""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lng1, lat2, lng2))
+
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def equirectangular(lat1, lng1, lat2, lng2):
+    """Element-wise equirectangular distance with NumPy broadcasting"""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lng1, lat2, lng2))
+
+    # Wrap the longitude difference across the antimeridian
+    delta_lng = (lng2 - lng1 + np.pi) % (2 * np.pi) - np.pi
+    x = delta_lng * np.cos((lat1 + lat2) / 2)
+    y = lat2 - lat1
+    return EARTH_RADIUS_KM * np.hypot(x, y)
+
+def haversine_one_to_many(lat, lng, lats, lngs):
+    """Distances from one point to each of many points"""
+    return haversine(lat, lng, lats, lngs)
+
+def haversine_pairwise(lats, lngs):
+    """Distances between consecutive points of a path (n - 1 values)"""
+    lats, lngs = np.asarray(lats, dtype=float), np.asarray(lngs, dtype=float)
+    return haversine(lats[:-1], lngs[:-1], lats[1:], lngs[1:])
+
+def haversine_matrix(lats1, lngs1, lats2, lngs2):
+    """Distance matrix of shape (len(lats1), len(lats2))"""
+    lats1, lngs1 = np.asarray(lats1, dtype=float), np.asarray(lngs1, dtype=float)
+    return haversine(lats1[:, None], lngs1[:, None], lats2, lngs2)
+
+def equirectangular_one_to_many(lat, lng, lats, lngs):
+    """Distances from one point to each of many points"""
+    return equirectangular(lat, lng, lats, lngs)
+
+def equirectangular_pairwise(lats, lngs):
+    """Distances between consecutive points of a path (n - 1 values)"""
+    lats, lngs = np.asarray(lats, dtype=float), np.asarray(lngs, dtype=float)
+    return equirectangular(lats[:-1], lngs[:-1], lats[1:], lngs[1:])
+
+def equirectangular_matrix(lats1, lngs1, lats2, lngs2):
+    """Distance matrix of shape (len(lats1), len(lats2))"""
+    lats1, lngs1 = np.asarray(lats1, dtype=float), np.asarray(lngs1, dtype=float)
+    return equirectangular(lats1[:, None], lngs1[:, None], lats2, lngs2)
+
+def distance_km(origin, destination):
+    """Haversine distance between two (latitude, longitude) pairs as a float"""
+    return float(haversine(origin[0], origin[1], destination[0], destination[1]))
@@ -1,40 +1,168 @@
 import frappe
-from frappe.utils import now_datetime
-from geopy.distance import geodesic
+from frappe.utils import now_datetime, get_datetime, flt, cint
 from datetime import timedelta
 from .deviation_detection import check_route_deviation
+from .location_cache import set_latest_position, get_latest_position
+from .arrival_board import update_bus_arrivals
+from ..realtime import notify_tracking_clients
+from ..doctype.gps_tracking_settings.gps_tracking_settings import batch_deviation_mode
+
+# Upper bound on fixes accepted in one batch upload
+MAX_BATCH_SIZE = 500
 
 def update_bus_location(bus_id, latitude, longitude):
     """Update bus location and check for deviations"""
     try:
-        # Create GPS log entry
-        log_entry = frappe.get_doc({
+        # Deviation checks and client notification run from the
+        # GPS Location Log after_insert hook
+        frappe.get_doc({
             'doctype': 'GPS Location Log',
             'bus': bus_id,
             'latitude': latitude,
             'longitude': longitude,
             'timestamp': now_datetime()
-        })
-        log_entry.insert()
+        }).insert()
+
+        return {"status": "success"}
+    except Exception as e:
+        frappe.log_error(f"GPS Update Failed: {str(e)}")
+        return {"status": "error", "message": str(e)}
+
+def on_location_log_insert(doc, method=None):
+    """Process a single GPS Location Log insert"""
+    process_location_fix(doc.bus, doc.latitude, doc.longitude, doc.timestamp)
+
+def process_location_fix(bus_id, latitude, longitude, timestamp, speed=None, heading=None):
+    """Check for route deviation and notify tracking clients for a bus's newest fix"""
+    set_latest_position(bus_id, latitude, longitude, timestamp, speed=speed, heading=heading)
+    update_bus_arrivals(bus_id, latitude, longitude)
 
-        # Check for route deviation
+    # In batch mode the deviation evaluator picks the fix up from the cache
+    deviation = None
+    if not batch_deviation_mode():
         current_position = {
             'latitude': latitude,
-            'longitude': longitude
+            'longitude': longitude,
+            'timestamp': timestamp
         }
         deviation = check_route_deviation(bus_id, current_position)
 
-        # Notify clients about location update and any deviation
-        notify_tracking_clients(bus_id, {
-            'location': current_position,
-            'timestamp': str(log_entry.timestamp),
-            'deviation': deviation.name if deviation else None
-        })
+    notify_tracking_clients(
+        bus_id, latitude, longitude, timestamp,
+        speed=speed, heading=heading,
+        deviation=deviation.name if deviation else None
+    )
+
+    return deviation
 
-        return {"status": "success"}
-    except Exception as e:
-        frappe.log_error(f"GPS Update Failed: {str(e)}")
-        return {"status": "error", "message": str(e)}
+def record_location_batch(fixes):
+    """Validate and bulk insert GPS fixes for one or many buses.
+
+    Every fix is written with a single multi-row insert, bypassing the
+    per-document hooks; deviation checks and realtime publishes then run
+    once per bus on its newest fix. Returns (inserted, rejected) where
+    rejected lists the index and reason of every fix that failed validation.
+    """
+    if len(fixes) > MAX_BATCH_SIZE:
+        frappe.throw(f"A batch can contain at most {MAX_BATCH_SIZE} fixes")
+
+    valid, rejected = validate_location_batch(fixes)
+    if not valid:
+        return 0, rejected
+
+    now = now_datetime()
+    user = frappe.session.user
+    names = make_log_names(len(valid))
+    values = [
+        (name, now, now, user, user, 0,
+         fix['bus'], fix['latitude'], fix['longitude'], fix['timestamp'])
+        for name, fix in zip(names, valid)
+    ]
+    frappe.db.bulk_insert(
+        'GPS Location Log',
+        ['name', 'creation', 'modified', 'owner', 'modified_by', 'docstatus',
+         'bus', 'latitude', 'longitude', 'timestamp'],
+        values
+    )
+
+    # Only the newest fix per bus drives deviation checks and notifications
+    newest = {}
+    for fix in valid:
+        if fix['bus'] not in newest or fix['timestamp'] >= newest[fix['bus']]['timestamp']:
+            newest[fix['bus']] = fix
+
+    for fix in newest.values():
+        try:
+            process_location_fix(
+                fix['bus'], fix['latitude'], fix['longitude'], fix['timestamp'],
+                speed=fix['speed'], heading=fix['heading']
+            )
+        except Exception as e:
+            frappe.log_error(f"GPS batch processing failed for bus {fix['bus']}: {str(e)}")
+
+    return len(valid), rejected
+
+def validate_location_batch(fixes):
+    """Normalise a batch of fixes, splitting them into valid fixes and rejections"""
+    valid = []
+    rejected = []
+
+    bus_ids = {fix.get('bus_id') for fix in fixes if isinstance(fix, dict) and fix.get('bus_id')}
+    known_buses = set(frappe.get_all(
+        'Bus',
+        filters={'name': ['in', list(bus_ids)]},
+        pluck='name'
+    )) if bus_ids else set()
+
+    for index, fix in enumerate(fixes):
+        try:
+            if not isinstance(fix, dict):
+                raise ValueError("Fix must be an object")
+            if fix.get('bus_id') not in known_buses:
+                raise ValueError(f"Unknown bus {fix.get('bus_id')}")
+
+            latitude = flt(fix.get('latitude'))
+            longitude = flt(fix.get('longitude'))
+            if fix.get('latitude') is None or not -90 <= latitude <= 90:
+                raise ValueError("Latitude must be between -90 and 90 degrees")
+            if fix.get('longitude') is None or not -180 <= longitude <= 180:
+                raise ValueError("Longitude must be between -180 and 180 degrees")
+
+            valid.append({
+                'bus': fix['bus_id'],
+                'latitude': latitude,
+                'longitude': longitude,
+                'timestamp': get_datetime(fix.get('timestamp')) if fix.get('timestamp') else now_datetime(),
+                'speed': flt(fix['speed']) if fix.get('speed') is not None else None,
+                'heading': flt(fix['heading']) if fix.get('heading') is not None else None
+            })
+        except Exception as e:
+            rejected.append({'index': index, 'message': str(e)})
+
+    return valid, rejected
+
+def make_log_names(count):
+    """Reserve a contiguous block of GPS Location Log names with one series update"""
+    prefix = 'GPS-'
+    current = frappe.db.sql(
+        "select `current` from `tabSeries` where `name`=%s for update",
+        (prefix,)
+    )
+
+    if current and current[0][0] is not None:
+        start = cint(current[0][0])
+        frappe.db.sql(
+            "update `tabSeries` set `current` = `current` + %s where `name`=%s",
+            (count, prefix)
+        )
+    else:
+        start = 0
+        frappe.db.sql(
+            "insert into `tabSeries` (`name`, `current`) values (%s, %s)",
+            (prefix, count)
+        )
+
+    return [f"{prefix}{i:04d}" for i in range(start + 1, start + count + 1)]
 
 def notify_delay(trip):
     """Notify passengers about trip delay"""
@@ -62,18 +190,12 @@ def notify_delay(trip):
 def get_bus_location(bus_id):
     """Get latest bus location"""
     try:
-        latest_log = frappe.get_all(
-            "GPS Location Log",
-            filters={"bus": bus_id},
-            fields=["latitude", "longitude", "timestamp"],
-            order_by="timestamp desc",
-            limit=1
-        )
+        latest_location = get_latest_position(bus_id)
         
-        if latest_log:
+        if latest_location:
             return {
                 "status": "success",
-                "location": latest_log[0]
+                "location": latest_location
             }
         return {
             "status": "error",
@@ -0,0 +1,141 @@
+import math
+import frappe
+from frappe.utils import get_datetime, flt
+from .geo import distance_km
+from .speed_stats import update_speed_stats
+
+# Per-bus Redis hash holding the newest fix
+POSITION_KEY = "bus_position:{}"
+POSITION_FIELDS = ("latitude", "longitude", "timestamp", "speed", "heading")
+
+# Positions of buses that stop reporting drop out of the cache after a day
+POSITION_TTL = 86400
+
+def set_latest_position(bus_id, latitude, longitude, timestamp, speed=None, heading=None):
+    """Store a bus's newest fix, ignoring fixes older than the cached one"""
+    timestamp = get_datetime(timestamp)
+    previous = get_cached_positions([bus_id]).get(bus_id)
+
+    if previous and previous.timestamp >= timestamp:
+        return previous
+
+    # Derive speed and heading from the previous fix when the unit did not send them
+    if previous and (speed is None or heading is None):
+        elapsed = (timestamp - previous.timestamp).total_seconds()
+        if speed is None and elapsed > 0:
+            distance = distance_km((previous.latitude, previous.longitude), (latitude, longitude))
+            speed = distance / (elapsed / 3600)
+        if heading is None and (previous.latitude, previous.longitude) != (latitude, longitude):
+            heading = calculate_bearing(previous.latitude, previous.longitude, latitude, longitude)
+
+    position = frappe._dict({
+        "latitude": flt(latitude),
+        "longitude": flt(longitude),
+        "timestamp": timestamp,
+        "speed": flt(speed) if speed is not None else None,
+        "heading": flt(heading) if heading is not None else None
+    })
+    write_positions({bus_id: position})
+
+    if previous:
+        update_speed_stats(bus_id, previous, position)
+
+    return position
+
+def write_positions(positions):
+    """Write {bus_id: position} entries to the cache in one round-trip"""
+    pipe = frappe.cache().pipeline()
+    for bus_id, position in positions.items():
+        key = POSITION_KEY.format(bus_id)
+        pipe.hset(key, mapping={
+            field: str(position[field])
+            for field in POSITION_FIELDS
+            if position.get(field) is not None
+        })
+        pipe.expire(key, POSITION_TTL)
+    pipe.execute()
+
+def get_cached_positions(bus_ids):
+    """Read cached positions for several buses in one round-trip, skipping misses"""
+    pipe = frappe.cache().pipeline()
+    for bus_id in bus_ids:
+        pipe.hgetall(POSITION_KEY.format(bus_id))
+
+    positions = {}
+    for bus_id, raw in zip(bus_ids, pipe.execute()):
+        if raw:
+            positions[bus_id] = parse_position(raw)
+    return positions
+
+def get_latest_position(bus_id):
+    """Get a bus's newest fix, falling back to the database on a cache miss"""
+    return get_latest_positions([bus_id]).get(bus_id)
+
+def get_latest_positions(bus_ids):
+    """Get the newest fix for many buses, keyed by bus.
+
+    Cached positions are read with one pipelined round-trip; misses are
+    loaded with a single query and written back to the cache.
+    """
+    bus_ids = list(dict.fromkeys(bus_ids))
+    if not bus_ids:
+        return {}
+
+    positions = get_cached_positions(bus_ids)
+    missing = [bus_id for bus_id in bus_ids if bus_id not in positions]
+
+    if missing:
+        loaded = load_positions_from_db(missing)
+        if loaded:
+            write_positions(loaded)
+            positions.update(loaded)
+
+    return positions
+
+def load_positions_from_db(bus_ids):
+    """Load the newest GPS Location Log row per bus"""
+    rows = frappe.db.sql("""
+        SELECT log.bus, log.latitude, log.longitude, log.timestamp
+        FROM `tabGPS Location Log` log
+        INNER JOIN (
+            SELECT bus, MAX(timestamp) AS timestamp
+            FROM `tabGPS Location Log`
+            WHERE bus IN %(buses)s
+            GROUP BY bus
+        ) latest ON latest.bus = log.bus AND latest.timestamp = log.timestamp
+    """, {"buses": bus_ids}, as_dict=True)
+
+    return {
+        row.bus: frappe._dict({
+            "latitude": row.latitude,
+            "longitude": row.longitude,
+            "timestamp": row.timestamp,
+            "speed": None,
+            "heading": None
+        })
+        for row in rows
+    }
+
+def parse_position(raw):
+    """Convert a raw Redis hash into a position dict"""
+    values = {
+        (k.decode() if isinstance(k, bytes) else k): (v.decode() if isinstance(v, bytes) else v)
+        for k, v in raw.items()
+    }
+    return frappe._dict({
+        "latitude": flt(values.get("latitude")),
+        "longitude": flt(values.get("longitude")),
+        "timestamp": get_datetime(values.get("timestamp")),
+        "speed": flt(values["speed"]) if values.get("speed") else None,
+        "heading": flt(values["heading"]) if values.get("heading") else None
+    })
+
+def calculate_bearing(lat1, lng1, lat2, lng2):
+    """Initial bearing in degrees from the first point to the second"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    delta_lng = math.radians(lng2 - lng1)
+
+    x = math.sin(delta_lng) * math.cos(phi2)
+    y = math.cos(phi1) * math.sin(phi2) - math.sin(phi1) * math.cos(phi2) * math.cos(delta_lng)
+
+    return (math.degrees(math.atan2(x, y)) + 360) % 360
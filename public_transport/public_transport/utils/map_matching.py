@@ -0,0 +1,129 @@
+import numpy as np
+import frappe
+from .geo import EARTH_RADIUS_KM
+
+# Last matched segment per bus, stored as (route, segment index)
+CURSOR_KEY = "bus_match_cursor"
+
+# Segments tested around the cursor before falling back to the whole route
+CURSOR_WINDOW = 2
+
+class RouteSegments:
+    """A route polyline projected onto a local plane (km).
+
+    Uses an equirectangular projection centred on the route, which is
+    accurate to well under a metre per kilometre at route scale.
+    """
+
+    def __init__(self, geometry):
+        latitudes = np.asarray(geometry.latitudes, dtype=float)
+        longitudes = np.asarray(geometry.longitudes, dtype=float)
+
+        self.origin_latitude = float(latitudes.mean()) if len(latitudes) else 0.0
+        self.scale_x = EARTH_RADIUS_KM * np.radians(1) * np.cos(np.radians(self.origin_latitude))
+        self.scale_y = EARTH_RADIUS_KM * np.radians(1)
+
+        x, y = self.project(latitudes, longitudes)
+        self.start_x, self.start_y = x[:-1], y[:-1]
+        self.delta_x, self.delta_y = x[1:] - x[:-1], y[1:] - y[:-1]
+        self.length_squared = self.delta_x ** 2 + self.delta_y ** 2
+        self.offsets = np.asarray(geometry.cumulative_distances[:-1], dtype=float)
+
+        # Segment bounding boxes for the full-route search
+        self.min_x, self.max_x = np.minimum(x[:-1], x[1:]), np.maximum(x[:-1], x[1:])
+        self.min_y, self.max_y = np.minimum(y[:-1], y[1:]), np.maximum(y[:-1], y[1:])
+
+    def __len__(self):
+        return len(self.start_x)
+
+    def project(self, latitudes, longitudes):
+        return np.asarray(longitudes, dtype=float) * self.scale_x, np.asarray(latitudes, dtype=float) * self.scale_y
+
+    def distances(self, x, y, segments):
+        """Perpendicular (clamped) distance from a point to each given segment"""
+        dx, dy = self.delta_x[segments], self.delta_y[segments]
+        px, py = x - self.start_x[segments], y - self.start_y[segments]
+
+        length_squared = self.length_squared[segments]
+        t = np.divide(
+            px * dx + py * dy, length_squared,
+            out=np.zeros(np.broadcast(px, length_squared).shape), where=length_squared > 0
+        )
+        t = np.clip(t, 0, 1)
+
+        return np.hypot(px - t * dx, py - t * dy), t
+
+    def nearest(self, latitudes, longitudes):
+        """Cross-track distance (km), nearest segment and distance along the route (km) for many points"""
+        x, y = self.project(latitudes, longitudes)
+        distances, t = self.distances(x[:, None], y[:, None], np.arange(len(self)))
+
+        rows = np.arange(len(distances))
+        segments = distances.argmin(axis=1)
+        along = self.offsets[segments] + t[rows, segments] * np.sqrt(self.length_squared[segments])
+
+        return distances[rows, segments], segments, along
+
+    def candidates(self, x, y, tolerance):
+        """Segments whose bounding box, grown by tolerance, contains the point"""
+        return np.nonzero(
+            (self.min_x - tolerance <= x) & (x <= self.max_x + tolerance)
+            & (self.min_y - tolerance <= y) & (y <= self.max_y + tolerance)
+        )[0]
+
+def get_route_segments(geometry):
+    """Projected segments for a compiled geometry, built once per geometry"""
+    segments = getattr(geometry, "_segments", None)
+    if segments is None:
+        segments = RouteSegments(geometry)
+        geometry._segments = segments
+    return segments
+
+def match_to_route(geometry, latitude, longitude, tolerance, cursor=None):
+    """Match a fix to a route polyline.
+
+    Tests the segments around `cursor` first; only when none of them is
+    within `tolerance` km are the remaining segments searched, prefiltered
+    by bounding box. Returns {segment, distance, along} where distance is
+    the cross-track distance (km) and along the distance covered along the
+    route (km), or None for routes with fewer than two stops.
+    """
+    segments = get_route_segments(geometry)
+    if not len(segments):
+        return None
+
+    x, y = segments.project(latitude, longitude)
+
+    if cursor is not None and 0 <= cursor < len(segments):
+        window = np.arange(max(cursor - 1, 0), min(cursor + CURSOR_WINDOW + 1, len(segments)))
+        match = _best_match(segments, x, y, window)
+        if match.distance <= tolerance:
+            return match
+
+    candidates = segments.candidates(x, y, tolerance)
+    if not len(candidates):
+        # Off route everywhere: measure against the whole polyline
+        candidates = np.arange(len(segments))
+
+    return _best_match(segments, x, y, candidates)
+
+def _best_match(segments, x, y, indexes):
+    distances, t = segments.distances(x, y, indexes)
+    best = int(distances.argmin())
+    segment = int(indexes[best])
+
+    return frappe._dict({
+        "segment": segment,
+        "distance": float(distances[best]),
+        "along": float(segments.offsets[segment] + t[best] * np.sqrt(segments.length_squared[segment]))
+    })
+
+def get_cursor(bus_id, route):
+    """Last matched segment for a bus on a route"""
+    cursor = frappe.cache().hget(CURSOR_KEY, bus_id)
+    if cursor and cursor[0] == route:
+        return cursor[1]
+    return None
+
+def set_cursor(bus_id, route, segment):
+    frappe.cache().hset(CURSOR_KEY, bus_id, (route, segment))
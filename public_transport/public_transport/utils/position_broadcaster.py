@@ -0,0 +1,139 @@
+import json
+import time
+import frappe
+from .viewport_grid import group_by_viewer
+from .subscriber_registry import get_followed_buses, get_followers
+from ..doctype.gps_tracking_settings.gps_tracking_settings import read_tracking_settings
+
+# Newest unsent position per bus, {bus: JSON}; later fixes overwrite earlier ones
+PENDING_KEY = "position_broadcast:pending"
+
+# Newest full position published per bus, {bus: JSON}, handed to new followers
+LAST_SENT_KEY = "position_broadcast:last"
+
+# Fields sent with every update; the rest only when they change
+ALWAYS_SENT = ("bus", "lat", "lng", "ts")
+
+# Followers get every field at least this often, so a missed delta heals
+FULL_STATE_SECONDS = 30
+
+# What this broadcaster last sent per bus, so later updates can be deltas,
+# and when it last sent each bus in full
+_last_sent = {}
+_full_sent = {}
+
+def queue_position(bus_id, latitude, longitude, timestamp, speed=None, heading=None, deviation=None):
+    """Record a bus's newest position for the next flush (O(1), no publish)"""
+    payload = {
+        "bus": bus_id,
+        "lat": round(float(latitude), 6),
+        "lng": round(float(longitude), 6),
+        "ts": str(timestamp),
+        "spd": round(float(speed), 1) if speed is not None else None,
+        "hdg": round(float(heading)) if heading is not None else None,
+        "dev": deviation
+    }
+
+    pipe = frappe.cache().pipeline()
+    pipe.hset(PENDING_KEY, bus_id, json.dumps(payload, separators=(",", ":")))
+    pipe.execute()
+
+def run_position_broadcaster():
+    """Flush queued positions every broadcast_interval seconds, forever.
+
+    Runs in its own long-lived process (bench run-position-broadcaster),
+    so it never holds a scheduler worker and its delta state survives
+    between flushes.
+    """
+    while True:
+        flush_started = time.monotonic()
+        try:
+            flush_positions()
+        except Exception:
+            frappe.log_error(title="Position broadcast failed")
+
+        # A fresh transaction, so an interval saved since the last flush is seen
+        frappe.db.rollback()
+        interval = read_tracking_settings().broadcast_interval or 2
+        time.sleep(max(interval - (time.monotonic() - flush_started), 0))
+
+def flush_positions():
+    """Publish the latest position of every bus that moved to the users watching it.
+
+    Users following a bus get a bus_location delta. Users with a map
+    viewport get one bus_positions event listing the buses in the tiles
+    they cover. Buses nobody watches are dropped without publishing.
+    Returns the number of buses published to followers.
+    """
+    # Take and clear the pending positions in one transaction
+    pipe = frappe.cache().pipeline()
+    pipe.hgetall(PENDING_KEY)
+    pipe.delete(PENDING_KEY)
+    pending = pipe.execute()[0]
+    if not pending:
+        return 0
+
+    positions = {
+        (bus.decode() if isinstance(bus, bytes) else bus): json.loads(raw)
+        for bus, raw in pending.items()
+    }
+
+    pipe = frappe.cache().pipeline()
+    pipe.hset(LAST_SENT_KEY, mapping={bus: json.dumps(payload, separators=(",", ":")) for bus, payload in positions.items()})
+    pipe.execute()
+
+    publish_to_viewports(positions)
+    return publish_to_followers(positions)
+
+def get_last_position(bus_id):
+    """Newest full position published for a bus, or None"""
+    pipe = frappe.cache().pipeline()
+    pipe.hget(LAST_SENT_KEY, bus_id)
+    raw = pipe.execute()[0]
+    return json.loads(raw) if raw else None
+
+def publish_to_followers(positions):
+    """Send bus_location deltas to the live followers of each bus"""
+    followed = [bus for bus in get_followed_buses() if bus in positions]
+    if not followed:
+        return 0
+
+    followers = get_followers(followed)
+    for bus, users in followers.items():
+        update = compact_update(bus, positions[bus])
+        for user in users:
+            frappe.publish_realtime("bus_location", update, user=user)
+
+    return len(followers)
+
+def publish_to_viewports(positions):
+    """Send every viewport subscriber the buses inside its tiles as one event"""
+    for user, payloads in group_by_viewer(positions).items():
+        frappe.publish_realtime(
+            "bus_positions",
+            {"buses": [
+                {key: value for key, value in payload.items() if value is not None}
+                for payload in payloads
+            ]},
+            user=user
+        )
+
+def compact_update(bus, payload):
+    """The payload without optional fields unchanged since the last send.
+
+    A field that became None is sent as null so clients clear it. Every
+    FULL_STATE_SECONDS the whole payload goes out instead.
+    """
+    now = time.monotonic()
+    if bus not in _last_sent or now - _full_sent.get(bus, 0) >= FULL_STATE_SECONDS:
+        _last_sent[bus] = payload
+        _full_sent[bus] = now
+        return dict(payload)
+
+    previous = _last_sent[bus]
+    update = {
+        key: value for key, value in payload.items()
+        if key in ALWAYS_SENT or previous.get(key) != value
+    }
+    _last_sent[bus] = payload
+    return update
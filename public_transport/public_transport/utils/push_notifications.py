@@ -3,6 +3,7 @@ from frappe.utils import now_datetime
 import json
 import requests
 from typing import List, Dict, Any, Optional
+from .trip_resolver import active_trip
 
 class PushNotificationManager:
     def __init__(self):
@@ -32,17 +33,9 @@ class PushNotificationManager:
             return
             
         # Get operator for this bus
-        operators = frappe.get_all(
-            "Bus Trip",
-            filters={
-                "bus": bus_id,
-                "departure_time": ["<=", now_datetime()],
-                "arrival_time": [">", now_datetime()]
-            },
-            fields=["bus_operator"]
-        )
+        trip = active_trip(bus_id)
         
-        if not operators:
+        if not trip or not trip.bus_operator:
             return
             
         notification_data = {
@@ -55,7 +48,7 @@ class PushNotificationManager:
             }
         }
         
-        self._send_notification(notification_data, [operators[0].bus_operator])
+        self._send_notification(notification_data, [trip.bus_operator])
     
     def send_weather_notification(self, conditions: Dict[str, Any], affected_routes: List[str]) -> None:
         """Send push notification about weather conditions"""
@@ -67,8 +60,8 @@ class PushNotificationManager:
             "Bus Trip",
             filters={
                 "route": ["in", affected_routes],
-                "departure_time": ["<=", now_datetime()],
-                "arrival_time": [">", now_datetime()]
+                "trip_status": "Running",
+                "docstatus": 1
             },
             fields=["bus_operator"]
         )
@@ -1,13 +1,14 @@
 import frappe
 from frappe.realtime import publish_realtime
+from .seat_reservations import hold_seats, release_seats
 
-def notify_seat_status_change(trip, seat_id, status):
-    """Notify all clients about seat status changes"""
+def notify_seat_changes(trip, seat_ids, status):
+    """Notify all clients about seat status changes, in one event per change"""
     publish_realtime('seat_status_update', {
         'trip': trip,
-        'seat_id': seat_id,
+        'seat_ids': list(seat_ids),
         'status': status
-    })
+    }, after_commit=True)
 
 def notify_booking_confirmation(booking_id):
     """Notify relevant parties about booking confirmation"""
@@ -30,13 +31,8 @@ def notify_booking_confirmation(booking_id):
 
 def lock_seat(trip_id, seat_id, user):
     """Lock a seat temporarily during booking process"""
-    key = f"seat_lock:{trip_id}:{seat_id}"
-    if not frappe.cache().exists(key):
-        frappe.cache().setex(key, 300, user)  # Lock for 5 minutes
-        return True
-    return False
+    return not hold_seats(trip_id, [seat_id], user)
 
 def release_seat_lock(trip_id, seat_id):
     """Release a seat lock"""
-    key = f"seat_lock:{trip_id}:{seat_id}"
-    frappe.cache().delete(key)
\ No newline at end of file
+    release_seats(trip_id, [seat_id])
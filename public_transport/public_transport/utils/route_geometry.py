@@ -0,0 +1,238 @@
+import time
+import numpy as np
+import frappe
+from frappe.utils import flt, cint
+from .geo import haversine_pairwise
+
+# Compiled geometries are shared across workers through this Redis hash
+GEOMETRY_CACHE_KEY = "route_geometry"
+
+# How long a worker trusts its in-process copy before re-reading Redis
+LOCAL_TTL = 30
+
+# Bumped on every route or stop change so workers reload the active route snapshot
+SNAPSHOT_VERSION_KEY = "route_snapshot:version"
+
+_local_geometries = {}
+
+# (version, checked at, {route: RouteGeometry}) for all active routes
+_snapshot = None
+
+class RouteGeometry:
+    """Compiled, read-only geometry of a route.
+
+    Stops are held in sequence order as parallel arrays of coordinates,
+    cumulative distances (km) and scheduled offsets (minutes from the
+    first stop), so positions along the route are found by binary search.
+    Their stored Route Stop sequence numbers are kept alongside.
+    """
+
+    def __init__(self, route, route_name, stops, latitudes, longitudes, cumulative_distances, scheduled_offsets, route_number=None, sequences=None):
+        self.route = route
+        self.route_name = route_name
+        self.stops = stops
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.cumulative_distances = cumulative_distances
+        self.scheduled_offsets = scheduled_offsets
+        self.route_number = route_number
+        self.sequences = sequences
+
+    @property
+    def total_distance(self):
+        return float(self.cumulative_distances[-1]) if len(self.cumulative_distances) else 0
+
+    @property
+    def total_time(self):
+        """Scheduled running time in minutes"""
+        return float(self.scheduled_offsets[-1]) if len(self.scheduled_offsets) else 0
+
+    def interpolate(self, progress):
+        """Position at a fraction (0-1) of the route's length"""
+        if len(self.stops) < 2 or not self.total_distance:
+            return None
+        return self.position_at_distance(self.total_distance * min(max(progress, 0), 1))
+
+    def position_at_distance(self, distance):
+        """Position at a distance (km) along the route"""
+        if distance >= self.total_distance:
+            return {"latitude": float(self.latitudes[-1]), "longitude": float(self.longitudes[-1])}
+
+        # First stop whose cumulative distance reaches the target ends the segment
+        end = max(int(np.searchsorted(self.cumulative_distances, distance)), 1)
+        start = end - 1
+        length = self.cumulative_distances[end] - self.cumulative_distances[start]
+        fraction = (distance - self.cumulative_distances[start]) / length if length else 0
+
+        return {
+            "latitude": float(self.latitudes[start] + (self.latitudes[end] - self.latitudes[start]) * fraction),
+            "longitude": float(self.longitudes[start] + (self.longitudes[end] - self.longitudes[start]) * fraction)
+        }
+
+    def as_dict(self):
+        return {
+            "route": self.route,
+            "route_name": self.route_name,
+            "stops": self.stops,
+            "latitudes": self.latitudes,
+            "longitudes": self.longitudes,
+            "cumulative_distances": self.cumulative_distances,
+            "scheduled_offsets": self.scheduled_offsets,
+            "route_number": self.route_number,
+            "sequences": self.sequences
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+def get_route_geometry(route):
+    """Get a route's compiled geometry from process memory, Redis or the database"""
+    cached = _local_geometries.get(route)
+    if cached and time.monotonic() - cached[1] < LOCAL_TTL:
+        return cached[0]
+
+    data = frappe.cache().hget(GEOMETRY_CACHE_KEY, route)
+    # Geometries cached before sequences were compiled in are rebuilt
+    if data and data.get("sequences") is not None:
+        geometry = RouteGeometry.from_dict(data)
+    else:
+        geometry = build_route_geometry(route)
+        frappe.cache().hset(GEOMETRY_CACHE_KEY, route, geometry.as_dict())
+
+    _local_geometries[route] = (geometry, time.monotonic())
+    return geometry
+
+def build_route_geometry(route):
+    """Compile a route's geometry with a single joined query"""
+    rows = frappe.db.sql("""
+        SELECT rs.stop, rs.sequence, rs.estimated_time_from_previous, bs.latitude, bs.longitude
+        FROM `tabRoute Stop` rs
+        INNER JOIN `tabBus Stop` bs ON bs.name = rs.stop
+        WHERE rs.parent = %s AND rs.parenttype = 'Route'
+        ORDER BY rs.idx
+    """, (route,), as_dict=True)
+
+    route_name, route_number = frappe.db.get_value("Route", route, ["route_name", "route_number"]) or (None, None)
+    return compile_route_geometry(route, route_name, rows, route_number)
+
+def compile_route_geometry(route, route_name, rows, route_number=None):
+    """Build a RouteGeometry from a route's stop rows in sequence order"""
+    stops = [row.stop for row in rows]
+    latitudes = np.array([flt(row.latitude) for row in rows], dtype=float)
+    longitudes = np.array([flt(row.longitude) for row in rows], dtype=float)
+
+    cumulative_distances = np.concatenate(([0.0], np.cumsum(haversine_pairwise(latitudes, longitudes)))) if rows else np.zeros(0)
+
+    # Route.calculate_route_metrics stores each segment's time on its starting stop
+    segment_times = [cint(row.estimated_time_from_previous) for row in rows[:-1]]
+    scheduled_offsets = np.concatenate(([0.0], np.cumsum(segment_times, dtype=float))) if rows else np.zeros(0)
+
+    return RouteGeometry(
+        route,
+        route_name,
+        stops,
+        latitudes,
+        longitudes,
+        cumulative_distances,
+        scheduled_offsets,
+        route_number,
+        [cint(row.sequence) for row in rows]
+    )
+
+def invalidate_route_geometry(route):
+    """Drop a route's compiled geometry from Redis and this process"""
+    global _snapshot
+
+    frappe.cache().hdel(GEOMETRY_CACHE_KEY, route)
+    _local_geometries.pop(route, None)
+
+    # Every worker rebuilds its active route snapshot on the next read
+    pipe = frappe.cache().pipeline()
+    pipe.incr(SNAPSHOT_VERSION_KEY)
+    pipe.execute()
+    _snapshot = None
+
+def get_active_routes():
+    """Geometry of every active route as {route: RouteGeometry}.
+
+    Loaded with one joined query and kept in process memory; the shared
+    version counter is checked at most every LOCAL_TTL seconds. Treat the
+    result as read-only.
+    """
+    global _snapshot
+
+    if _snapshot and time.monotonic() - _snapshot[1] < LOCAL_TTL:
+        return _snapshot[2]
+
+    pipe = frappe.cache().pipeline()
+    pipe.get(SNAPSHOT_VERSION_KEY)
+    version = cint(pipe.execute()[0])
+
+    if not _snapshot or _snapshot[0] != version:
+        _snapshot = (version, time.monotonic(), load_active_routes())
+    else:
+        _snapshot = (version, time.monotonic(), _snapshot[2])
+    return _snapshot[2]
+
+def load_active_routes():
+    """Compile every active route's geometry from a single joined query"""
+    rows = frappe.db.sql("""
+        SELECT r.name AS route, r.route_name, r.route_number,
+            rs.stop, rs.sequence, rs.estimated_time_from_previous, bs.latitude, bs.longitude
+        FROM `tabRoute` r
+        INNER JOIN `tabRoute Stop` rs ON rs.parent = r.name AND rs.parenttype = 'Route'
+        INNER JOIN `tabBus Stop` bs ON bs.name = rs.stop
+        WHERE r.status = 'Active'
+        ORDER BY r.name, rs.idx
+    """, as_dict=True)
+
+    return compile_route_geometries(rows)
+
+def compile_route_geometries(rows):
+    """Group joined rows (ordered by route, then sequence) into geometries.
+
+    Distances and scheduled offsets are accumulated over all rows at once
+    and rebased at each route's first stop.
+    """
+    if not rows:
+        return {}
+
+    # Item access: attribute access on thousands of _dict rows dominates otherwise
+    names = [row["route"] for row in rows]
+    latitudes = np.array([row["latitude"] or 0 for row in rows], dtype=float)
+    longitudes = np.array([row["longitude"] or 0 for row in rows], dtype=float)
+    segment_times = np.array([row["estimated_time_from_previous"] or 0 for row in rows[:-1]], dtype=float)
+
+    cumulative_distances = np.concatenate(([0.0], np.cumsum(haversine_pairwise(latitudes, longitudes))))
+    scheduled_offsets = np.concatenate(([0.0], np.cumsum(segment_times)))
+
+    starts = [0] + [i for i in range(1, len(names)) if names[i] != names[i - 1]]
+
+    routes = {}
+    for start, end in zip(starts, starts[1:] + [len(rows)]):
+        first = rows[start]
+        routes[names[start]] = RouteGeometry(
+            names[start],
+            first["route_name"],
+            [row["stop"] for row in rows[start:end]],
+            latitudes[start:end].copy(),
+            longitudes[start:end].copy(),
+            cumulative_distances[start:end] - cumulative_distances[start],
+            scheduled_offsets[start:end] - scheduled_offsets[start],
+            first["route_number"],
+            [cint(row["sequence"]) for row in rows[start:end]]
+        )
+    return routes
+
+def get_stop_coordinates(stops):
+    """Load {stop: (latitude, longitude)} for many stops with one query"""
+    if not stops:
+        return {}
+
+    rows = frappe.get_all(
+        "Bus Stop",
+        filters={"name": ["in", list(set(stops))]},
+        fields=["name", "latitude", "longitude"]
+    )
+    return {row.name: (flt(row.latitude), flt(row.longitude)) for row in rows}
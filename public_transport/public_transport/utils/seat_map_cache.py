@@ -0,0 +1,117 @@
+import json
+import frappe
+from .seat_reservations import (
+    SEAT_COUNTS_KEY, SEAT_STATE_KEY, SEAT_CHANGES_KEY, SEAT_LAYOUT_KEY, SEAT_LAYOUT_GENERATION_KEY,
+    SEAT_STATE_TTL, SEAT_CHANGES_KEPT,
+    sync_trip_seats, get_script, decode
+)
+
+# Caches a layout read from the database, unless the layout was invalidated
+# since the reader took the generation, i.e. the rows it read may be stale.
+#   KEYS: layout, generation
+#   ARGV: layout JSON, generation read before the rows, ttl
+CACHE_LAYOUT_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[2] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+return 1
+"""
+
+def get_seat_layout(trip_id):
+    """A trip's static seat layout, cached until its seat map is edited"""
+    pipe = frappe.cache().pipeline()
+    pipe.get(SEAT_LAYOUT_KEY.format(trip_id))
+    pipe.get(SEAT_LAYOUT_GENERATION_KEY.format(trip_id))
+    raw, generation = pipe.execute()
+    if raw:
+        return json.loads(raw)
+
+    if not frappe.db.get_value("Bus Trip", trip_id, "long_trip_limited_seat"):
+        frappe.throw("This trip does not have a seat map")
+
+    layout = [
+        {
+            "seat_id": seat.seat_id,
+            "price": seat.price,
+            "row": seat.row_identifier,
+            "column": seat.column_identifier,
+            "side": seat.side
+        }
+        for seat in frappe.get_all(
+            "Seat Map",
+            filters={"parent": trip_id, "parenttype": "Bus Trip"},
+            fields=["seat_id", "price", "row_identifier", "column_identifier", "side"],
+            order_by="idx asc"
+        )
+    ]
+
+    get_script(CACHE_LAYOUT_SCRIPT)(
+        keys=[SEAT_LAYOUT_KEY.format(trip_id), SEAT_LAYOUT_GENERATION_KEY.format(trip_id)],
+        args=[json.dumps(layout, default=str), decode(generation) or "0", SEAT_STATE_TTL]
+    )
+    return layout
+
+def invalidate_seat_layout(trip_id):
+    """Drop a trip's cached layout; readers that loaded the old rows can no longer cache them"""
+    generation_key = SEAT_LAYOUT_GENERATION_KEY.format(trip_id)
+    pipe = frappe.cache().pipeline()
+    pipe.incr(generation_key)
+    pipe.expire(generation_key, SEAT_STATE_TTL)
+    pipe.delete(SEAT_LAYOUT_KEY.format(trip_id))
+    pipe.execute()
+
+def get_seat_snapshot(trip_id, since_version=None):
+    """A trip's seat version with its layout and status vector, or only the changes since since_version.
+
+    The status vector has one character per layout seat: A(vailable),
+    H(eld), B(ooked) or X (blocked); changes are [seat index, character]
+    pairs. The version, states and change log are read in one
+    transaction, so they always agree.
+    """
+    layout = get_seat_layout(trip_id)
+    seat_ids = [seat["seat_id"] for seat in layout]
+
+    snapshot = read_seat_snapshot(trip_id, seat_ids)
+    if snapshot is None:
+        sync_trip_seats(trip_id)
+        snapshot = read_seat_snapshot(trip_id, seat_ids)
+    version, floor, states, log = snapshot
+
+    # A full log may have lost the older entries of its oldest version
+    if len(log) >= SEAT_CHANGES_KEPT:
+        floor = max(floor, int(log[0].split("|", 1)[0]))
+
+    if since_version is not None and floor <= since_version <= version:
+        # Later entries overwrite earlier ones, so each seat keeps its newest state
+        positions = {seat_id: index for index, seat_id in enumerate(seat_ids)}
+        changes = {}
+        for entry in log:
+            entry_version, seat_id, state = entry.split("|", 2)
+            if int(entry_version) > since_version and seat_id in positions:
+                changes[positions[seat_id]] = state
+        return frappe._dict(version=version, changes=sorted(changes.items()))
+
+    status = "".join(state[:1] if state else "X" for state in states)
+    return frappe._dict(version=version, layout=layout, status=status)
+
+def read_seat_snapshot(trip_id, seat_ids):
+    """(version, floor, states, change log) of a loaded trip; None when not loaded"""
+    pipe = frappe.cache().pipeline()
+    pipe.hmget(SEAT_COUNTS_KEY.format(trip_id), "V", "F")
+    pipe.lrange(SEAT_CHANGES_KEY.format(trip_id), 0, -1)
+    if seat_ids:
+        pipe.hmget(SEAT_STATE_KEY.format(trip_id), seat_ids)
+    results = pipe.execute()
+
+    version, floor = results[0]
+    if version is None:
+        return None
+
+    states = results[2] if seat_ids else []
+    return (
+        int(version),
+        int(floor or version),
+        [decode(state) for state in states],
+        [decode(entry) for entry in results[1]]
+    )
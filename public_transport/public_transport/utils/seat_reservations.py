@@ -0,0 +1,586 @@
+import time
+import frappe
+
+# Seat states of a trip, {seat_id: state}, where a state is
+#   A                         available
+#   B                         booked
+#   X                         blocked
+#   H|<holder>|<expires ms>   held; available again once expired
+SEAT_STATE_KEY = "seat_state:{}"
+
+# Field marking a trip's seat hash as loaded from its Seat Map rows
+LOADED_FIELD = "_loaded"
+
+# Number of a trip's seats in each state, {A|H|B|X: count}, kept by the scripts
+# below, with the trip's seat version V and F, the oldest version the change
+# log can bring a client forward from
+SEAT_COUNTS_KEY = "seat_counts:{}"
+
+# Recent seat changes of a trip, "version|seat|A|H|B|X", oldest first
+SEAT_CHANGES_KEY = "seat_changes:{}"
+
+# Entries the change log is trimmed to (the scripts' LTRIM)
+SEAT_CHANGES_KEPT = 256
+
+# Seats a trip currently holds, scored by when each hold expires in ms
+SEAT_HOLDS_KEY = "seat_holds:{}"
+
+# Trips with holds, scored by their earliest hold expiry in ms
+HELD_TRIPS_KEY = "seat_holds:trips"
+
+# Cached seat layout of a trip, as JSON
+SEAT_LAYOUT_KEY = "seat_layout:{}"
+
+# Bumped by every invalidation of a trip's cached layout
+SEAT_LAYOUT_GENERATION_KEY = "seat_layout_generation:{}"
+
+# Seats of a trip the last reconciliation found booked or blocked here but
+# available in Seat Map; freed only when the next run finds them again
+SEAT_DRIFT_KEY = "seat_drift:{}"
+SEAT_DRIFT_TTL = 3600
+
+# Seat hashes of trips nobody touches drop out and are reloaded on demand
+SEAT_STATE_TTL = 7 * 86400
+
+# How long a hold keeps a seat from other bookings
+HOLD_SECONDS = 300
+
+DB_STATES = {"Available": "A", "Booked": "B", "Blocked": "X"}
+STATE_NAMES = {"A": "Available", "B": "Booked", "X": "Blocked", "H": "Held"}
+
+# Start of the scripts that change holds: files a trip in the held trips
+# index under its earliest hold, or takes it out when it has none left
+#   KEYS: seat hash, seat counts, change log, hold expiries, held trips
+INDEX_TRIP_LUA = """
+local function index_trip(trip)
+    local first = redis.call('ZRANGE', KEYS[4], 0, 0, 'WITHSCORES')
+    if #first > 0 then
+        redis.call('ZADD', KEYS[5], first[2], trip)
+    else
+        redis.call('ZREM', KEYS[5], trip)
+    end
+end
+"""
+
+# Applies one operation to a set of seats all-or-nothing. Returns -1 when the
+# trip is not loaded, otherwise a flat [seat, reason, ...] list of conflicts;
+# nothing is written unless that list is empty. Seats changing state adjust
+# the counts, bump the version and are appended to the last 256 changes,
+# and the hold expiries follow the seats' holds.
+#   KEYS: seat hash, seat counts, change log, hold expiries, held trips
+#   ARGV: operation, holder, now ms, expires ms, ttl, trip, seat...
+SEAT_OPERATION_SCRIPT = INDEX_TRIP_LUA + """
+if redis.call('HEXISTS', KEYS[1], '_loaded') == 0 then
+    return -1
+end
+
+local op, holder, now, expires = ARGV[1], ARGV[2], tonumber(ARGV[3]), ARGV[4]
+local conflicts, changes, moved = {}, {}, {}
+
+local function change(seat, state, new_state)
+    table.insert(changes, seat)
+    table.insert(changes, new_state)
+    local from, to = string.sub(state, 1, 1), string.sub(new_state, 1, 1)
+    if from ~= to then
+        table.insert(moved, {seat, from, to})
+    end
+end
+
+for i = 7, #ARGV do
+    local seat = ARGV[i]
+    local state = redis.call('HGET', KEYS[1], seat)
+    local owner, held_until = nil, nil
+    if state then
+        owner, held_until = string.match(state, '^H|(.*)|(%d+)$')
+    end
+    local mine = owner == holder
+    local free = state == 'A' or (owner ~= nil and tonumber(held_until) <= now)
+
+    local reason = nil
+    if not state then
+        reason = 'unknown'
+    elseif op == 'hold' then
+        if not (free or mine) then
+            reason = owner and 'held' or (state == 'B' and 'booked' or 'blocked')
+        end
+        change(seat, state, 'H|' .. holder .. '|' .. expires)
+    elseif op == 'extend' or op == 'confirm' then
+        -- A lapsed hold can still be used while nobody else has taken the seat
+        if not mine then
+            reason = 'not_held'
+        end
+        change(seat, state, op == 'confirm' and 'B' or ('H|' .. holder .. '|' .. expires))
+    elseif op == 'release' then
+        if mine or (holder == '' and owner) then
+            change(seat, state, 'A')
+        end
+    elseif op == 'free' then
+        change(seat, state, 'A')
+    end
+
+    if reason then
+        table.insert(conflicts, seat)
+        table.insert(conflicts, reason)
+    end
+end
+
+if #conflicts == 0 and #changes > 0 then
+    redis.call('HSET', KEYS[1], unpack(changes))
+    if #moved > 0 then
+        local version = redis.call('HINCRBY', KEYS[2], 'V', 1)
+        for _, m in ipairs(moved) do
+            redis.call('HINCRBY', KEYS[2], m[2], -1)
+            redis.call('HINCRBY', KEYS[2], m[3], 1)
+            redis.call('RPUSH', KEYS[3], version .. '|' .. m[1] .. '|' .. m[3])
+        end
+        redis.call('LTRIM', KEYS[3], -256, -1)
+    end
+    for i = 1, #changes, 2 do
+        if string.sub(changes[i + 1], 1, 1) == 'H' then
+            redis.call('ZADD', KEYS[4], expires, changes[i])
+        else
+            redis.call('ZREM', KEYS[4], changes[i])
+        end
+    end
+    index_trip(ARGV[6])
+    for i = 1, 4 do
+        redis.call('EXPIRE', KEYS[i], ARGV[5])
+    end
+end
+return conflicts
+"""
+
+# Brings a loaded trip's seats in line with its Seat Map rows and recounts
+# them. Booked and blocked rows win at once. A seat booked or blocked here
+# but available in its row is freed only when it is in the drift set, i.e.
+# the previous run saw the same, so a submit between its confirm and its
+# commit is left alone; the seats seen for the first time become the new
+# drift set. Corrections are one version in the change log, so clients
+# catch up with a delta. Returns nil when the trip is not loaded, {1} when
+# the seats no longer match the layout and the trip needs a reload, and
+# otherwise {0, seat, state, ...} for the seats corrected.
+#   KEYS: seat hash, seat counts, change log, hold expiries, held trips, drift
+#   ARGV: ttl, trip, drift ttl, seat, state, seat, state...
+RECONCILE_SCRIPT = INDEX_TRIP_LUA + """
+if redis.call('HEXISTS', KEYS[1], '_loaded') == 0 then
+    return nil
+end
+if redis.call('HLEN', KEYS[1]) ~= (#ARGV - 3) / 2 + 1 then
+    return {1}
+end
+
+local drifted = {}
+for _, seat in ipairs(redis.call('SMEMBERS', KEYS[6])) do
+    drifted[seat] = true
+end
+
+local changes, drifting = {}, {}
+for i = 4, #ARGV, 2 do
+    local seat, state = ARGV[i], ARGV[i + 1]
+    local current = redis.call('HGET', KEYS[1], seat)
+    if not current then
+        return {1}
+    end
+    local class = string.sub(current, 1, 1)
+    if state ~= 'A' and class ~= state then
+        table.insert(changes, {seat, state})
+    elseif state == 'A' and (class == 'B' or class == 'X') then
+        if drifted[seat] then
+            table.insert(changes, {seat, 'A'})
+        else
+            table.insert(drifting, seat)
+        end
+    end
+end
+
+local corrected = {0}
+if #changes > 0 then
+    local version = redis.call('HINCRBY', KEYS[2], 'V', 1)
+    for _, c in ipairs(changes) do
+        redis.call('HSET', KEYS[1], c[1], c[2])
+        redis.call('ZREM', KEYS[4], c[1])
+        redis.call('RPUSH', KEYS[3], version .. '|' .. c[1] .. '|' .. c[2])
+        table.insert(corrected, c[1])
+        table.insert(corrected, c[2])
+    end
+    redis.call('LTRIM', KEYS[3], -256, -1)
+    redis.call('EXPIRE', KEYS[3], ARGV[1])
+    index_trip(ARGV[2])
+end
+
+redis.call('DEL', KEYS[6])
+if #drifting > 0 then
+    redis.call('SADD', KEYS[6], unpack(drifting))
+    redis.call('EXPIRE', KEYS[6], ARGV[3])
+end
+
+local counts = {A = 0, H = 0, B = 0, X = 0}
+local seats = redis.call('HGETALL', KEYS[1])
+for i = 1, #seats, 2 do
+    if seats[i] ~= '_loaded' then
+        local class = string.sub(seats[i + 1], 1, 1)
+        counts[class] = counts[class] + 1
+    end
+end
+redis.call('HSET', KEYS[2], 'A', counts.A, 'H', counts.H, 'B', counts.B, 'X', counts.X)
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return corrected
+"""
+
+# Turns a trip's expired holds back into available seats, as one version.
+# Returns the released seats. Holds are found through the hold expiries, so
+# only the seats that lapsed are read.
+#   KEYS: seat hash, seat counts, change log, hold expiries, held trips
+#   ARGV: ttl, now ms, trip
+EXPIRE_HOLDS_SCRIPT = INDEX_TRIP_LUA + """
+local now = tonumber(ARGV[2])
+if redis.call('HEXISTS', KEYS[1], '_loaded') == 0 then
+    redis.call('DEL', KEYS[4])
+    index_trip(ARGV[3])
+    return {}
+end
+
+local released, version = {}, nil
+for _, seat in ipairs(redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', now)) do
+    redis.call('ZREM', KEYS[4], seat)
+    local state = redis.call('HGET', KEYS[1], seat)
+    local held_until = state and tonumber(string.match(state, '^H|.*|(%d+)$'))
+    if held_until and held_until <= now then
+        version = version or redis.call('HINCRBY', KEYS[2], 'V', 1)
+        redis.call('HSET', KEYS[1], seat, 'A')
+        redis.call('HINCRBY', KEYS[2], 'H', -1)
+        redis.call('HINCRBY', KEYS[2], 'A', 1)
+        redis.call('RPUSH', KEYS[3], version .. '|' .. seat .. '|A')
+        table.insert(released, seat)
+    elseif held_until then
+        redis.call('ZADD', KEYS[4], held_until, seat)
+    end
+end
+
+if version then
+    redis.call('LTRIM', KEYS[3], -256, -1)
+    redis.call('EXPIRE', KEYS[3], ARGV[1])
+end
+index_trip(ARGV[3])
+return released
+"""
+
+# Loads or refreshes a trip's seats from its Seat Map rows. Booked and blocked
+# rows always win; rows marked available never undo a live hold or a booking
+# confirmed here but not yet written back, which takes free_seats or
+# reconciliation (RECONCILE_SCRIPT). Seats no
+# longer in the layout go. The counts are rebuilt and the version bumped
+# past every client's, starting from the clock when the trip is first
+# loaded, and the change log is cleared. The hold expiries are rebuilt from
+# the holds that remain.
+#   KEYS: seat hash, seat counts, change log, hold expiries, held trips
+#   ARGV: ttl, now seconds, trip, seat, state, seat, state...
+SYNC_SCRIPT = INDEX_TRIP_LUA + """
+local layout = {}
+for i = 4, #ARGV, 2 do
+    local seat, state = ARGV[i], ARGV[i + 1]
+    layout[seat] = true
+    local current = redis.call('HGET', KEYS[1], seat)
+    if state ~= 'A' or not current or current == 'X' then
+        redis.call('HSET', KEYS[1], seat, state)
+    end
+end
+
+for _, seat in ipairs(redis.call('HKEYS', KEYS[1])) do
+    if seat ~= '_loaded' and not layout[seat] then
+        redis.call('HDEL', KEYS[1], seat)
+    end
+end
+
+redis.call('HSET', KEYS[1], '_loaded', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+
+local counts = {A = 0, H = 0, B = 0, X = 0}
+redis.call('DEL', KEYS[4])
+for seat in pairs(layout) do
+    local state = redis.call('HGET', KEYS[1], seat)
+    local class = string.sub(state, 1, 1)
+    counts[class] = counts[class] + 1
+    if class == 'H' then
+        redis.call('ZADD', KEYS[4], string.match(state, '|(%d+)$'), seat)
+    end
+end
+redis.call('EXPIRE', KEYS[4], ARGV[1])
+index_trip(ARGV[3])
+
+redis.call('HSETNX', KEYS[2], 'V', ARGV[2])
+local version = redis.call('HINCRBY', KEYS[2], 'V', 1)
+redis.call('HSET', KEYS[2], 'A', counts.A, 'H', counts.H, 'B', counts.B, 'X', counts.X, 'F', version)
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+redis.call('DEL', KEYS[3])
+return 1
+"""
+
+_scripts = {}
+
+def get_script(source):
+    if source not in _scripts:
+        _scripts[source] = frappe.cache().register_script(source)
+    return _scripts[source]
+
+def seat_keys(trip_id):
+    """A trip's own keys: seat hash, seat counts, change log and hold expiries"""
+    return [
+        SEAT_STATE_KEY.format(trip_id), SEAT_COUNTS_KEY.format(trip_id),
+        SEAT_CHANGES_KEY.format(trip_id), SEAT_HOLDS_KEY.format(trip_id)
+    ]
+
+def script_keys(trip_id):
+    return seat_keys(trip_id) + [HELD_TRIPS_KEY]
+
+def hold_seats(trip_id, seat_ids, holder, seconds=HOLD_SECONDS):
+    """Hold every seat for holder, or none of them.
+
+    Seats the holder already holds are renewed. Returns {seat: reason} for
+    the seats that could not be held, empty on success.
+    """
+    return apply_operation("hold", trip_id, seat_ids, holder, seconds)
+
+def extend_hold(trip_id, seat_ids, holder, seconds=HOLD_SECONDS):
+    """Push out the expiry of seats holder still holds"""
+    return apply_operation("extend", trip_id, seat_ids, holder, seconds)
+
+def confirm_seats(trip_id, seat_ids, holder):
+    """Turn holder's holds into bookings"""
+    return apply_operation("confirm", trip_id, seat_ids, holder)
+
+def release_seats(trip_id, seat_ids, holder=None):
+    """Make seats held by holder, or by anyone when holder is None, available again"""
+    apply_operation("release", trip_id, seat_ids, holder or "")
+
+def free_seats(trip_id, seat_ids):
+    """Make seats available again whatever their state, e.g. when a booking is cancelled"""
+    apply_operation("free", trip_id, seat_ids, "")
+
+def apply_operation(operation, trip_id, seat_ids, holder, seconds=0):
+    seat_ids = list(dict.fromkeys(seat_ids))
+    if not seat_ids:
+        return {}
+
+    now = int(time.time() * 1000)
+    keys = script_keys(trip_id)
+    args = [operation, holder, now, now + int(seconds * 1000), SEAT_STATE_TTL, trip_id] + seat_ids
+
+    script = get_script(SEAT_OPERATION_SCRIPT)
+    result = script(keys=keys, args=args)
+    if result == -1:
+        sync_trip_seats(trip_id)
+        result = script(keys=keys, args=args)
+
+    pairs = [value.decode() if isinstance(value, bytes) else value for value in result]
+    return dict(zip(pairs[::2], pairs[1::2]))
+
+def sync_trip_seats(trip_id, seats=None):
+    """Load a trip's seat states from (seat_id, status) pairs, read from its Seat Map rows by default"""
+    if seats is None:
+        seats = frappe.get_all(
+            "Seat Map",
+            filters={"parent": trip_id, "parenttype": "Bus Trip"},
+            fields=["seat_id", "status"],
+            as_list=True
+        )
+
+    args = [SEAT_STATE_TTL, int(time.time()), trip_id]
+    for seat_id, status in seats:
+        args += [seat_id, DB_STATES.get(status, "X")]
+
+    get_script(SYNC_SCRIPT)(keys=script_keys(trip_id), args=args)
+
+def get_seat_counts(trip_ids):
+    """Available, held, booked and blocked seat counts of many trips, keyed by trip.
+
+    Counts of loaded trips come from one pipelined read; the rest are
+    counted from their Seat Map rows with a single grouped query.
+    """
+    trip_ids = list(trip_ids)
+    pipe = frappe.cache().pipeline()
+    for trip_id in trip_ids:
+        pipe.hmget(SEAT_COUNTS_KEY.format(trip_id), "A", "H", "B", "X")
+
+    counts = {}
+    for trip_id, values in zip(trip_ids, pipe.execute()):
+        if values[0] is not None:
+            counts[trip_id] = make_counts(*(int(value or 0) for value in values))
+
+    missing = [trip_id for trip_id in trip_ids if trip_id not in counts]
+    if missing:
+        counts.update(count_seat_rows(missing))
+
+    return counts
+
+def count_seat_rows(trip_ids):
+    """Seat counts of trips from their Seat Map rows, with one grouped query"""
+    rows = frappe.db.sql("""
+        SELECT parent, status, COUNT(*)
+        FROM `tabSeat Map`
+        WHERE parenttype = 'Bus Trip' AND parent IN %(trips)s
+        GROUP BY parent, status
+    """, {"trips": tuple(trip_ids)})
+
+    by_trip = {trip_id: {} for trip_id in trip_ids}
+    for trip_id, status, count in rows:
+        by_trip[trip_id][status] = count
+
+    return {
+        trip_id: make_counts(
+            statuses.get("Available", 0), 0, statuses.get("Booked", 0), statuses.get("Blocked", 0)
+        )
+        for trip_id, statuses in by_trip.items()
+    }
+
+def make_counts(available, held, booked, blocked):
+    return frappe._dict({"available": available, "held": held, "booked": booked, "blocked": blocked})
+
+def release_expired_holds():
+    """Make the seats of every expired hold available again, {trip: [seat_id]}.
+
+    Trips are found through the held trips index and their lapsed seats
+    through each trip's hold expiries, so nothing is scanned.
+    """
+    now = int(time.time() * 1000)
+    pipe = frappe.cache().pipeline()
+    pipe.zrangebyscore(HELD_TRIPS_KEY, "-inf", now)
+    trips = [decode(trip) for trip in pipe.execute()[0]]
+    if not trips:
+        return {}
+
+    script = get_script(EXPIRE_HOLDS_SCRIPT)
+    pipe = frappe.cache().pipeline()
+    for trip_id in trips:
+        script(keys=script_keys(trip_id), args=[SEAT_STATE_TTL, now, trip_id], client=pipe)
+
+    return {
+        trip_id: [decode(seat) for seat in seats]
+        for trip_id, seats in zip(trips, pipe.execute())
+        if seats
+    }
+
+def reconcile_seat_counts():
+    """Correct drift between the seat engine of upcoming trips and their Seat Map rows.
+
+    Every loaded trip is compared seat by seat and recounted in one
+    pipelined round-trip; see RECONCILE_SCRIPT for which side wins. Trips
+    whose seats no longer match their layout are reloaded. Returns the
+    corrected seats, {trip: {state: [seat_id]}}.
+    """
+    from .realtime_sync import notify_seat_changes
+
+    trips = frappe.get_all(
+        "Bus Trip",
+        filters={
+            "docstatus": 1,
+            "long_trip_limited_seat": 1,
+            "departure_time": [">", frappe.utils.now_datetime()]
+        },
+        pluck="name"
+    )
+    if not trips:
+        return {}
+
+    seats = {trip_id: [] for trip_id in trips}
+    for trip_id, seat_id, status in frappe.get_all(
+        "Seat Map",
+        filters={"parenttype": "Bus Trip", "parent": ["in", trips]},
+        fields=["parent", "seat_id", "status"],
+        as_list=True
+    ):
+        seats[trip_id] += [seat_id, DB_STATES.get(status, "X")]
+
+    script = get_script(RECONCILE_SCRIPT)
+    pipe = frappe.cache().pipeline()
+    for trip_id in trips:
+        keys = script_keys(trip_id) + [SEAT_DRIFT_KEY.format(trip_id)]
+        script(keys=keys, args=[SEAT_STATE_TTL, trip_id, SEAT_DRIFT_TTL] + seats[trip_id], client=pipe)
+
+    corrected, reloaded = {}, []
+    for trip_id, result in zip(trips, pipe.execute()):
+        if not result:
+            continue
+        if result[0]:
+            sync_trip_seats(trip_id)
+            reloaded.append(trip_id)
+            continue
+
+        values = [decode(value) for value in result[1:]]
+        for seat_id, state in zip(values[::2], values[1::2]):
+            corrected.setdefault(trip_id, {}).setdefault(STATE_NAMES[state], []).append(seat_id)
+
+    for trip_id, states in corrected.items():
+        for status, seat_ids in states.items():
+            notify_seat_changes(trip_id, seat_ids, status)
+
+    if corrected or reloaded:
+        frappe.logger("seat_reservations").info(
+            f"Corrected seat states of {len(corrected)} trips and reloaded {len(reloaded)} "
+            f"that drifted from Seat Map: {', '.join(list(corrected) + reloaded)}"
+        )
+
+    return corrected
+
+def book_seat_rows(trip_id, seat_ids):
+    """Flip a trip's Seat Map rows from Available to Booked with one conditional UPDATE.
+
+    Rows another booking already took are left alone, so the number of
+    rows changed, which is returned, tells whether every seat was won.
+    """
+    return flip_seat_rows(trip_id, seat_ids, "Available", "Booked")
+
+def free_seat_rows(trip_id, seat_ids):
+    """Flip a trip's Booked Seat Map rows back to Available, e.g. when a booking is cancelled"""
+    return flip_seat_rows(trip_id, seat_ids, "Booked", "Available")
+
+def flip_seat_rows(trip_id, seat_ids, from_status, to_status):
+    if not seat_ids:
+        return 0
+
+    frappe.db.sql("""
+        UPDATE `tabSeat Map`
+        SET status = %(to_status)s, modified = %(now)s
+        WHERE parenttype = 'Bus Trip'
+            AND parent = %(trip)s
+            AND seat_id IN %(seats)s
+            AND status = %(from_status)s
+    """, {
+        "trip": trip_id, "seats": tuple(seat_ids), "now": frappe.utils.now_datetime(),
+        "from_status": from_status, "to_status": to_status
+    })
+
+    return frappe.db._cursor.rowcount
+
+def get_seat_states(trip_id, seat_ids=None):
+    """Current state name of a trip's seats, or of the given ones, {seat_id: state}"""
+    key = SEAT_STATE_KEY.format(trip_id)
+    pipe = frappe.cache().pipeline()
+    pipe.hexists(key, LOADED_FIELD)
+    pipe.hgetall(key)
+    loaded, raw = pipe.execute()
+
+    if not loaded:
+        sync_trip_seats(trip_id)
+        pipe = frappe.cache().pipeline()
+        pipe.hgetall(key)
+        raw = pipe.execute()[0]
+
+    now = time.time() * 1000
+    states = {}
+    for seat, state in raw.items():
+        seat, state = decode(seat), decode(state)
+        if seat != LOADED_FIELD:
+            states[seat] = parse_state(state, now)
+
+    if seat_ids is not None:
+        return {seat: states.get(seat) for seat in seat_ids}
+    return states
+
+def parse_state(state, now):
+    if state.startswith("H|"):
+        return "Held" if int(state.rsplit("|", 1)[1]) > now else "Available"
+    return STATE_NAMES.get(state, "Blocked")
+
+def decode(value):
+    return value.decode() if isinstance(value, bytes) else value
@@ -0,0 +1,109 @@
+import json
+from datetime import datetime
+import frappe
+from .geo import distance_km
+
+# Rolling speed statistics of every bus in one Redis hash, {bus: JSON}
+SPEED_STATS_KEY = "bus_speed_stats"
+
+# Legs (pairs of consecutive fixes) in the rolling window
+WINDOW_LEGS = 9
+
+# Time constant of the exponentially weighted speed, in seconds
+EWMA_SECONDS = 120
+
+# Below this speed (km/h) a leg counts as standing still
+STATIONARY_SPEED = 2
+
+# Folds one leg into a bus's statistics in a single step, so concurrent fixes
+# of a bus cannot overwrite each other's update. A leg ending no later than
+# the last one folded in is a late duplicate and is skipped.
+#   KEYS: stats hash
+#   ARGV: bus, distance km, elapsed s, leg end, leg start (epoch s),
+#         window legs, EWMA seconds, stationary speed
+UPDATE_SCRIPT = """
+local bus = ARGV[1]
+local distance, elapsed = tonumber(ARGV[2]), tonumber(ARGV[3])
+local ended, started = tonumber(ARGV[4]), tonumber(ARGV[5])
+local speed = distance / (elapsed / 3600)
+
+local raw = redis.call('HGET', KEYS[1], bus)
+local stats
+if raw then
+    stats = cjson.decode(raw)
+    if stats.updated and stats.updated >= ended then
+        return 0
+    end
+else
+    stats = {legs = {}, distance = 0, time = 0, ewma = speed, still = cjson.null}
+end
+
+-- Window sums are adjusted by the leg entering and the one leaving
+table.insert(stats.legs, {distance, elapsed})
+stats.distance = stats.distance + distance
+stats.time = stats.time + elapsed
+if #stats.legs > tonumber(ARGV[6]) then
+    local old = table.remove(stats.legs, 1)
+    stats.distance = stats.distance - old[1]
+    stats.time = stats.time - old[2]
+end
+
+-- Time-aware weight, so irregular reporting intervals are handled
+stats.ewma = stats.ewma + (1 - math.exp(-elapsed / tonumber(ARGV[7]))) * (speed - stats.ewma)
+
+if speed < tonumber(ARGV[8]) then
+    if stats.still == cjson.null then
+        stats.still = started
+    end
+else
+    stats.still = cjson.null
+end
+
+stats.updated = ended
+redis.call('HSET', KEYS[1], bus, cjson.encode(stats))
+return 1
+"""
+
+_scripts = {}
+
+def get_script(source):
+    if source not in _scripts:
+        _scripts[source] = frappe.cache().register_script(source)
+    return _scripts[source]
+
+def update_speed_stats(bus_id, previous, position):
+    """Fold the leg from `previous` to `position` into a bus's rolling statistics in O(1)"""
+    elapsed = (position.timestamp - previous.timestamp).total_seconds()
+    if elapsed <= 0:
+        return
+
+    distance = distance_km((previous.latitude, previous.longitude), (position.latitude, position.longitude))
+    get_script(UPDATE_SCRIPT)(keys=[SPEED_STATS_KEY], args=[
+        bus_id, distance, elapsed, position.timestamp.timestamp(), previous.timestamp.timestamp(),
+        WINDOW_LEGS, EWMA_SECONDS, STATIONARY_SPEED
+    ])
+
+def get_speed_stats():
+    """Rolling speed statistics of every bus, read with one HGETALL"""
+    pipe = frappe.cache().pipeline()
+    pipe.hgetall(SPEED_STATS_KEY)
+
+    return {
+        (bus.decode() if isinstance(bus, bytes) else bus): parse_speed_stats(json.loads(raw))
+        for bus, raw in pipe.execute()[0].items()
+    }
+
+def parse_speed_stats(stats):
+    return frappe._dict({
+        "ewma_speed": stats["ewma"],
+        "window_speed": stats["distance"] / (stats["time"] / 3600) if stats["time"] > 0 else None,
+        "stationary_seconds": stats["updated"] - stats["still"] if stats["still"] else 0,
+        "updated": datetime.fromtimestamp(stats["updated"])
+    })
+
+def clear_speed_stats(bus_ids):
+    if not bus_ids:
+        return
+    pipe = frappe.cache().pipeline()
+    pipe.hdel(SPEED_STATS_KEY, *bus_ids)
+    pipe.execute()
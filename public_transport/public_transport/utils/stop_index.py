@@ -0,0 +1,255 @@
+import json
+import math
+import numpy as np
+import frappe
+from frappe.utils import flt, cint
+from .geo import haversine_one_to_many
+
+# Active stops as {stop: [latitude, longitude, stop_name]} shared across workers
+STOP_COORDINATES_KEY = "bus_stop_index:stops"
+
+# Field of the stop hash holding the version its contents are at; a hash
+# without it has not been seeded from the database
+VERSION_FIELD = "_version"
+
+# Incremented on every stop change; workers compare it with their copy
+VERSION_KEY = "bus_stop_index:version"
+
+# Recent changes as JSON [stop, latitude, longitude, stop_name, active], newest
+# first, so entry i is the change that produced version (current - i)
+CHANGE_LOG_KEY = "bus_stop_index:changes"
+CHANGE_LOG_SIZE = 1000
+
+# Grid cell size in degrees (about 1.1 km of latitude)
+CELL_SIZE = 0.01
+
+KM_PER_DEGREE = 111.195
+
+# Bumps the version and logs a stop change, applying it to the stop hash
+# only when the hash is seeded, so a cold hash is never left partial.
+#   KEYS: stop hash, version, change log
+#   ARGV: stop, coordinates JSON or '' when removed, change JSON, log size
+UPDATE_SCRIPT = """
+local version = redis.call('INCR', KEYS[2])
+if redis.call('HEXISTS', KEYS[1], '_version') == 1 then
+    if ARGV[2] == '' then
+        redis.call('HDEL', KEYS[1], ARGV[1])
+    else
+        redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    end
+    redis.call('HSET', KEYS[1], '_version', version)
+end
+redis.call('LPUSH', KEYS[3], ARGV[3])
+redis.call('LTRIM', KEYS[3], 0, tonumber(ARGV[4]) - 1)
+return version
+"""
+
+# Seeds the stop hash with stops read from the database at a version, unless
+# another worker seeded it or a stop changed since that version was read.
+#   KEYS: stop hash, version
+#   ARGV: version, stop, coordinates JSON, stop, coordinates JSON...
+SEED_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], '_version') == 1 then
+    return 0
+end
+if tonumber(redis.call('GET', KEYS[2]) or 0) ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+for i = 2, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('HSET', KEYS[1], '_version', ARGV[1])
+return 1
+"""
+
+# Reads the current version with the changes a worker at ARGV[1] has not
+# seen, newest first, in one step so no change can slip in between. Only
+# the version is returned when the log no longer reaches back that far.
+#   KEYS: version, change log
+#   ARGV: version the worker is at
+CHANGES_SCRIPT = """
+local version = tonumber(redis.call('GET', KEYS[1]) or 0)
+local behind = version - tonumber(ARGV[1])
+if behind <= 0 or behind > redis.call('LLEN', KEYS[2]) then
+    return {version}
+end
+local changes = redis.call('LRANGE', KEYS[2], 0, behind - 1)
+table.insert(changes, 1, version)
+return changes
+"""
+
+_index = None
+_scripts = {}
+
+class StopIndex:
+    """Uniform lat/lng grid over active Bus Stops.
+
+    Stops are bucketed into CELL_SIZE cells; k-nearest and radius queries
+    only compute distances for stops in the cells around the query point.
+    """
+
+    def __init__(self, version=0):
+        self.version = version
+        self.stops = {}
+        self.cells = {}
+
+    @staticmethod
+    def cell_of(latitude, longitude):
+        return (math.floor(latitude / CELL_SIZE), math.floor(longitude / CELL_SIZE))
+
+    def add(self, stop, latitude, longitude, stop_name=None):
+        self.remove(stop)
+        self.stops[stop] = (flt(latitude), flt(longitude), stop_name)
+        self.cells.setdefault(self.cell_of(latitude, longitude), set()).add(stop)
+
+    def remove(self, stop):
+        if stop not in self.stops:
+            return
+        latitude, longitude, _ = self.stops.pop(stop)
+        cell = self.cell_of(latitude, longitude)
+        self.cells[cell].discard(stop)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def within(self, latitude, longitude, radius_km):
+        """Stops within radius_km of a point, nearest first"""
+        lat_cells = math.ceil(radius_km / (KM_PER_DEGREE * CELL_SIZE))
+        lng_cells = math.ceil(radius_km / (KM_PER_DEGREE * CELL_SIZE * max(math.cos(math.radians(latitude)), 0.01)))
+
+        results = self._ranked(latitude, longitude, self._cells_around(latitude, longitude, lat_cells, lng_cells))
+        return [stop for stop in results if stop.distance <= radius_km]
+
+    def nearest(self, latitude, longitude, k=3):
+        """The k stops nearest to a point, nearest first"""
+        ring_km = KM_PER_DEGREE * CELL_SIZE * max(math.cos(math.radians(latitude)), 0.01)
+
+        # Widen the search square until the k-th candidate is closer than any unsearched cell
+        rings = 0
+        while True:
+            cells = self._cells_around(latitude, longitude, rings, rings)
+            results = self._ranked(latitude, longitude, cells)
+            if len(cells) == len(self.cells):
+                return results[:k]
+            if len(results) >= k and results[k - 1].distance <= rings * ring_km:
+                return results[:k]
+            rings = rings * 2 + 1
+
+    def _cells_around(self, latitude, longitude, lat_cells, lng_cells):
+        cx, cy = self.cell_of(latitude, longitude)
+        if (2 * lat_cells + 1) * (2 * lng_cells + 1) > len(self.cells):
+            # Scanning the occupied cells is cheaper than probing empty ones
+            return [
+                cell for cell in self.cells
+                if abs(cell[0] - cx) <= lat_cells and abs(cell[1] - cy) <= lng_cells
+            ]
+        return [
+            (x, y)
+            for x in range(cx - lat_cells, cx + lat_cells + 1)
+            for y in range(cy - lng_cells, cy + lng_cells + 1)
+            if (x, y) in self.cells
+        ]
+
+    def _ranked(self, latitude, longitude, cells):
+        names = [stop for cell in cells for stop in self.cells[cell]]
+        if not names:
+            return []
+
+        coordinates = [self.stops[stop] for stop in names]
+        distances = haversine_one_to_many(
+            latitude, longitude,
+            [c[0] for c in coordinates], [c[1] for c in coordinates]
+        )
+
+        return [
+            frappe._dict({
+                "name": names[i],
+                "stop_name": coordinates[i][2],
+                "latitude": coordinates[i][0],
+                "longitude": coordinates[i][1],
+                "distance": float(distances[i])
+            })
+            for i in np.argsort(distances, kind="stable")
+        ]
+
+def get_stop_index():
+    """Get this worker's stop index, catching up with changes made elsewhere"""
+    global _index
+
+    if _index is None:
+        _index = load_stop_index()
+        return _index
+
+    version, *changes = get_script(CHANGES_SCRIPT)(keys=[VERSION_KEY, CHANGE_LOG_KEY], args=[_index.version])
+    version = cint(version)
+    if version == _index.version:
+        return _index
+
+    if changes:
+        # Replay the changes this worker has not seen yet, oldest first
+        for entry in reversed(changes):
+            apply_change(_index, json.loads(entry))
+        _index.version = version
+        return _index
+
+    _index = load_stop_index()
+    return _index
+
+def load_stop_index():
+    """Build an index from the shared stop hash, seeding the hash from the database when cold"""
+    pipe = frappe.cache().pipeline()
+    pipe.get(VERSION_KEY)
+    pipe.hgetall(STOP_COORDINATES_KEY)
+    version, raw = pipe.execute()
+    raw = {(k.decode() if isinstance(k, bytes) else k): v for k, v in raw.items()}
+
+    if VERSION_FIELD in raw:
+        version = cint(raw.pop(VERSION_FIELD))
+        stops = {stop: json.loads(value) for stop, value in raw.items()}
+    else:
+        # Stop changes are recorded after commit, so these rows include every change up to version
+        version = cint(version)
+        stops = {
+            stop.name: [flt(stop.latitude), flt(stop.longitude), stop.stop_name]
+            for stop in frappe.get_all(
+                "Bus Stop",
+                filters={"is_active": 1},
+                fields=["name", "stop_name", "latitude", "longitude"]
+            )
+        }
+        args = [version]
+        for stop, value in stops.items():
+            args += [stop, json.dumps(value)]
+        get_script(SEED_SCRIPT)(keys=[STOP_COORDINATES_KEY, VERSION_KEY], args=args)
+
+    index = StopIndex(version)
+    for stop, (latitude, longitude, stop_name) in stops.items():
+        index.add(stop, latitude, longitude, stop_name)
+    return index
+
+def get_script(source):
+    if source not in _scripts:
+        _scripts[source] = frappe.cache().register_script(source)
+    return _scripts[source]
+
+def apply_change(index, change):
+    stop, latitude, longitude, stop_name, active = change
+    if active:
+        index.add(stop, latitude, longitude, stop_name)
+    else:
+        index.remove(stop)
+
+def update_stop(stop, latitude, longitude, stop_name=None, active=True):
+    """Record a committed Bus Stop change in the shared index and this worker's copy"""
+    change = [stop, flt(latitude), flt(longitude), stop_name, 1 if active else 0]
+    coordinates = json.dumps([flt(latitude), flt(longitude), stop_name]) if active else ""
+
+    version = get_script(UPDATE_SCRIPT)(
+        keys=[STOP_COORDINATES_KEY, VERSION_KEY, CHANGE_LOG_KEY],
+        args=[stop, coordinates, json.dumps(change), CHANGE_LOG_SIZE]
+    )
+
+    # Keep this worker current without a reload; other workers replay the log
+    if _index is not None and _index.version == version - 1:
+        apply_change(_index, change)
+        _index.version = version
@@ -0,0 +1,77 @@
+import time
+import frappe
+
+# Users following a bus, scored by their last heartbeat
+FOLLOWERS_KEY = "bus_followers:{}"
+
+# Followed buses, scored by the newest heartbeat of any of their followers
+ACTIVE_BUSES_KEY = "bus_followers:active"
+
+# Followers that have not renewed for this long no longer receive updates
+SUBSCRIPTION_TTL = 90
+
+def add_follower(bus_id, user):
+    """Subscribe a user to a bus, or renew the subscription (the heartbeat)"""
+    now = time.time()
+    pipe = frappe.cache().pipeline()
+    pipe.zadd(FOLLOWERS_KEY.format(bus_id), {user: now})
+    pipe.zadd(ACTIVE_BUSES_KEY, {bus_id: now})
+    pipe.expire(FOLLOWERS_KEY.format(bus_id), SUBSCRIPTION_TTL * 2)
+    pipe.execute()
+
+def remove_follower(bus_id, user):
+    """Unsubscribe a user; a bus's last follower leaving also drops the bus"""
+    pipe = frappe.cache().pipeline()
+    pipe.zrem(FOLLOWERS_KEY.format(bus_id), user)
+    pipe.zcard(FOLLOWERS_KEY.format(bus_id))
+    remaining = pipe.execute()[1]
+
+    if not remaining:
+        pipe = frappe.cache().pipeline()
+        pipe.zrem(ACTIVE_BUSES_KEY, bus_id)
+        pipe.execute()
+
+def get_followed_buses():
+    """Buses with at least one live follower"""
+    pipe = frappe.cache().pipeline()
+    pipe.zrangebyscore(ACTIVE_BUSES_KEY, time.time() - SUBSCRIPTION_TTL, "+inf")
+    return [decode(bus) for bus in pipe.execute()[0]]
+
+def get_followers(bus_ids):
+    """Live followers of several buses, {bus: [user]}, in one round-trip"""
+    since = time.time() - SUBSCRIPTION_TTL
+    pipe = frappe.cache().pipeline()
+    for bus_id in bus_ids:
+        pipe.zrangebyscore(FOLLOWERS_KEY.format(bus_id), since, "+inf")
+
+    return {
+        bus_id: [decode(user) for user in users]
+        for bus_id, users in zip(bus_ids, pipe.execute())
+        if users
+    }
+
+def expire_followers():
+    """Drop followers and buses whose heartbeats lapsed.
+
+    Buses with no live follower are found with a range query on the
+    active index, so no keyspace scan is needed; only buses still
+    followed have their follower sets trimmed.
+    """
+    cutoff = time.time() - SUBSCRIPTION_TTL
+    pipe = frappe.cache().pipeline()
+    pipe.zrangebyscore(ACTIVE_BUSES_KEY, "-inf", cutoff)
+    pipe.zremrangebyscore(ACTIVE_BUSES_KEY, "-inf", cutoff)
+    pipe.zrangebyscore(ACTIVE_BUSES_KEY, cutoff, "+inf")
+    lapsed, _, followed = pipe.execute()
+
+    pipe = frappe.cache().pipeline()
+    for bus_id in lapsed:
+        pipe.delete(FOLLOWERS_KEY.format(decode(bus_id)))
+    for bus_id in followed:
+        pipe.zremrangebyscore(FOLLOWERS_KEY.format(decode(bus_id)), "-inf", cutoff)
+    pipe.execute()
+
+    return len(lapsed)
+
+def decode(value):
+    return value.decode() if isinstance(value, bytes) else value
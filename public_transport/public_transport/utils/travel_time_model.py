@@ -0,0 +1,295 @@
+import json
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import frappe
+from frappe.utils import get_datetime, now_datetime, add_days, cint
+from .route_geometry import get_route_geometry
+from .map_matching import get_route_segments
+from .deviation_detection import DEVIATION_THRESHOLD_KM
+
+# Observed travel times are counted in bins of this many seconds
+BIN_SECONDS = 10
+
+# Longer stop-to-stop times are layovers or bad data, not travel
+MAX_SEGMENT_SECONDS = 7200
+
+# Compiled lookup tables are shared across workers through this Redis hash
+MODEL_CACHE_KEY = "segment_travel_times"
+
+# How long a worker trusts its in-process copy before re-reading Redis
+LOCAL_TTL = 300
+
+# Speed assumed for segments with neither observations nor a schedule
+FALLBACK_SPEED_KMH = 30
+
+_local_tables = {}
+
+class TravelTimeTable:
+    """Observed travel times of a route's stop pairs.
+
+    Median and 85th percentile seconds are held as float32 arrays indexed
+    [pair, weekday, hour], NaN where no trip has been observed.
+    """
+
+    def __init__(self, route, pairs, medians, p85s):
+        self.route = route
+        self.pairs = pairs
+        self.medians = medians
+        self.p85s = p85s
+
+    def lookup(self, from_stop, to_stop, at, quantile="median"):
+        """Travel time in seconds for a stop pair entered at `at`, or None"""
+        row = self.pairs.get((from_stop, to_stop))
+        if row is None:
+            return None
+
+        value = (self.p85s if quantile == "p85" else self.medians)[row, at.weekday(), at.hour]
+        return None if np.isnan(value) else float(value)
+
+    def typical(self, from_stop, to_stop):
+        """Median travel time in seconds over every observed hour, or None"""
+        row = self.pairs.get((from_stop, to_stop))
+        if row is None or np.isnan(self.medians[row]).all():
+            return None
+        return float(np.nanmedian(self.medians[row]))
+
+    def as_dict(self):
+        return {
+            "route": self.route,
+            "pairs": self.pairs,
+            "medians": self.medians,
+            "p85s": self.p85s
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+def get_travel_time_table(route):
+    """Get a route's travel time table from process memory, Redis or the database"""
+    cached = _local_tables.get(route)
+    if cached and time.monotonic() - cached[1] < LOCAL_TTL:
+        return cached[0]
+
+    data = frappe.cache().hget(MODEL_CACHE_KEY, route)
+    if data:
+        table = TravelTimeTable.from_dict(data)
+    else:
+        table = build_travel_time_table(route)
+        frappe.cache().hset(MODEL_CACHE_KEY, route, table.as_dict())
+
+    _local_tables[route] = (table, time.monotonic())
+    return table
+
+def build_travel_time_table(route):
+    """Compile a route's Segment Travel Time rows into lookup arrays"""
+    rows = frappe.get_all(
+        "Segment Travel Time",
+        filters={"route": route},
+        fields=["from_stop", "to_stop", "weekday", "hour", "median_seconds", "p85_seconds"]
+    )
+
+    pairs = {}
+    for row in rows:
+        pairs.setdefault((row.from_stop, row.to_stop), len(pairs))
+
+    medians = np.full((len(pairs), 7, 24), np.nan, dtype=np.float32)
+    p85s = np.full((len(pairs), 7, 24), np.nan, dtype=np.float32)
+    for row in rows:
+        index = (pairs[(row.from_stop, row.to_stop)], row.weekday, row.hour)
+        medians[index] = row.median_seconds
+        p85s[index] = row.p85_seconds
+
+    return TravelTimeTable(route, pairs, medians, p85s)
+
+def invalidate_travel_time_table(route):
+    """Drop a route's travel time table from Redis and this process"""
+    frappe.cache().hdel(MODEL_CACHE_KEY, route)
+    _local_tables.pop(route, None)
+
+def predict_stop_arrivals(geometry, along, at=None, quantile="median"):
+    """Predicted arrival at each stop beyond `along` km as [(stop index, datetime)].
+
+    Walks the remaining segments once, looking each one up at the weekday
+    and hour the bus is expected to enter it.
+    """
+    clock = get_datetime(at) if at else now_datetime()
+    table = get_travel_time_table(geometry.route)
+    cumulative = geometry.cumulative_distances
+
+    arrivals = []
+    for i in range(max(int(np.searchsorted(cumulative, along, side="right")) - 1, 0), len(geometry.stops) - 1):
+        length = float(cumulative[i + 1] - cumulative[i])
+        remaining = min(max(float(cumulative[i + 1]) - along, 0), length)
+
+        seconds = segment_seconds(geometry, table, i, clock, quantile)
+        clock += timedelta(seconds=seconds * (remaining / length if length else 1))
+        arrivals.append((i + 1, clock))
+
+    return arrivals
+
+def segment_seconds(geometry, table, index, at, quantile="median"):
+    """Travel time of one segment: observed, else scheduled, else at FALLBACK_SPEED_KMH"""
+    observed = table.lookup(geometry.stops[index], geometry.stops[index + 1], at, quantile)
+    if observed is not None:
+        return observed
+
+    scheduled = float(geometry.scheduled_offsets[index + 1] - geometry.scheduled_offsets[index]) * 60
+    if scheduled > 0:
+        return scheduled
+
+    length = float(geometry.cumulative_distances[index + 1] - geometry.cumulative_distances[index])
+    return length / FALLBACK_SPEED_KMH * 3600
+
+def refresh_travel_time_model():
+    """Fold trips completed since the last run into the model (nightly)"""
+    trained_until = frappe.db.get_single_value("GPS Tracking Settings", "travel_time_trained_until")
+    if not trained_until:
+        history_days = cint(frappe.db.get_single_value("GPS Tracking Settings", "travel_time_history_days")) or 28
+        trained_until = add_days(now_datetime(), -history_days)
+
+    trips = frappe.get_all(
+        "Bus Trip",
+        filters={
+            "docstatus": 1,
+            "trip_status": "Completed",
+            "arrival_time": [">", trained_until]
+        },
+        fields=["name", "bus", "route", "departure_time", "arrival_time"],
+        order_by="arrival_time asc"
+    )
+    if not trips:
+        return
+
+    samples = {}
+    for trip in trips:
+        try:
+            for key, seconds in extract_segment_times(trip):
+                samples.setdefault((trip.route,) + key, []).append(seconds)
+        except Exception as e:
+            frappe.log_error(f"Travel time extraction failed for {trip.name}: {str(e)}")
+
+    routes = merge_samples(samples)
+
+    frappe.db.set_value("GPS Tracking Settings", None, "travel_time_trained_until", trips[-1].arrival_time)
+    frappe.db.commit()
+
+    for route in routes:
+        invalidate_travel_time_table(route)
+
+def extract_segment_times(trip):
+    """Stop-to-stop travel times of one completed trip from its GPS logs.
+
+    Fixes are matched to the route polyline and the time the bus passed
+    each stop is interpolated from its distance along the route. Returns
+    [((from_stop, to_stop, weekday, hour), seconds)], keyed by when the
+    bus entered the segment.
+    """
+    geometry = get_route_geometry(trip.route)
+    if len(geometry.stops) < 2:
+        return []
+
+    logs = frappe.get_all(
+        "GPS Location Log",
+        filters={
+            "bus": trip.bus,
+            "timestamp": ["between", [trip.departure_time, trip.arrival_time]]
+        },
+        fields=["latitude", "longitude", "timestamp"],
+        order_by="timestamp asc"
+    )
+    if len(logs) < 2:
+        return []
+
+    distances, _, along = get_route_segments(geometry).nearest(
+        np.array([log.latitude for log in logs], dtype=float),
+        np.array([log.longitude for log in logs], dtype=float)
+    )
+    times = np.array([get_datetime(log.timestamp).timestamp() for log in logs])
+
+    # Off-route fixes say nothing about the route's segments
+    on_route = distances <= DEVIATION_THRESHOLD_KM
+    along, times = along[on_route], times[on_route]
+
+    # Progress only counts forward; keep the first fix at each new distance
+    along = np.maximum.accumulate(along)
+    forward = np.concatenate(([True], np.diff(along) > 0)) if len(along) else along.astype(bool)
+    along, times = along[forward], times[forward]
+    if len(along) < 2:
+        return []
+
+    cumulative = geometry.cumulative_distances
+    covered = (cumulative >= along[0]) & (cumulative <= along[-1])
+    passed = np.interp(cumulative, along, times)
+
+    results = []
+    for i in range(len(geometry.stops) - 1):
+        if not (covered[i] and covered[i + 1]):
+            continue
+
+        seconds = float(passed[i + 1] - passed[i])
+        if 0 < seconds <= MAX_SEGMENT_SECONDS:
+            entered = datetime.fromtimestamp(passed[i])
+            results.append(((geometry.stops[i], geometry.stops[i + 1], entered.weekday(), entered.hour), seconds))
+
+    return results
+
+def merge_samples(samples):
+    """Add new travel times to the stored histograms and refresh their quantiles.
+
+    `samples` maps (route, from_stop, to_stop, weekday, hour) to seconds.
+    Returns the routes that changed.
+    """
+    routes = sorted({key[0] for key in samples})
+    if not routes:
+        return []
+
+    existing = {
+        (row.route, row.from_stop, row.to_stop, row.weekday, row.hour): row
+        for row in frappe.get_all(
+            "Segment Travel Time",
+            filters={"route": ["in", routes]},
+            fields=["name", "route", "from_stop", "to_stop", "weekday", "hour", "histogram"]
+        )
+    }
+
+    for key, values in samples.items():
+        row = existing.get(key)
+        histogram = {int(k): v for k, v in json.loads(row.histogram).items()} if row and row.histogram else {}
+        for seconds in values:
+            bucket = int(seconds // BIN_SECONDS)
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+
+        statistics = {
+            "sample_count": sum(histogram.values()),
+            "median_seconds": histogram_quantile(histogram, 0.5),
+            "p85_seconds": histogram_quantile(histogram, 0.85),
+            "histogram": json.dumps(histogram, sort_keys=True)
+        }
+
+        if row:
+            frappe.db.set_value("Segment Travel Time", row.name, statistics, update_modified=False)
+        else:
+            route, from_stop, to_stop, weekday, hour = key
+            frappe.get_doc(dict(
+                statistics,
+                doctype="Segment Travel Time",
+                route=route,
+                from_stop=from_stop,
+                to_stop=to_stop,
+                weekday=weekday,
+                hour=hour
+            )).insert(ignore_permissions=True)
+
+    return routes
+
+def histogram_quantile(histogram, quantile):
+    """Quantile in seconds of a {bin: count} histogram, at the bin's centre"""
+    total = sum(histogram.values())
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen >= quantile * total:
+            return (bucket + 0.5) * BIN_SECONDS
+    return None
@@ -0,0 +1,137 @@
+import json
+from datetime import datetime
+import frappe
+from frappe.utils import now_datetime, get_datetime, add_to_date
+
+# Per-bus sorted set of submitted trips scored by departure time.
+# Members are JSON [trip, route, bus_operator, arrival_epoch].
+TRIP_INDEX_KEY = "bus_trips:{}"
+
+# Marks an index as built so buses without trips are not reloaded on every call
+LOADED_MARKER = "__loaded__"
+
+# Indexes are rebuilt lazily after a day without trip changes
+TRIP_INDEX_TTL = 86400
+
+# Completed trips are kept this long so late fixes still resolve
+RETENTION_HOURS = 24
+
+def active_trip(bus_id, at=None):
+    """Get the trip a bus is running at a given time (default now).
+
+    Resolved from the bus's trip index with a single reverse range lookup,
+    so the cost is O(log n) in the number of indexed trips.
+    """
+    at = get_datetime(at) if at else now_datetime()
+    ensure_index(bus_id)
+
+    members = frappe.cache().zrevrangebyscore(
+        TRIP_INDEX_KEY.format(bus_id), at.timestamp(), "-inf", start=0, num=1, withscores=True
+    )
+    if not members:
+        return None
+
+    trip = parse_member(bus_id, *members[0])
+    if not trip or trip.arrival_time <= at:
+        return None
+    return trip
+
+def upcoming_trips(bus_id, limit=5, after=None):
+    """Get the next trips a bus is scheduled to depart on"""
+    after = get_datetime(after) if after else now_datetime()
+    ensure_index(bus_id)
+
+    members = frappe.cache().zrangebyscore(
+        TRIP_INDEX_KEY.format(bus_id), f"({after.timestamp()}", "+inf", start=0, num=limit, withscores=True
+    )
+    return [trip for trip in (parse_member(bus_id, *m) for m in members) if trip]
+
+def ensure_index(bus_id):
+    """Build a bus's trip index if it is not cached"""
+    if not frappe.cache().zscore(TRIP_INDEX_KEY.format(bus_id), LOADED_MARKER):
+        refresh_bus(bus_id)
+
+def refresh_bus(bus_id):
+    """Rebuild a bus's trip index from submitted Bus Trips"""
+    if not bus_id:
+        return
+
+    trips = frappe.get_all(
+        "Bus Trip",
+        filters={
+            "bus": bus_id,
+            "arrival_time": [">", add_to_date(now_datetime(), hours=-RETENTION_HOURS)],
+            "docstatus": 1
+        },
+        fields=["name", "route", "bus_operator", "departure_time", "arrival_time"]
+    )
+
+    key = TRIP_INDEX_KEY.format(bus_id)
+    mapping = {LOADED_MARKER: 0}
+    for trip in trips:
+        member = json.dumps([
+            trip.name,
+            trip.route,
+            trip.bus_operator,
+            get_datetime(trip.arrival_time).timestamp()
+        ])
+        mapping[member] = get_datetime(trip.departure_time).timestamp()
+
+    pipe = frappe.cache().pipeline()
+    pipe.delete(key)
+    pipe.zadd(key, mapping)
+    pipe.expire(key, TRIP_INDEX_TTL)
+    pipe.execute()
+
+def invalidate_bus(bus_id):
+    """Drop a bus's trip index so it is rebuilt on next use"""
+    frappe.cache().delete(TRIP_INDEX_KEY.format(bus_id))
+
+def parse_member(bus_id, member, score):
+    """Convert an index member into a trip dict"""
+    if isinstance(member, bytes):
+        member = member.decode()
+    if member == LOADED_MARKER:
+        return None
+
+    name, route, bus_operator, arrival = json.loads(member)
+    return frappe._dict({
+        "name": name,
+        "bus": bus_id,
+        "route": route,
+        "bus_operator": bus_operator,
+        "departure_time": datetime.fromtimestamp(score),
+        "arrival_time": datetime.fromtimestamp(arrival)
+    })
+
+def get_trip_status(departure_time, arrival_time, at=None):
+    """Scheduled, Running or Completed for a trip's time window"""
+    at = get_datetime(at) if at else now_datetime()
+    if at < get_datetime(departure_time):
+        return "Scheduled"
+    if at < get_datetime(arrival_time):
+        return "Running"
+    return "Completed"
+
+def update_trip_states():
+    """Advance the materialized trip_status of submitted trips"""
+    now = now_datetime()
+
+    frappe.db.sql("""
+        UPDATE `tabBus Trip`
+        SET trip_status = 'Running'
+        WHERE docstatus = 1
+            AND trip_status = 'Scheduled'
+            AND departure_time <= %(now)s
+            AND arrival_time > %(now)s
+    """, {"now": now})
+
+    frappe.db.sql("""
+        UPDATE `tabBus Trip`
+        SET trip_status = 'Completed'
+        WHERE docstatus = 1
+            AND trip_status IN ('Scheduled', 'Running')
+            AND arrival_time <= %(now)s
+    """, {"now": now})
+
+    frappe.db.commit()
@@ -0,0 +1,132 @@
+import json
+import math
+import time
+import frappe
+
+# Tile edge at level 0 in degrees; every further level halves it
+BASE_TILE_DEGREES = 0.8
+GRID_LEVELS = 5
+
+# A viewport is subscribed at the finest level that covers it in this many tiles
+MAX_VIEWPORT_TILES = 64
+
+# Users watching a tile, as a set per tile
+TILE_KEY = "viewport_tile:{}"
+
+# Every user's subscribed tiles, {user: JSON list}
+VIEWPORTS_KEY = "viewport_subscriptions"
+
+# Viewport subscribers scored by when their subscription lapses
+VIEWPORT_EXPIRY_KEY = "viewport_subscriptions:expiry"
+
+# Clients renew their viewport at least this often or stop receiving updates
+VIEWPORT_TTL = 120
+
+def tile_size(level):
+    return BASE_TILE_DEGREES / 2 ** level
+
+def tile_of(latitude, longitude, level):
+    size = tile_size(level)
+    return f"{level}:{math.floor(latitude / size)}:{math.floor(longitude / size)}"
+
+def position_tiles(latitude, longitude):
+    """The tile containing a point at every grid level"""
+    return [tile_of(latitude, longitude, level) for level in range(GRID_LEVELS)]
+
+def viewport_tiles(south, west, north, east, zoom=None):
+    """Tiles covering a bounding box at the finest level within MAX_VIEWPORT_TILES.
+
+    The map zoom caps the level, so a zoomed-out client is not handed a
+    fine grid just because its window is small.
+    """
+    finest = GRID_LEVELS - 1
+    if zoom is not None:
+        finest = min(finest, max(int(zoom) - 9, 0))
+
+    for level in range(finest, -1, -1):
+        size = tile_size(level)
+        rows = range(math.floor(south / size), math.floor(north / size) + 1)
+        cols = range(math.floor(west / size), math.floor(east / size) + 1)
+        if len(rows) * len(cols) <= MAX_VIEWPORT_TILES or level == 0:
+            return [f"{level}:{row}:{col}" for row in rows for col in cols]
+
+def set_viewport(user, tiles):
+    """Replace a user's subscribed tiles, touching only the tiles that changed"""
+    previous = get_viewport(user)
+    tiles = set(tiles)
+
+    pipe = frappe.cache().pipeline()
+    for tile in previous - tiles:
+        pipe.srem(TILE_KEY.format(tile), user)
+    for tile in tiles - previous:
+        pipe.sadd(TILE_KEY.format(tile), user)
+    pipe.hset(VIEWPORTS_KEY, user, json.dumps(sorted(tiles)))
+    pipe.zadd(VIEWPORT_EXPIRY_KEY, {user: time.time() + VIEWPORT_TTL})
+    pipe.execute()
+
+def clear_viewport(user):
+    remove_viewports({user: get_viewport(user)})
+
+def get_viewport(user):
+    pipe = frappe.cache().pipeline()
+    pipe.hget(VIEWPORTS_KEY, user)
+    raw = pipe.execute()[0]
+    return set(json.loads(raw)) if raw else set()
+
+def remove_viewports(viewports):
+    """Drop {user: tiles} subscriptions from the tile sets and the registry"""
+    if not viewports:
+        return
+
+    pipe = frappe.cache().pipeline()
+    for user, tiles in viewports.items():
+        for tile in tiles:
+            pipe.srem(TILE_KEY.format(tile), user)
+    pipe.hdel(VIEWPORTS_KEY, *viewports)
+    pipe.zrem(VIEWPORT_EXPIRY_KEY, *viewports)
+    pipe.execute()
+
+def get_tile_subscribers(tiles):
+    """Users watching each tile, {tile: [user]}, in one round-trip"""
+    tiles = list(tiles)
+    pipe = frappe.cache().pipeline()
+    for tile in tiles:
+        pipe.smembers(TILE_KEY.format(tile))
+
+    return {
+        tile: [user.decode() if isinstance(user, bytes) else user for user in users]
+        for tile, users in zip(tiles, pipe.execute())
+        if users
+    }
+
+def group_by_viewer(positions):
+    """Group {bus: payload} into {user: [payload]} for every user whose viewport covers the bus"""
+    tiles = {
+        bus: position_tiles(payload["lat"], payload["lng"])
+        for bus, payload in positions.items()
+    }
+    subscribers = get_tile_subscribers({tile for bus_tiles in tiles.values() for tile in bus_tiles})
+    if not subscribers:
+        return {}
+
+    viewers = {}
+    for bus, bus_tiles in tiles.items():
+        users = {user for tile in bus_tiles for user in subscribers.get(tile, ())}
+        for user in users:
+            viewers.setdefault(user, []).append(positions[bus])
+    return viewers
+
+def prune_viewports():
+    """Remove viewport subscriptions that were not renewed in time"""
+    pipe = frappe.cache().pipeline()
+    pipe.zrangebyscore(VIEWPORT_EXPIRY_KEY, "-inf", time.time())
+    users = [user.decode() if isinstance(user, bytes) else user for user in pipe.execute()[0]]
+    if not users:
+        return
+
+    pipe = frappe.cache().pipeline()
+    pipe.hmget(VIEWPORTS_KEY, users)
+    remove_viewports({
+        user: json.loads(raw) if raw else []
+        for user, raw in zip(users, pipe.execute()[0])
+    })
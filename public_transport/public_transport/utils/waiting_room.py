@@ -0,0 +1,187 @@
+import base64
+import hashlib
+import hmac
+import json
+import math
+import time
+import frappe
+from frappe.utils.password import get_encryption_key
+from ..doctype.booking_queue_settings.booking_queue_settings import get_queue_settings
+
+# Users waiting for a trip, scored by arrival order
+QUEUE_KEY = "booking_queue:{}"
+
+# Users waiting for a trip, scored by their last poll
+SEEN_KEY = "booking_queue:{}:seen"
+
+# Users allowed to book a trip, scored by when their admission lapses
+ADMITTED_KEY = "booking_queue:{}:admitted"
+
+# Arrival counter of a trip's queue
+SEQUENCE_KEY = "booking_queue:{}:sequence"
+
+# Smoothed seconds an admitted user takes to book, per trip
+SESSION_KEY = "booking_queue:{}:session"
+
+# Queue tokens stop being accepted after this long
+TOKEN_SECONDS = 2 * 3600
+
+# Assumed booking time until a trip has measured some
+DEFAULT_SESSION_SECONDS = 60
+
+# Weight of a new booking time in the smoothed value
+SESSION_SMOOTHING = 0.2
+
+# Lapsed admissions and waiters are dropped, then free places go to the
+# longest waiting users. Returns {1, admission expiry} for an admitted user,
+# {0, users ahead} for a waiting one and {-1} for a user not in the queue.
+#   KEYS: queue, seen, admitted
+#   ARGV: now, concurrent bookers, admission seconds, waiting timeout, user
+ADMISSION_SCRIPT = """
+local now = tonumber(ARGV[1])
+local user = ARGV[5]
+
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now)
+
+local stale = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now - tonumber(ARGV[4]), 'LIMIT', 0, 1000)
+if #stale > 0 then
+    redis.call('ZREM', KEYS[1], unpack(stale))
+    redis.call('ZREM', KEYS[2], unpack(stale))
+end
+
+if redis.call('ZSCORE', KEYS[1], user) then
+    redis.call('ZADD', KEYS[2], now, user)
+end
+
+local free = tonumber(ARGV[2]) - redis.call('ZCARD', KEYS[3])
+if free > 0 then
+    local admitted = redis.call('ZRANGE', KEYS[1], 0, free - 1)
+    if #admitted > 0 then
+        for _, next_user in ipairs(admitted) do
+            redis.call('ZADD', KEYS[3], now + tonumber(ARGV[3]), next_user)
+        end
+        redis.call('ZREM', KEYS[1], unpack(admitted))
+        redis.call('ZREM', KEYS[2], unpack(admitted))
+    end
+end
+
+local expires = redis.call('ZSCORE', KEYS[3], user)
+if expires then
+    return {1, expires}
+end
+
+local ahead = redis.call('ZRANK', KEYS[1], user)
+if not ahead then
+    return {-1}
+end
+return {0, ahead}
+"""
+
+_script = None
+
+def waiting_room_enabled():
+    return bool(get_queue_settings().enable_waiting_room)
+
+def join_queue(trip_id, user):
+    """Queue a user for a trip, keeping their place if already queued, and issue their token"""
+    now = time.time()
+    if not is_admitted(trip_id, user):
+        pipe = frappe.cache().pipeline()
+        pipe.incr(SEQUENCE_KEY.format(trip_id))
+        sequence = pipe.execute()[0]
+
+        pipe = frappe.cache().pipeline()
+        pipe.zadd(QUEUE_KEY.format(trip_id), {user: sequence}, nx=True)
+        pipe.zadd(SEEN_KEY.format(trip_id), {user: now})
+        for key in (QUEUE_KEY, SEEN_KEY, ADMITTED_KEY, SEQUENCE_KEY):
+            pipe.expire(key.format(trip_id), TOKEN_SECONDS)
+        pipe.execute()
+
+    status = get_queue_status(trip_id, user)
+    status.token = make_token(trip_id, user, now + TOKEN_SECONDS)
+    return status
+
+def get_queue_status(trip_id, user):
+    """Admit whoever the free places allow and report the user's standing.
+
+    Waiting users call this to poll, which also keeps their place.
+    """
+    global _script
+    if _script is None:
+        _script = frappe.cache().register_script(ADMISSION_SCRIPT)
+
+    settings = get_queue_settings()
+    result = _script(
+        keys=[QUEUE_KEY.format(trip_id), SEEN_KEY.format(trip_id), ADMITTED_KEY.format(trip_id)],
+        args=[time.time(), settings.max_concurrent_bookers, settings.admission_seconds, settings.waiting_timeout, user]
+    )
+
+    if result[0] == 1:
+        return frappe._dict(status="admitted", admitted_until=float(result[1]))
+    if result[0] == -1:
+        return frappe._dict(status="not_queued")
+
+    ahead = int(result[1])
+    return frappe._dict(
+        status="waiting",
+        position=ahead + 1,
+        estimated_wait=estimate_wait(trip_id, ahead, settings.max_concurrent_bookers)
+    )
+
+def estimate_wait(trip_id, ahead, concurrent):
+    """Seconds until a user with `ahead` users in front is admitted"""
+    pipe = frappe.cache().pipeline()
+    pipe.get(SESSION_KEY.format(trip_id))
+    session = float(pipe.execute()[0] or DEFAULT_SESSION_SECONDS)
+    return int(math.ceil((ahead + 1) / concurrent) * session)
+
+def is_admitted(trip_id, user):
+    pipe = frappe.cache().pipeline()
+    pipe.zscore(ADMITTED_KEY.format(trip_id), user)
+    expires = pipe.execute()[0]
+    return expires is not None and float(expires) > time.time()
+
+def leave_queue(trip_id, user):
+    """Free a user's admission after booking, recording how long the booking took"""
+    settings = get_queue_settings()
+    pipe = frappe.cache().pipeline()
+    pipe.zscore(ADMITTED_KEY.format(trip_id), user)
+    pipe.zrem(ADMITTED_KEY.format(trip_id), user)
+    pipe.get(SESSION_KEY.format(trip_id))
+    expires, _, session = pipe.execute()
+    if expires is None:
+        return
+
+    took = time.time() - (float(expires) - settings.admission_seconds)
+    session = float(session or DEFAULT_SESSION_SECONDS)
+    session += SESSION_SMOOTHING * (took - session)
+
+    pipe = frappe.cache().pipeline()
+    pipe.set(SESSION_KEY.format(trip_id), session, ex=TOKEN_SECONDS)
+    pipe.execute()
+
+def make_token(trip_id, user, expires):
+    payload = base64.urlsafe_b64encode(
+        json.dumps({"t": trip_id, "u": user, "e": int(expires)}, separators=(",", ":")).encode()
+    ).decode()
+    return f"{payload}.{sign(payload)}"
+
+def verify_token(token, trip_id, user):
+    """True when the token was issued by this site to user for trip_id and has not expired.
+
+    Needs no database or Redis access, so forged and stale tokens are
+    turned away before any other work.
+    """
+    payload, _, signature = (token or "").partition(".")
+    if not payload or not hmac.compare_digest(signature, sign(payload)):
+        return False
+
+    try:
+        claims = json.loads(base64.urlsafe_b64decode(payload.encode()))
+    except ValueError:
+        return False
+
+    return claims.get("t") == trip_id and claims.get("u") == user and claims.get("e", 0) > time.time()
+
+def sign(payload):
+    return hmac.new(get_encryption_key().encode(), payload.encode(), hashlib.sha256).hexdigest()
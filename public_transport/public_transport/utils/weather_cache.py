@@ -0,0 +1,115 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+import frappe
+from frappe.utils import cint
+
+# Cached provider response per geohash cell, as JSON
+OBSERVATION_KEY = "weather_observation:{}"
+
+OPENWEATHERMAP_URL = "https://api.openweathermap.org/data/2.5/weather"
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+_session = None
+
+def geohash_cell(latitude, longitude, precision):
+    """Geohash of a point and the centre (latitude, longitude) of its cell"""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    cell, bits, value, even = [], 0, 0, True
+
+    while len(cell) < precision:
+        span, coordinate = (lng_range, longitude) if even else (lat_range, latitude)
+        middle = (span[0] + span[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            span[0] = middle
+        else:
+            span[1] = middle
+        even = not even
+
+        bits += 1
+        if bits == 5:
+            cell.append(GEOHASH_ALPHABET[value])
+            bits, value = 0, 0
+
+    return "".join(cell), ((lat_range[0] + lat_range[1]) / 2, (lng_range[0] + lng_range[1]) / 2)
+
+def get_session(pool_size):
+    """Process-wide HTTP session, so connections to the provider are reused"""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+    return _session
+
+def get_weather_observations(settings, points):
+    """Weather for many (latitude, longitude) points, keyed by point.
+
+    Points are bucketed into geohash cells. Each distinct cell is read from
+    the cache once, and the misses are fetched concurrently, at the cell
+    centre, and cached for cache_ttl minutes. Points whose lookup failed
+    map to None.
+    """
+    precision = cint(settings.geohash_precision) or 5
+    cells, centres = {}, {}
+    for point in points:
+        cell, centre = geohash_cell(point[0], point[1], precision)
+        cells[point] = cell
+        centres[cell] = centre
+
+    unique = list(centres)
+    pipe = frappe.cache().pipeline()
+    for cell in unique:
+        pipe.get(OBSERVATION_KEY.format(cell))
+    observations = {
+        cell: json.loads(raw)
+        for cell, raw in zip(unique, pipe.execute())
+        if raw
+    }
+
+    missing = [cell for cell in unique if cell not in observations]
+    if missing:
+        fetched = fetch_observations(settings, {cell: centres[cell] for cell in missing})
+
+        ttl = (cint(settings.cache_ttl) or 30) * 60
+        pipe = frappe.cache().pipeline()
+        for cell, data in fetched.items():
+            if data is not None:
+                pipe.set(OBSERVATION_KEY.format(cell), json.dumps(data), ex=ttl)
+        pipe.execute()
+        observations.update(fetched)
+
+    return {point: observations.get(cell) for point, cell in cells.items()}
+
+def fetch_observations(settings, centres):
+    """Fetch {cell: (latitude, longitude)} from the provider in parallel"""
+    workers = cint(settings.max_concurrent_requests) or 8
+    timeout = cint(settings.request_timeout) or 10
+    session = get_session(workers)
+    api_key = settings.get_password("api_key")
+    url = settings.api_endpoint if settings.provider == "Custom" and settings.api_endpoint else OPENWEATHERMAP_URL
+
+    def fetch(centre):
+        try:
+            response = session.get(
+                url,
+                params={
+                    "lat": centre[0],
+                    "lon": centre[1],
+                    "appid": api_key,
+                    "units": "metric"
+                },
+                timeout=timeout
+            )
+            return response.json() if response.status_code == 200 else None
+        except requests.RequestException:
+            return None
+
+    cells = list(centres)
+    with ThreadPoolExecutor(max_workers=min(workers, len(cells))) as executor:
+        return dict(zip(cells, executor.map(fetch, [centres[cell] for cell in cells])))
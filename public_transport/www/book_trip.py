@@ -1,5 +1,7 @@
 import frappe
 from frappe import _
+from public_transport.public_transport.utils.seat_reservations import get_seat_counts
+from public_transport.public_transport.utils.waiting_room import waiting_room_enabled
 
 def get_context(context):
     context.no_cache = 1
@@ -15,14 +17,12 @@ def get_context(context):
         order_by="departure_time asc"
     )
     
-    # Add available seats count for each trip
+    # Available seats of every trip in one round-trip
+    counts = get_seat_counts([trip.name for trip in context.trips])
     for trip in context.trips:
-        trip.available_seats = len(frappe.get_all(
-            "Seat Map",
-            filters={
-                "parent": trip.name,
-                "status": "Available"
-            }
-        ))
+        trip.available_seats = counts[trip.name].available
+
+    # Bookers queue before create_booking when the waiting room is on
+    context.waiting_room_enabled = waiting_room_enabled()
         
-    return context
\ No newline at end of file
+    return context
@@ -1,5 +1,6 @@
 import frappe
-from frappe.utils import now_datetime, add_to_date
+from public_transport.public_transport.utils.location_cache import get_latest_positions
+from public_transport.public_transport.utils.route_geometry import get_active_routes
 
 def get_context(context):
     context.no_cache = 1
@@ -8,28 +9,25 @@ def get_context(context):
     context.active_trips = frappe.get_all(
         "Bus Trip",
         filters={
-            "departure_time": ["<=", now_datetime()],
-            "arrival_time": [">", now_datetime()],
+            "trip_status": "Running",
             "docstatus": 1
         },
         fields=["name", "route", "departure_time", "bus"],
         order_by="departure_time desc"
     )
     
-    # Add estimated arrival for each trip
+    # Latest locations for every active bus in one cache round-trip
+    locations = get_latest_positions([trip.bus for trip in context.active_trips])
+    
+    routes = get_active_routes()
+    
     for trip in context.active_trips:
         trip.departure_time = trip.departure_time.strftime("%H:%M")
         
-        # Get latest location
-        latest_location = frappe.get_all(
-            "GPS Location Log",
-            filters={"bus": trip.bus},
-            fields=["latitude", "longitude", "timestamp"],
-            order_by="timestamp desc",
-            limit=1
-        )
+        route = routes.get(trip.route)
+        trip.route_name = route.route_name if route else trip.route
         
-        if latest_location:
-            trip.current_location = latest_location[0]
+        if trip.bus in locations:
+            trip.current_location = locations[trip.bus]
     
     return context
\ No newline at end of file